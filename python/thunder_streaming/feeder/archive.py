@@ -0,0 +1,265 @@
+"""An append-only, chunked and compressed archive of raw input frames, with an index allowing random access by
+timepoint.
+
+An archive is a directory containing:
+* data files, "archive-00000.dat" and so on, each a sequence of independently compressed chunks. A new data file is
+  started once the current one exceeds max_file_bytes.
+* an index, "archive.index", with one JSON object per line per chunk, giving the chunk's data file, byte offset and
+  compressed length, codec, and the timepoints, their arrival times and per-queue frame sizes it contains.
+
+Each chunk holds the frames for a run of consecutive timepoints (in order of arrival), and within each timepoint,
+the frames for each queue in the archive's queue order, concatenated. Chunks are only listed in the index once they
+have been completely written, so an archive that is being written to may be read at any time.
+
+Chunks are compressed on a pool of worker threads; zlib and bz2 release the interpreter lock while compressing.
+lzma is used if the lzma module (or the backports.lzma package) is available.
+"""
+import bz2
+from collections import deque
+import json
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Lock
+import time
+import zlib
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+CODECS = {
+    "none": (lambda data, level: data, lambda data: data),
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (lambda data, level: bz2.compress(data, max(1, level)), bz2.decompress),
+}
+if lzma is not None:
+    CODECS["lzma"] = (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+
+INDEX_FILENAME = "archive.index"
+DATA_FILENAME_FMT = "archive-%05d.dat"
+
+
+class ArchiveWriter(object):
+    """Appends frames to an archive directory.
+
+    Parameters
+    ----------
+    archive_dir: string
+        Directory to write to; created if necessary. If it already contains an archive, new chunks are appended.
+    qnames: sequence of strings
+        Queue names, giving the order of frames within each timepoint.
+    chunk_timepoints: int
+        Number of timepoints per chunk.
+    codec: string
+        One of the keys of CODECS.
+    level: int
+        Compression level.
+    nworkers: int
+        Number of threads compressing chunks.
+    max_file_bytes: int
+        Size beyond which a new data file is started.
+    max_chunk_wait: float
+        Time in s after which flush_if_stale() writes out a partial chunk (negative disables).
+    """
+    def __init__(self, archive_dir, qnames, chunk_timepoints=100, codec="zlib", level=6, nworkers=2,
+                 max_file_bytes=1024*1024*1024, max_chunk_wait=60.0):
+        if codec not in CODECS:
+            raise ValueError("Unknown archive codec '%s'; available codecs are %s" % (
+                codec, ", ".join(sorted(CODECS))))
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        self.archive_dir = archive_dir
+        self.qnames = list(qnames)
+        self.chunk_timepoints = max(1, int(chunk_timepoints))
+        self.codec = codec
+        self.level = int(level)
+        self.max_file_bytes = int(max_file_bytes)
+        self.max_chunk_wait = float(max_chunk_wait)
+        self._pool = ThreadPool(nworkers)
+        # compressions in progress, in order, as (AsyncResult, index entry):
+        self._in_flight = deque()
+        self._write_lock = Lock()
+
+        self._timepoints = []
+        self._times = []
+        self._sizes = []
+        self._buffers = []
+        self._chunk_start_time = None
+
+        self._fileidx = 0
+        while os.path.exists(self._data_filename(self._fileidx + 1)):
+            self._fileidx += 1
+        self._datafp = self._open_data_file()
+        self._indexfp = open(os.path.join(archive_dir, INDEX_FILENAME), 'ab')
+
+    def _data_filename(self, fileidx):
+        return os.path.join(self.archive_dir, DATA_FILENAME_FMT % fileidx)
+
+    def _open_data_file(self):
+        fp = open(self._data_filename(self._fileidx), 'ab')
+        # the initial position of a file opened for appending is platform-dependent
+        fp.seek(0, os.SEEK_END)
+        return fp
+
+    def append(self, timepoint, frames, arrival_time=None):
+        """Adds the frames for a single timepoint, given as a list of strings (or buffers) in queue order.
+
+        arrival_time is the time the timepoint's input files were written, for replaying the archive with its
+        original timing (see bin/replay_session.py); it defaults to the current time.
+        """
+        if len(frames) != len(self.qnames):
+            raise ValueError("Expected %d frames for timepoint '%s', got %d" % (
+                len(self.qnames), timepoint, len(frames)))
+        if self._chunk_start_time is None:
+            self._chunk_start_time = time.time()
+        self._timepoints.append(timepoint)
+        self._times.append(arrival_time if arrival_time is not None else time.time())
+        self._sizes.append([len(frame) for frame in frames])
+        self._buffers.extend(frames)
+        if len(self._timepoints) >= self.chunk_timepoints:
+            self.flush()
+        self._write_completed()
+
+    def flush(self):
+        """Starts compressing the current partial chunk, if any.
+        """
+        if not self._timepoints:
+            return
+        data = b"".join(self._buffers)
+        entry = {"timepoints": self._timepoints, "times": self._times, "qnames": self.qnames, "sizes": self._sizes,
+                 "codec": self.codec, "raw_length": len(data)}
+        compress = CODECS[self.codec][0]
+        self._in_flight.append((self._pool.apply_async(compress, (data, self.level)), entry))
+        self._timepoints, self._times, self._sizes, self._buffers = [], [], [], []
+        self._chunk_start_time = None
+
+    def flush_if_stale(self):
+        """Flushes the current partial chunk if its first timepoint was added more than max_chunk_wait s ago,
+        and writes out any chunks that have finished compressing.
+        """
+        if self.max_chunk_wait >= 0 and self._chunk_start_time is not None and \
+                time.time() - self._chunk_start_time >= self.max_chunk_wait:
+            self.flush()
+        self._write_completed()
+
+    def _write_completed(self, wait=False):
+        # chunks are written in order, so stop at the first that is still being compressed
+        with self._write_lock:
+            while self._in_flight and (wait or self._in_flight[0][0].ready()):
+                result, entry = self._in_flight.popleft()
+                self._write_chunk(result.get(), entry)
+
+    def _write_chunk(self, compressed, entry):
+        if self._datafp.tell() >= self.max_file_bytes:
+            self._datafp.close()
+            self._fileidx += 1
+            self._datafp = self._open_data_file()
+        entry["file"] = os.path.basename(self._datafp.name)
+        entry["offset"] = self._datafp.tell()
+        entry["length"] = len(compressed)
+        self._datafp.write(compressed)
+        self._datafp.flush()
+        # the index entry is only written once the chunk it refers to is complete
+        self._indexfp.write(json.dumps(entry) + "\n")
+        self._indexfp.flush()
+
+    def close(self):
+        """Writes out all pending data and closes the archive.
+        """
+        self.flush()
+        self._write_completed(wait=True)
+        self._pool.close()
+        self._pool.join()
+        self._datafp.close()
+        self._indexfp.close()
+
+
+class ArchiveReader(object):
+    """Reads frames back from an archive directory by timepoint.
+
+    Only the chunks containing the requested timepoints are read and decompressed. The most recently decompressed
+    chunk is cached, so that reading consecutive ranges is cheap.
+    """
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.entries = []
+        # timepoint -> (entry index, position within entry):
+        self._locations = {}
+        self._cached_entryidx, self._cached_data = None, None
+        self.refresh()
+
+    def refresh(self):
+        """Reads any index entries added since the archive was opened or last refreshed.
+        """
+        with open(os.path.join(self.archive_dir, INDEX_FILENAME), 'rb') as fp:
+            lines = fp.readlines()
+        for line in lines[len(self.entries):]:
+            if not line.endswith("\n"):
+                # entry still being written
+                break
+            entry = json.loads(line)
+            entryidx = len(self.entries)
+            self.entries.append(entry)
+            for tpidx, timepoint in enumerate(entry["timepoints"]):
+                self._locations[timepoint] = (entryidx, tpidx)
+
+    def timepoints(self):
+        """Returns a sorted list of all timepoints in the archive.
+        """
+        return sorted(self._locations)
+
+    def arrival_time(self, timepoint):
+        """Returns the time the passed timepoint's input files were written, or None for archives written without
+        arrival times.
+        """
+        entryidx, tpidx = self._locations[timepoint]
+        times = self.entries[entryidx].get("times")
+        return times[tpidx] if times else None
+
+    def _chunk_data(self, entryidx):
+        if entryidx != self._cached_entryidx:
+            entry = self.entries[entryidx]
+            with open(os.path.join(self.archive_dir, entry["file"]), 'rb') as fp:
+                fp.seek(entry["offset"])
+                compressed = fp.read(entry["length"])
+            self._cached_data = CODECS[entry["codec"]][1](compressed)
+            self._cached_entryidx = entryidx
+        return self._cached_data
+
+    def read_frame(self, timepoint, qname):
+        """Returns the frame for the passed timepoint and queue as a string.
+        """
+        entryidx, tpidx = self._locations[timepoint]
+        entry = self.entries[entryidx]
+        qidx = entry["qnames"].index(qname)
+        offset = sum(sum(sizes) for sizes in entry["sizes"][:tpidx]) + sum(entry["sizes"][tpidx][:qidx])
+        data = self._chunk_data(entryidx)
+        return data[offset:offset+entry["sizes"][tpidx][qidx]]
+
+    def read(self, start, stop, qname, dtype='uint16'):
+        """Returns the frames from the passed queue for all archived timepoints t with start <= t < stop, as a 2d
+        array of shape (number of timepoints, elements per frame), in timepoint order.
+
+        All frames in the range must be the same size.
+        """
+        timepoints = [timepoint for timepoint in self.timepoints() if start <= timepoint < stop]
+        if not timepoints:
+            return np.empty((0, 0), dtype=dtype)
+        # read in chunk order, so that each chunk is decompressed at most once
+        order = sorted(xrange(len(timepoints)), key=lambda idx: self._locations[timepoints[idx]])
+        out = None
+        for idx in order:
+            frame = np.frombuffer(self.read_frame(timepoints[idx], qname), dtype=dtype)
+            if out is None:
+                out = np.empty((len(timepoints), frame.size), dtype=dtype)
+            elif frame.size != out.shape[1]:
+                raise ValueError("Frames for queue '%s' differ in size between timepoints %s and %s" % (
+                    qname, timepoints[order[0]], timepoints[idx]))
+            out[idx] = frame
+        return out
@@ -0,0 +1,166 @@
+"""Tracking of files published by the feeder that have not yet been consumed by Spark, so that the feeder can
+hold back new data when the consumer falls behind.
+
+Whether a file has been consumed is determined by one of several ConsumptionTrackers:
+* AccessTimeTracker: a file has been consumed once it has been read, as shown by its access time. This requires
+the output directory to be on a filesystem that updates access times (i.e. not mounted 'noatime').
+* AckFileTracker: the consumer touches an acknowledgement file after processing each batch. Files published before
+the acknowledgement file's last modification time have been consumed.
+* OutputProgressTracker: files published before the most recent modification in the consumer's output directory have
+been consumed. This is approximate, since a batch in progress may already have picked up more recent files.
+"""
+from collections import OrderedDict
+import os
+import time
+
+from thunder_streaming.feeder.utils.metrics import global_metrics
+
+
+class ConsumptionTracker(object):
+    """Superclass for strategies to determine whether a published file has been consumed.
+    """
+    def consumed(self, absname, publish_time):
+        """Abstract method that returns True if the passed file, published at publish_time, has been consumed.
+        """
+        raise NotImplementedError
+
+
+class AccessTimeTracker(ConsumptionTracker):
+    """Considers a file consumed once its access time is later than its modification time.
+
+    The feeder sets both times when a file is published, so a later access time means the file has been read.
+    Files that no longer exist are also considered consumed.
+    """
+    def consumed(self, absname, publish_time):
+        try:
+            st = os.stat(absname)
+        except OSError:
+            return True
+        return st.st_atime > st.st_mtime
+
+
+class _WatermarkTracker(ConsumptionTracker):
+    """Abstract tracker that considers all files published no later than some watermark time as consumed.
+    """
+    def watermark(self):
+        raise NotImplementedError
+
+    def consumed(self, absname, publish_time):
+        return publish_time <= self.watermark()
+
+
+class AckFileTracker(_WatermarkTracker):
+    """Uses the last modification time of an acknowledgement file, touched by the consumer after each batch,
+    as the watermark.
+    """
+    def __init__(self, ack_filename):
+        self.ack_filename = ack_filename
+
+    def watermark(self):
+        try:
+            return os.stat(self.ack_filename).st_mtime
+        except OSError:
+            return 0.0
+
+
+class OutputProgressTracker(_WatermarkTracker):
+    """Uses the most recent modification time of any entry in the consumer's output directory as the watermark.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def watermark(self):
+        latest = 0.0
+        try:
+            fnames = os.listdir(self.output_dir)
+        except OSError:
+            return latest
+        for fname in fnames:
+            try:
+                latest = max(latest, os.stat(os.path.join(self.output_dir, fname)).st_mtime)
+            except OSError:
+                pass
+        return latest
+
+
+TRACKERS = {
+    "atime": lambda path: AccessTimeTracker(),
+    "ackfile": AckFileTracker,
+    "outputdir": OutputProgressTracker,
+}
+
+
+class BacklogMonitor(object):
+    """Keeps track of published files not yet consumed, in order of publication.
+
+    Consumers are assumed to take files roughly in the order in which they were published, so files are checked
+    starting from the oldest, stopping at the first one that has not been consumed.
+
+    Parameters
+    ----------
+    tracker: ConsumptionTracker
+    max_backlog: int
+        Number of unconsumed files at or above which the feeder should hold back new data.
+    max_held_files: int
+        Maximum number of input files the feeder should set aside to be merged into later batches while held back.
+        Once this many files are held, the feeder stops picking up new files altogether.
+    """
+    def __init__(self, tracker, max_backlog, max_held_files=1000):
+        self.tracker = tracker
+        self.max_backlog = int(max_backlog)
+        self.max_held_files = int(max_held_files)
+        # absname -> publish time, in order of publication:
+        self._unconsumed = OrderedDict()
+        global_metrics.gauge_callback("feeder_consumer_backlog_files", lambda: len(self._unconsumed),
+                                      "Published files not yet consumed, as of the last backlog check")
+
+    def record(self, absname, publish_time=None):
+        """Records that the passed file has been published.
+        """
+        self._unconsumed.pop(absname, None)
+        self._unconsumed[absname] = time.time() if publish_time is None else publish_time
+
+    def backlog(self):
+        """Returns the number of published files that have not yet been consumed.
+        """
+        unconsumed = self._unconsumed
+        while unconsumed:
+            absname, publish_time = next(unconsumed.iteritems())
+            if not self.tracker.consumed(absname, publish_time):
+                break
+            del unconsumed[absname]
+        return len(unconsumed)
+
+    def exceeded(self):
+        """Returns True if the backlog is at or above max_backlog.
+
+        The backlog is not logged here, as it changes with every file published or consumed; callers log when it
+        crosses max_backlog, and it is exported as the feeder_consumer_backlog_files metric.
+        """
+        return self.backlog() >= self.max_backlog
+
+
+def add_backlog_options(parser):
+    """Adds options controlling the backlog monitor to the passed optparse.OptionParser.
+    """
+    parser.add_option("--max-backlog", type="int", default=-1,
+                      help="Hold back new data while at least this many published files have not yet been " +
+                           "consumed (zero or negative disables), default %default")
+    parser.add_option("--backlog-mode", type="choice", choices=sorted(TRACKERS.keys()), default="atime",
+                      help="How to tell whether a published file has been consumed: 'atime' (file access time), " +
+                           "'ackfile' (modification time of a file touched by the consumer), or 'outputdir' " +
+                           "(latest modification in the consumer's output directory), default '%default'")
+    parser.add_option("--backlog-path", default=None,
+                      help="Acknowledgement file or consumer output directory, for the 'ackfile' and 'outputdir' " +
+                           "backlog modes")
+
+
+def get_backlog_monitor(opts):
+    """Returns a BacklogMonitor as specified by the options added by add_backlog_options(), or None if backlog
+    monitoring is disabled.
+    """
+    if opts.max_backlog <= 0:
+        return None
+    if opts.backlog_mode != "atime" and not opts.backlog_path:
+        raise ValueError("--backlog-path must be given for backlog mode '%s'" % opts.backlog_mode)
+    return BacklogMonitor(TRACKERS[opts.backlog_mode](opts.backlog_path), opts.max_backlog)
@@ -0,0 +1,267 @@
+"""Emission policies, which decide when timepoints that have been matched by a feeder are written out, and how
+many timepoints are packed into each output file.
+"""
+import math
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+
+class EmissionPolicy(object):
+    """Superclass for policies deciding when held timepoints are to be written out.
+
+    This implementation writes out all held timepoints immediately.
+    """
+    def record_arrivals(self, ntimepoints, now):
+        """Called with the number of newly matched timepoints on each feed() call, including zero.
+        """
+        pass
+
+    def record_publish(self, ntimepoints, elapsed):
+        """Called after each output file is written, with the number of timepoints it contained and the time in
+        seconds taken to write it.
+        """
+        pass
+
+    def nready(self, nheld, oldest_arrival, now):
+        """Returns the number of held timepoints, out of nheld, to write out now.
+
+        oldest_arrival is the time at which the oldest held timepoint was matched.
+        """
+        return nheld
+
+    def next_check_time(self, nheld, now):
+        """Returns the time at which nready() should next be called, if this is sooner than the feeder would
+        otherwise check, or None.
+        """
+        return None
+
+
+class FixedSizeBatches(EmissionPolicy):
+    """Writes out held timepoints in batches of batch_size, or fewer once the oldest has been held for max_wait
+    seconds (if max_wait is positive).
+    """
+    def __init__(self, batch_size, max_wait=-1.0):
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = float(max_wait)
+
+    def nready(self, nheld, oldest_arrival, now):
+        if nheld >= self.batch_size:
+            return self.batch_size
+        if nheld and self.max_wait > 0 and now - oldest_arrival >= self.max_wait:
+            return nheld
+        return 0
+
+
+class _ExpDecaySums(object):
+    """Exponentially-weighted sums for an online least squares fit of y = a + b*x.
+    """
+    def __init__(self, decay):
+        self.decay = decay
+        self.w = self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, x, y):
+        d = self.decay
+        self.w = d*self.w + 1.0
+        self.sx = d*self.sx + x
+        self.sy = d*self.sy + y
+        self.sxx = d*self.sxx + x*x
+        self.sxy = d*self.sxy + x*y
+
+    def fit(self):
+        """Returns non-negative (a, b), or None if no points have been added.
+        """
+        if not self.w:
+            return None
+        meanx, meany = self.sx / self.w, self.sy / self.w
+        varx = self.sxx / self.w - meanx*meanx
+        if varx > 1e-9 * max(1.0, meanx*meanx):
+            b = max(0.0, (self.sxy / self.w - meanx*meany) / varx)
+            a = max(0.0, meany - b*meanx)
+        else:
+            # all batches the same size, so fixed and per-timepoint costs can't be told apart
+            a, b = 0.0, meany / meanx if meanx else 0.0
+        return a, b
+
+
+class AdaptiveBatchController(EmissionPolicy):
+    """Chooses how many timepoints to pack into each output file so as to meet a target latency, measured from
+    the time a timepoint is matched to the time the file containing it is published.
+
+    The controller measures the rate at which timepoints are matched, r, and models the cost of writing out a
+    batch of n timepoints as a + b*n, fitting a and b to recent batches. The first timepoint in a batch of n then
+    waits about (n-1)/r + a + b*n seconds, and the controller picks the largest n for which this is within the
+    target, since larger batches cost less per timepoint both here and in Spark.
+
+    Held timepoints are also written out early if the oldest of them would otherwise miss the target.
+
+    If the target cannot be met even with batches of min_batch, the controller falls back to batches of up to
+    max_batch (or all held timepoints, if max_batch is not positive) and logs a warning.
+    """
+    def __init__(self, target_latency, min_batch=1, max_batch=-1, smoothing=0.2):
+        self.target_latency = float(target_latency)
+        self.min_batch = max(1, int(min_batch))
+        self.max_batch = int(max_batch)
+        self.smoothing = float(smoothing)
+        self.rate = None
+        self._last_arrival_time = None
+        self._costs = _ExpDecaySums(1.0 - self.smoothing)
+        self._target_missed = False
+
+    def record_arrivals(self, ntimepoints, now):
+        if self._last_arrival_time is not None:
+            dt = now - self._last_arrival_time
+            if dt > 0:
+                inst_rate = ntimepoints / dt
+                if self.rate is None:
+                    self.rate = inst_rate
+                else:
+                    self.rate += self.smoothing * (inst_rate - self.rate)
+        self._last_arrival_time = now
+
+    def record_publish(self, ntimepoints, elapsed):
+        self._costs.add(float(ntimepoints), elapsed)
+
+    def expected_cost(self, ntimepoints):
+        fit = self._costs.fit()
+        if fit is None:
+            return 0.0
+        a, b = fit
+        return a + b*ntimepoints
+
+    def batch_size(self):
+        """Returns the current target number of timepoints per batch, or None if there are not yet enough
+        measurements to choose one.
+        """
+        fit = self._costs.fit()
+        if not self.rate or fit is None:
+            return None
+        a, b = fit
+        interval = 1.0 / self.rate
+        nbest = int((self.target_latency - a + interval) / (interval + b))
+        if nbest < self.min_batch:
+            if not self._target_missed:
+                global_logger.get().warn(
+                    "Target latency of %g s can't be met with %g timepoint(s) arriving per s and batch cost " % (
+                        self.target_latency, self.rate) +
+                    "%g s + %g s per timepoint; falling back to configured batch limits" % (a, b))
+                self._target_missed = True
+            return self.max_batch if self.max_batch > 0 else None
+        if self._target_missed:
+            global_logger.get().info("Target latency of %g s can be met again, with batches of %d timepoints",
+                                     self.target_latency, nbest)
+            self._target_missed = False
+        if self.max_batch > 0:
+            nbest = min(nbest, self.max_batch)
+        return nbest
+
+    def nready(self, nheld, oldest_arrival, now):
+        if not nheld:
+            return 0
+        nbatch = self.batch_size()
+        if nbatch is None:
+            # still measuring, or falling back to writing out everything
+            return nheld
+        if nheld >= nbatch:
+            return nbatch
+        if now - oldest_arrival + self.expected_cost(nheld) >= self.target_latency:
+            return nheld
+        return 0
+
+
+class ClockAlignedEmission(EmissionPolicy):
+    """Writes out all held timepoints as a single file once per Spark batch interval, shortly before each batch
+    boundary, so that each file is picked up by the earliest batch it can be.
+
+    Spark Streaming starts batches at whole multiples of the batch duration since the epoch, so the boundaries are
+    at multiples of batch_time, offset by phase. Held timepoints are written out at the boundary less the expected
+    cost of writing them and a safety margin, with the cost modelled as a + b*n for n timepoints and fitted to
+    recent files, as for AdaptiveBatchController. Timepoints matched after that point are held until the next
+    interval, so that no more than one file is written per interval.
+    """
+    def __init__(self, batch_time, margin=0.1, phase=0.0, smoothing=0.2):
+        self.batch_time = float(batch_time)
+        self.margin = float(margin)
+        self.phase = float(phase)
+        self._costs = _ExpDecaySums(1.0 - float(smoothing))
+        self._last_boundary = None
+        self._too_slow = False
+
+    def record_publish(self, ntimepoints, elapsed):
+        self._costs.add(float(ntimepoints), elapsed)
+
+    def expected_cost(self, ntimepoints):
+        fit = self._costs.fit()
+        if fit is None:
+            return 0.0
+        a, b = fit
+        return a + b*ntimepoints
+
+    def boundary_after(self, now):
+        """Returns the first batch boundary after the passed time.
+        """
+        return (math.floor((now - self.phase) / self.batch_time) + 1) * self.batch_time + self.phase
+
+    def publish_time(self, boundary, ntimepoints):
+        """Returns the time at which ntimepoints held timepoints should be written out to be in time for the
+        passed boundary.
+        """
+        lead = self.expected_cost(ntimepoints) + self.margin
+        if lead >= self.batch_time and not self._too_slow:
+            global_logger.get().warn("Writing out %d timepoint(s) is expected to take %g s, more than the batch " +
+                                     "time of %g s less the margin; files will be written once per batch as soon " +
+                                     "as possible", ntimepoints, lead - self.margin, self.batch_time)
+            self._too_slow = True
+        return boundary - lead
+
+    def _next_boundary(self, now):
+        boundary = self.boundary_after(now)
+        if self._last_boundary is not None and boundary <= self._last_boundary:
+            # already written out for this interval
+            boundary = self._last_boundary + self.batch_time
+        return boundary
+
+    def nready(self, nheld, oldest_arrival, now):
+        if not nheld:
+            return 0
+        boundary = self._next_boundary(now)
+        if boundary - now > self.batch_time:
+            return 0
+        if now >= self.publish_time(boundary, nheld):
+            self._last_boundary = boundary
+            return nheld
+        return 0
+
+    def next_check_time(self, nheld, now):
+        return self.publish_time(self._next_boundary(now), max(1, nheld))
+
+
+def add_batching_options(parser):
+    """Adds options controlling adaptive batch sizing and clock-aligned emission to the passed
+    optparse.OptionParser.
+    """
+    parser.add_option("--target-latency", type="float", default=-1.0,
+                      help="Choose the number of timepoints written to each output file so as to publish each " +
+                           "timepoint within this many seconds of it being matched (negative disables), " +
+                           "default %default")
+    parser.add_option("--min-batch", type="int", default=1,
+                      help="Smallest number of timepoints per output file with --target-latency, default %default")
+    parser.add_option("--max-batch", type="int", default=-1,
+                      help="Largest number of timepoints per output file with --target-latency " +
+                           "(negative disables), default %default")
+    parser.add_option("--batch-time", type="float", default=-1.0,
+                      help="Spark batch interval in s; if positive, write all matched timepoints out as a single " +
+                           "file once per interval, shortly before each batch boundary. Takes precedence over " +
+                           "--target-latency. Default %default")
+    parser.add_option("--publish-margin", type="float", default=0.1,
+                      help="Time in s by which files are to be written out ahead of each batch boundary with " +
+                           "--batch-time, in addition to the time expected to write them, default %default")
+
+
+def get_emission_policy(opts):
+    """Returns an EmissionPolicy as specified by the options added by add_batching_options().
+    """
+    if opts.batch_time > 0:
+        return ClockAlignedEmission(opts.batch_time, margin=opts.publish_margin)
+    if opts.target_latency > 0:
+        return AdaptiveBatchController(opts.target_latency, min_batch=opts.min_batch, max_batch=opts.max_batch)
+    return EmissionPolicy()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Watches one or more input directories for new files, matches them by timepoint as grouping_series_stream_feeder
+does, and delivers each matched timepoint to several sinks, each with its own output format, directory, batch size
+and linger time. Each input file is read only once, however many sinks there are.
+
+Expected usage: something like:
+ ./fanout_stream_feeder.py \
+ /mnt/data/data/from_nick/demo_2015_01_09/registered_im/ \
+ /mnt/data/data/from_nick/demo_2015_01_09/registered_bv/ \
+ --queues images,behaviour \
+ --sink series:/mnt/tmpram/sparkinputdir/:batch=1:linger=5:shape=512,512,4 \
+ --sink series:/mnt/tmpram/sparkinputdir_slow/:batch=20:wait=30:linger=60:shape=512,512,4 \
+ --sink raw:/mnt/data/data/copies/:linger=-1 \
+ --sink socket:tcp://sparkmaster:5557:batch=1:shape=512,512,4
+
+See sinks.py for the sink specification format.
+"""
+import logging
+import sys
+
+from thunder_streaming.feeder.core import build_filecheck_generators, get_filename_parser
+from thunder_streaming.feeder.eventloop import add_eventloop_options, run_loop
+from thunder_streaming.feeder.sinks import FanOutFeeder, Sink
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import add_metrics_options, start_metrics
+from thunder_streaming.feeder.utils.profiling import add_profiling_options, start_profiling
+from thunder_streaming.feeder.utils.prefetch import add_prefetch_options, get_prefetcher
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog datadir [datadir...] --sink spec [--sink spec...] [options]")
+    parser.add_option("-p", "--poll-time", type="float", default=1.0,
+                      help="Time between checks of datadir in s, default %default")
+    parser.add_option("-m", "--mod-buffer-time", type="float", default=1.0,
+                      help="Time to wait after last file modification time before feeding file into stream, "
+                           "default %default")
+    parser.add_option("--max-files", type="int", default=-1,
+                      help="Max files to copy in one iteration "
+                           "(negative disables), default %default")
+    parser.add_option("--queues", default="img,behav",
+                      help="Comma-separated queue names (file prefixes), in the order in which they are to be " +
+                           "written out, default '%default'")
+    parser.add_option("--sink", dest="sinks", action="append", default=[],
+                      help="Sink specification 'kind:outdir[:key=value...]'; may be given more than once")
+    parser.add_option("--prefix-regex-file", default=None)
+    parser.add_option("--timepoint-regex-file", default=None)
+    parser.add_option("--check-size", action="store_true", default=False,
+                      help="If set, assume all files should be the same size as the first encountered file of that " +
+                           "type, and discard with a warning files that have different sizes.")
+    parser.add_option("--no-check-skip",  dest="check_skip", action="store_false", default=True,
+                      help="If set, omit checking for skipped timepoints. Default is to warn if " +
+                           "a timepoint appears to have been missed.")
+    add_prefetch_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
+    opts, args = parser.parse_args()
+
+    if not args or not opts.sinks:
+        print >> sys.stderr, parser.get_usage()
+        sys.exit(1)
+
+    setattr(opts, "datadirs", args)
+
+    return opts
+
+
+def main():
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+
+    filename_parser = get_filename_parser(opts)
+    qnames = opts.queues.split(",")
+    sinks = [Sink.fromSpec(spec, filename_parser=filename_parser, qnames=qnames) for spec in opts.sinks]
+    feeder = FanOutFeeder(sinks, qnames,
+                          filename_parser=filename_parser,
+                          check_file_size=opts.check_size,
+                          check_skip_in_sequence=opts.check_skip,
+                          prefetcher=get_prefetcher(opts))
+
+    file_checkers = build_filecheck_generators(opts.datadirs, opts.mod_buffer_time,
+                                               max_files=opts.max_files,
+                                               filename_predicate=filename_parser.queueName)
+    start_metrics(opts)
+    start_profiling(opts)
+    run_loop(file_checkers, feeder, opts.poll_time, opts)
+
+if __name__ == "__main__":
+    main()
@@ -17,13 +17,13 @@ Expected usage: something like:
  -l -1.0 --prefix-regex-file ../../resources/regexes/nikita_queuenames.regex \
  --timepoint-regex-file ../../resources/regexes/nikita_timepoints.regex
 
- Set TMP environment var to same filesystem as output directory (here /mnt/tmpram/)
- so as to ensure that os.rename step is atomic - see stream_feeder.py.
-
 Behavioral vars will be represented as an extra, incomplete 'z' dimension
 Regular image data can be extracted in thunder as something like the following:
 imgseries = series.filterOnKeys(lambda (x, y, z): z < 4)
 
+Behavioral files with a different dtype, byte order or header than the images can be described with a
+--queue-spec-file, which can also key them independently of the image shape; see feeder/queuespec.py.
+
 If a --shape parameter is passed to the script, the resulting output files will have x,y,z subscript indices
 added to match the specified shape. If no shape is passed, then the output will not have any index set (not even
 a linear index). (It is not clear (to me) whether data without any index could be read as a Series by Thunder...)
@@ -48,8 +48,18 @@ import os
 import sys
 
 from thunder_streaming.feeder.utils.logger import global_logger
-from thunder_streaming.feeder.core import build_filecheck_generators, runloop, get_parsing_functions
+from thunder_streaming.feeder.utils.metrics import add_metrics_options
+from thunder_streaming.feeder.utils.profiling import add_profiling_options
+from thunder_streaming.feeder.backpressure import add_backlog_options, get_backlog_monitor
+from thunder_streaming.feeder.batching import add_batching_options, get_emission_policy
+from thunder_streaming.feeder.core import build_filecheck_generators, get_filename_parser
+from thunder_streaming.feeder.eventloop import add_eventloop_options
 from thunder_streaming.feeder.feeders import SyncSeriesFeeder
+from thunder_streaming.feeder.pipeline import add_pipeline_options, run_feeder
+from thunder_streaming.feeder.preview import add_preview_options, get_preview_tap
+from thunder_streaming.feeder.queuespec import add_queue_spec_options, get_queue_specs
+from thunder_streaming.feeder.stages import StagePipeline
+from thunder_streaming.feeder.utils.prefetch import add_prefetch_options, get_prefetcher
 
 
 def get_last_matching_directory(directory_path_pattern):
@@ -79,6 +89,9 @@ def parse_options():
     parser.add_option("--linear", action="store_true", default=False)
     parser.add_option("--dtype", default="uint16")
     parser.add_option("--indtype", default="uint16")
+    parser.add_option("--stages", default=None,
+                      help="Comma-separated list of pre-reduction stages to run on image data before it is written " +
+                           "out, for example 'detrend:0.01,clip:-500:500'. See feeder/stages.py.")
     parser.add_option("--prefix-regex-file", default=None)
     parser.add_option("--timepoint-regex-file", default=None)
     parser.add_option("--check-size", action="store_true", default=False,
@@ -87,6 +100,18 @@ def parse_options():
     parser.add_option("--no-check-skip",  dest="check_skip", action="store_false", default=True,
                       help="If set, omit checking for skipped timepoints. Default is to warn if " +
                            "a timepoint appears to have been missed.")
+    parser.add_option("--write-manifests", action="store_true", default=False,
+                      help="If set, write a hidden manifest next to each series file, recording when each " +
+                           "timepoint was written and fed, for latency tracing. See feeder/manifest.py.")
+    add_backlog_options(parser)
+    add_batching_options(parser)
+    add_pipeline_options(parser)
+    add_prefetch_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
+    add_queue_spec_options(parser)
+    add_preview_options(parser)
     opts, args = parser.parse_args()
 
     if len(args) != 3:
@@ -111,17 +136,24 @@ def main():
     global_logger.get().info("Reading images from: %s", opts.imgdatadir)
     global_logger.get().info("Reading behavioral/ephys data from: %s", opts.behavdatadir)
 
-    fname_to_qname_fcn, fname_to_timepoint_fcn = get_parsing_functions(opts)
+    filename_parser = get_filename_parser(opts)
+    stages = {opts.imgprefix: StagePipeline.fromSpec(opts.stages)} if opts.stages else None
     feeder = SyncSeriesFeeder(opts.outdir, opts.linger_time, (opts.imgprefix, opts.behavprefix),
                               shape=opts.shape, dtype=opts.dtype, indtype=opts.indtype,
-                              fname_to_qname_fcn=fname_to_qname_fcn,
-                              fname_to_timepoint_fcn=fname_to_timepoint_fcn,
+                              filename_parser=filename_parser,
                               check_file_size=opts.check_size,
-                              check_skip_in_sequence=opts.check_skip)
+                              check_skip_in_sequence=opts.check_skip,
+                              stages=stages,
+                              emission_policy=get_emission_policy(opts),
+                              prefetcher=get_prefetcher(opts),
+                              queue_specs=get_queue_specs(opts),
+                              write_manifests=opts.write_manifests,
+                              preview=get_preview_tap(opts, opts.imgprefix))
     file_checkers = build_filecheck_generators((opts.imgdatadir, opts.behavdatadir), opts.mod_buffer_time,
                                                max_files=opts.max_files,
-                                               filename_predicate=fname_to_qname_fcn)
-    runloop(file_checkers, feeder, opts.poll_time)
+                                               filename_predicate=filename_parser.queueName)
+    feeder.backlog_monitor = get_backlog_monitor(opts)
+    run_feeder(file_checkers, feeder, opts.poll_time, opts)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -8,8 +8,9 @@ assumed to represent imaging and behavioral data from the same point in time.
 Files are matched based on having identical suffixes after the first appearance of a delimiter character '_', excluding
 filename extensions. So 'foo_abc.txt' and 'bar_abc' match, but 'foo_123' and 'bar_124' do not.
 
-Note that this script will block forever waiting for a match. So for instance given files a_01, a_02, a_03, b_01, and
-b_03, after moving the a_01 b_01 pair it will block waiting for a b_02 to show up.
+Matching pairs are moved as soon as both files have arrived, in whatever order. A file that is not matched within
+a few seconds is discarded with a warning. So for instance given files a_01, a_02, a_03, b_01, and b_03, the a_01 b_01
+and a_03 b_03 pairs will be moved, and a_02 will be discarded if no b_02 shows up.
 
 """
 
@@ -17,7 +18,11 @@ import logging
 import sys
 
 from thunder_streaming.feeder.utils.logger import global_logger
-from thunder_streaming.feeder.core import build_filecheck_generators, runloop, get_parsing_functions
+from thunder_streaming.feeder.utils.metrics import add_metrics_options, start_metrics
+from thunder_streaming.feeder.utils.profiling import add_profiling_options, start_profiling
+from thunder_streaming.feeder.backpressure import add_backlog_options, get_backlog_monitor
+from thunder_streaming.feeder.core import build_filecheck_generators, get_filename_parser
+from thunder_streaming.feeder.eventloop import add_eventloop_options, run_loop
 from thunder_streaming.feeder.feeders import SyncCopyAndMoveFeeder
 
 
@@ -39,6 +44,14 @@ def parse_options():
     parser.add_option("--behavprefix", default="behav")
     parser.add_option("--prefix-regex-file", default=None)
     parser.add_option("--timepoint-regex-file", default=None)
+    parser.add_option("--link-files", action="store_true", default=False,
+                      help="Hard link input files into outdir where possible instead of copying them. Linked files " +
+                           "keep the modification time of the input file, so Spark ignores any written longer ago " +
+                           "than it remembers; only use this when files are fed as soon as they are written")
+    add_backlog_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
     opts, args = parser.parse_args()
 
     if len(args) != 3:
@@ -60,15 +73,17 @@ def main():
 
     opts = parse_options()
 
-    fname_to_qname_fcn, fname_to_timepoint_fcn = get_parsing_functions(opts)
+    filename_parser = get_filename_parser(opts)
     feeder = SyncCopyAndMoveFeeder(opts.outdir, opts.linger_time, (opts.imgprefix, opts.behavprefix),
-                                   fname_to_qname_fcn=fname_to_qname_fcn,
-                                   fname_to_timepoint_fcn=fname_to_timepoint_fcn)
+                                   filename_parser=filename_parser, link_files=opts.link_files)
 
     file_checkers = build_filecheck_generators((opts.imgdatadir, opts.behavdatadir), opts.mod_buffer_time,
                                                max_files=opts.max_files,
-                                               filename_predicate=fname_to_qname_fcn)
-    runloop(file_checkers, feeder, opts.poll_time)
+                                               filename_predicate=filename_parser.queueName)
+    feeder.backlog_monitor = get_backlog_monitor(opts)
+    start_metrics(opts)
+    start_profiling(opts)
+    run_loop(file_checkers, feeder, opts.poll_time, opts)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""Replays a recorded session into feeder input directories, recreating the pattern in which its files arrived, at
+the original speed, some multiple of it, or as fast as possible.
+
+The schedule of arrivals is read from one of:
+* recorded session directories, such as the registered_im and registered_bv directories of a demo session, from the
+  modification times of the files they contain. Files are replayed into the corresponding output directory at the
+  same relative path.
+* an archive written by an ArchiveSink (see archive.py), from the arrival times recorded in its index, or at a fixed
+  --archive-rate for archives written without them. Frames are written out as <queue>_<timepoint>.bin, into one
+  output directory per queue, in the archive's queue order, or all into a single output directory.
+* a schedule saved from recorded session directories by an earlier run with --save-schedule.
+
+Each file is first placed into a hidden staging directory next to its output directory, then renamed into place,
+so that it arrives all at once. Recorded files are placed with the cheapest available method (--method auto): a
+reflink if the filesystem supports them, else a hard link if on the same filesystem, else a copy. Archived frames
+have to be decompressed and written out.
+
+A hard link shares its modification time with the recorded file, so anything touching the replayed files changes
+the recorded times. To be safe when replaying a session more than once, save its schedule with --save-schedule on
+the first run and replay from it with --schedule.
+
+The intended and actual arrival time of each file is logged as a summary, and can be written out with --report.
+
+Usage is:
+replay_session.py [options] srcdir outdir [srcdir outdir ...]
+replay_session.py [options] --archive archivedir outdir [outdir ...]
+replay_session.py [options] --schedule schedulefile outdir [outdir ...]
+"""
+import atexit
+from collections import namedtuple
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.archive import ArchiveReader
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.transfer import clone_file, transfer_file
+
+# offset: time in s of the arrival of the file in the recorded session, from the first arrival
+# outidx: index of the output directory to replay the file into
+# relpath: path of the file relative to the output directory
+# source: path of the recorded file, or (timepoint, queue name) of an archived frame
+ReplayEvent = namedtuple("ReplayEvent", ["offset", "outidx", "relpath", "source"])
+
+METHODS = ("auto", "clone", "link", "copy")
+
+
+def schedule_from_dirs(srcdirs):
+    """Returns a list of ReplayEvents for the files in the passed recorded session directories, in order of
+    modification time. Hidden files and directories are skipped.
+    """
+    arrivals = []
+    for outidx, srcdir in enumerate(srcdirs):
+        for dirpath, dirnames, filenames in os.walk(srcdir):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                arrivals.append((os.stat(path).st_mtime, outidx, os.path.relpath(path, srcdir), path))
+    arrivals.sort()
+    if not arrivals:
+        return []
+    first = arrivals[0][0]
+    return [ReplayEvent(mtime - first, outidx, relpath, path) for mtime, outidx, relpath, path in arrivals]
+
+
+def _timepoint_string(timepoint):
+    # zero-padded, so that files sort in timepoint order, as the feeders expect
+    return "%06d" % timepoint if isinstance(timepoint, (int, long)) else str(timepoint)
+
+
+def schedule_from_archive(reader, noutdirs, rate):
+    """Returns a list of ReplayEvents for the frames in the archive opened by the passed ArchiveReader.
+    """
+    timepoints = reader.timepoints()
+    times = [reader.arrival_time(timepoint) for timepoint in timepoints]
+    if None in times:
+        global_logger.get().warn("Archive has no arrival times for some timepoints; replaying all at %g per s",
+                                 rate)
+        times = [idx / float(rate) for idx in xrange(len(timepoints))]
+    arrivals = sorted(zip(times, timepoints))
+    # all chunks of an archive have the same queues
+    qnames = reader.entries[0]["qnames"] if reader.entries else []
+    events = []
+    for arrival, timepoint in arrivals:
+        for qidx, qname in enumerate(qnames):
+            outidx = qidx if noutdirs > 1 else 0
+            relpath = "%s_%s.bin" % (qname, _timepoint_string(timepoint))
+            events.append(ReplayEvent(arrival - arrivals[0][0], outidx, relpath, (timepoint, qname)))
+    return events
+
+
+def save_schedule(filename, srcdirs, events):
+    with open(filename, "w") as fp:
+        json.dump({"sources": srcdirs, "events": [list(event) for event in events]}, fp)
+
+
+def load_schedule(filename):
+    with open(filename) as fp:
+        return [ReplayEvent(*event) for event in json.load(fp)["events"]]
+
+
+def compress_gaps(events, max_gap):
+    """Returns the passed events with any gap between consecutive arrivals longer than max_gap s shortened to
+    max_gap.
+    """
+    compressed, shift, last = [], 0.0, None
+    for event in events:
+        if last is not None and event.offset - last > max_gap:
+            shift += event.offset - last - max_gap
+        last = event.offset
+        compressed.append(event._replace(offset=event.offset - shift))
+    return compressed
+
+
+def _sleep_until(target):
+    delay = target - time.time()
+    if delay > 0.002:
+        time.sleep(delay - 0.001)
+    while time.time() < target:
+        pass
+
+
+class SessionReplayer(object):
+    """Places the files of a schedule of ReplayEvents into the passed output directories at the scheduled times,
+    scaled by 1/speed (or as fast as possible, if speed is zero).
+    """
+    def __init__(self, outdirs, speed=1.0, method="auto", reader=None):
+        self.outdirs = outdirs
+        self.speed = speed
+        self.method = method
+        self.reader = reader
+        self._staging_dirs = {}
+        self.methods_used = {}
+        self.records = []
+        self._warned_link = False
+
+    def _staging_dir(self, outidx):
+        staging_dir = self._staging_dirs.get(outidx)
+        if staging_dir is None:
+            # next to the output directory, so on the same filesystem, but outside of it, so never fed
+            parent = os.path.dirname(os.path.abspath(self.outdirs[outidx]))
+            staging_dir = self._staging_dirs[outidx] = tempfile.mkdtemp(prefix=".replay-staging-", dir=parent)
+            atexit.register(shutil.rmtree, staging_dir, True)
+        return staging_dir
+
+    def _stage(self, event, stagedname):
+        if not isinstance(event.source, basestring):
+            timepoint, qname = event.source
+            with open(stagedname, "wb") as fp:
+                fp.write(self.reader.read_frame(timepoint, qname))
+            return "write"
+        if self.method == "auto":
+            return transfer_file(event.source, stagedname, clone=True)
+        if self.method == "clone":
+            clone_file(event.source, stagedname)
+        elif self.method == "link":
+            os.link(event.source, stagedname)
+        else:
+            shutil.copyfile(event.source, stagedname)
+        return self.method
+
+    def place(self, event):
+        """Places the file of the passed event into its output directory, returning the method used.
+        """
+        stagedname = os.path.join(self._staging_dir(event.outidx), os.path.basename(event.relpath))
+        method = self._stage(event, stagedname)
+        if method == "link" and not self._warned_link:
+            global_logger.get().warn("Replaying by hard links: anything touching the replayed files changes the " +
+                                     "modification times of the recorded ones. Use --save-schedule to keep the " +
+                                     "recorded schedule.")
+            self._warned_link = True
+        outname = os.path.join(self.outdirs[event.outidx], event.relpath)
+        outsubdir = os.path.dirname(outname)
+        if not os.path.isdir(outsubdir):
+            os.makedirs(outsubdir)
+        os.rename(stagedname, outname)
+        return method
+
+    def run(self, events, stats_interval=10.0):
+        """Replays the passed events, returning a list of (intended, actual) arrival times in s from the start of
+        the replay, one for each event.
+        """
+        start = time.time()
+        next_stats = start + stats_interval
+        for eventidx, event in enumerate(events):
+            if self.speed > 0:
+                intended = start + event.offset / self.speed
+                _sleep_until(intended)
+            else:
+                intended = time.time()
+            method = self.place(event)
+            self.methods_used[method] = self.methods_used.get(method, 0) + 1
+            self.records.append((intended - start, time.time() - start))
+            if time.time() >= next_stats:
+                global_logger.get().info("Replayed %d of %d files", eventidx + 1, len(events))
+                next_stats += stats_interval
+        return self.records
+
+    def summary(self):
+        if not self.records:
+            return "Replayed no files"
+        records = np.array(self.records)
+        lateness = records[:, 1] - records[:, 0]
+        return ("Replayed %d files (%s) in %.2f s, intended %.2f s; lateness p50 %.2f ms, p99 %.2f ms, max %.2f ms" %
+                (len(records), ", ".join("%d by %s" % (count, method) for method, count in
+                                         sorted(self.methods_used.iteritems())),
+                 records[:, 1].max(), records[:, 0].max(), 1000 * np.percentile(lateness, 50),
+                 1000 * np.percentile(lateness, 99), 1000 * lateness.max()))
+
+    def write_report(self, filename, events):
+        with open(filename, "w") as fp:
+            json.dump({"speed": self.speed,
+                       "methods": self.methods_used,
+                       "files": [{"path": os.path.join(self.outdirs[event.outidx], event.relpath),
+                                  "recorded": event.offset, "intended": intended, "actual": actual}
+                                 for event, (intended, actual) in zip(events, self.records)]}, fp, indent=1)
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] srcdir outdir [srcdir outdir ...]\n" +
+                                         "       %prog [options] --archive archivedir outdir [outdir ...]\n" +
+                                         "       %prog [options] --schedule schedulefile outdir [outdir ...]")
+    parser.add_option("-s", "--speed", type="float", default=1.0,
+                      help="Replay speed as a multiple of the recorded speed (zero replays as fast as possible), " +
+                           "default %default")
+    parser.add_option("--method", type="choice", choices=METHODS, default="auto",
+                      help="How recorded files are placed: one of %s, default %%default" % ", ".join(METHODS))
+    parser.add_option("--max-gap", type="float", default=None,
+                      help="If given, shorten any gap between recorded arrivals longer than this many s to it")
+    parser.add_option("--archive", default=None,
+                      help="Replay from this archive directory, rather than from recorded session directories")
+    parser.add_option("--archive-rate", type="float", default=10.0,
+                      help="Timepoints replayed per s (before --speed) from archives without arrival times, " +
+                           "default %default")
+    parser.add_option("--schedule", default=None,
+                      help="Replay from this schedule, saved by --save-schedule")
+    parser.add_option("--save-schedule", default=None,
+                      help="Save the schedule read from recorded session directories to this file")
+    parser.add_option("--report", default=None,
+                      help="Write the recorded, intended and actual arrival time of each file to this file as JSON")
+    parser.add_option("--stats-interval", type="float", default=10.0,
+                      help="Time in s between logged progress, default %default")
+    opts, args = parser.parse_args()
+
+    if opts.archive or opts.schedule:
+        if not args or (opts.archive and opts.schedule):
+            print >> sys.stderr, parser.get_usage()
+            sys.exit(1)
+        setattr(opts, "srcdirs", [])
+        setattr(opts, "outdirs", args)
+    else:
+        if not args or len(args) % 2:
+            print >> sys.stderr, parser.get_usage()
+            sys.exit(1)
+        setattr(opts, "srcdirs", args[0::2])
+        setattr(opts, "outdirs", args[1::2])
+    if opts.save_schedule and not opts.srcdirs:
+        parser.error("--save-schedule can only be used when replaying from recorded session directories")
+
+    return opts
+
+
+def main():
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+
+    reader = None
+    if opts.archive:
+        reader = ArchiveReader(opts.archive)
+        events = schedule_from_archive(reader, len(opts.outdirs), opts.archive_rate)
+    elif opts.schedule:
+        events = load_schedule(opts.schedule)
+    else:
+        events = schedule_from_dirs(opts.srcdirs)
+        if opts.save_schedule:
+            save_schedule(opts.save_schedule, opts.srcdirs, events)
+    if opts.max_gap is not None:
+        events = compress_gaps(events, opts.max_gap)
+    noutdirs = max(event.outidx for event in events) + 1 if events else 0
+    if noutdirs > len(opts.outdirs):
+        print >> sys.stderr, "Schedule replays into %d output directories, but only %d were given" % (
+            noutdirs, len(opts.outdirs))
+        sys.exit(1)
+    for outdir in opts.outdirs:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    duration = events[-1].offset if events else 0.0
+    global_logger.get().info("Replaying %d files recorded over %.1f s at %s", len(events), duration,
+                             "%gx speed" % opts.speed if opts.speed > 0 else "maximum speed")
+    replayer = SessionReplayer(opts.outdirs, speed=opts.speed, method=opts.method, reader=reader)
+    try:
+        replayer.run(events, opts.stats_interval)
+    finally:
+        global_logger.get().info(replayer.summary())
+        if opts.report:
+            replayer.write_report(opts.report, events[:len(replayer.records)])
+
+if __name__ == "__main__":
+    main()
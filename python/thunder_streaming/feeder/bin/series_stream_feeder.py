@@ -5,9 +5,19 @@ which it then converts into the Thunder series binary format and copies into the
 import logging
 import sys
 
-from thunder_streaming.feeder.core import build_filecheck_generators, runloop
+from thunder_streaming.feeder.backpressure import add_backlog_options, get_backlog_monitor
+from thunder_streaming.feeder.batching import add_batching_options, get_emission_policy
+from thunder_streaming.feeder.core import build_filecheck_generators
+from thunder_streaming.feeder.eventloop import add_eventloop_options
+from thunder_streaming.feeder.pipeline import add_pipeline_options, run_feeder
+from thunder_streaming.feeder.preview import add_preview_options, get_preview_tap
+from thunder_streaming.feeder.queuespec import add_queue_spec_options, get_queue_specs
+from thunder_streaming.feeder.stages import StagePipeline
 from thunder_streaming.feeder.utils.logger import global_logger
-from grouping_series_stream_feeder import SyncSeriesFeeder, get_parsing_functions
+from thunder_streaming.feeder.utils.metrics import add_metrics_options
+from thunder_streaming.feeder.utils.profiling import add_profiling_options
+from thunder_streaming.feeder.utils.prefetch import add_prefetch_options, get_prefetcher
+from grouping_series_stream_feeder import SyncSeriesFeeder, get_filename_parser
 
 
 def parse_options():
@@ -29,8 +39,23 @@ def parse_options():
     parser.add_option("--linear", action="store_true", default=False)
     parser.add_option("--dtype", default="uint16")
     parser.add_option("--indtype", default="uint16")
+    parser.add_option("--stages", default=None,
+                      help="Comma-separated list of pre-reduction stages to run on image data before it is written " +
+                           "out, for example 'detrend:0.01,clip:-500:500'. See feeder/stages.py.")
     parser.add_option("--prefix-regex-file", default=None)
     parser.add_option("--timepoint-regex-file", default=None)
+    parser.add_option("--write-manifests", action="store_true", default=False,
+                      help="If set, write a hidden manifest next to each series file, recording when each " +
+                           "timepoint was written and fed, for latency tracing. See feeder/manifest.py.")
+    add_backlog_options(parser)
+    add_batching_options(parser)
+    add_pipeline_options(parser)
+    add_prefetch_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
+    add_queue_spec_options(parser)
+    add_preview_options(parser)
     opts, args = parser.parse_args()
 
     if len(args) != 2:
@@ -51,14 +76,22 @@ def main():
 
     opts = parse_options()
 
-    fname_to_qname_fcn, fname_to_timepoint_fcn = get_parsing_functions(opts)
+    filename_parser = get_filename_parser(opts)
+    stages = {opts.imgprefix: StagePipeline.fromSpec(opts.stages)} if opts.stages else None
     feeder = SyncSeriesFeeder(opts.outdir, opts.linger_time, (opts.imgprefix,),
                               shape=opts.shape, dtype=opts.dtype, linear=opts.linear, indtype=opts.indtype,
-                              fname_to_qname_fcn=fname_to_qname_fcn, fname_to_timepoint_fcn=fname_to_timepoint_fcn)
+                              filename_parser=filename_parser,
+                              stages=stages,
+                              emission_policy=get_emission_policy(opts),
+                              prefetcher=get_prefetcher(opts),
+                              queue_specs=get_queue_specs(opts),
+                              write_manifests=opts.write_manifests,
+                              preview=get_preview_tap(opts, opts.imgprefix))
 
     file_checkers = build_filecheck_generators(opts.imgdatadir, opts.mod_buffer_time,
-                                               max_files=opts.max_files, filename_predicate=fname_to_qname_fcn)
-    runloop(file_checkers, feeder, opts.poll_time)
+                                               max_files=opts.max_files, filename_predicate=filename_parser.queueName)
+    feeder.backlog_monitor = get_backlog_monitor(opts)
+    run_feeder(file_checkers, feeder, opts.poll_time, opts)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
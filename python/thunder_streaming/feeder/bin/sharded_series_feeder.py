@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""A variant of grouping_series_stream_feeder that shares the work of transposing timepoints into series files among
+several worker processes, for data arriving faster than a single feeder can keep up with.
+
+A shard coordinator runs in this process, and assigns shards of the timepoints to the workers (see sharding.py).
+Each worker watches all of the input directories, but only writes out the timepoints of its own shards, to file
+names tagged with the worker's name. If a worker dies, its shards are reassigned to the remaining workers.
+
+Expected usage: something like:
+ ./sharded_series_feeder.py \
+ /mnt/data/data/from_nick/demo_2015_01_09/registered_im/ \
+ /mnt/data/data/from_nick/demo_2015_01_09/registered_bv/ \
+ /mnt/tmpram/sparkinputdir/ \
+ --queues images,behaviour --shape 512 512 4 --workers 4
+
+A replacement worker may be started by hand, joining the running coordinator, with the same arguments plus
+--worker-name, for instance --worker-name w4.
+"""
+import logging
+from multiprocessing import Process
+import signal
+import sys
+
+from thunder_streaming.feeder.batching import add_batching_options, get_emission_policy
+from thunder_streaming.feeder.core import build_filecheck_generators, get_filename_parser
+from thunder_streaming.feeder.eventloop import add_eventloop_options, run_loop
+from thunder_streaming.feeder.feeders import SyncSeriesFeeder
+from thunder_streaming.feeder.queuespec import add_queue_spec_options, get_queue_specs
+from thunder_streaming.feeder.sharding import ShardCoordinator, ShardWorker, add_sharding_options
+from thunder_streaming.feeder.stages import StagePipeline
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import add_metrics_options, start_metrics
+from thunder_streaming.feeder.utils.profiling import add_profiling_options, start_profiling
+from thunder_streaming.feeder.utils.prefetch import add_prefetch_options, get_prefetcher
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog datadir [datadir...] outdir [options]")
+    parser.add_option("-p", "--poll-time", type="float", default=1.0,
+                      help="Time between checks of datadir in s, default %default")
+    parser.add_option("-m", "--mod-buffer-time", type="float", default=1.0,
+                      help="Time to wait after last file modification time before feeding file into stream, "
+                           "default %default")
+    parser.add_option("-l", "--linger-time", type="float", default=5.0,
+                      help="Time to wait after feeding into stream before deleting intermediate file "
+                           "(negative time disables), default %default")
+    parser.add_option("--max-files", type="int", default=-1,
+                      help="Max files to copy in one iteration "
+                           "(negative disables), default %default")
+    parser.add_option("--queues", default="img,behav",
+                      help="Comma-separated queue names (file prefixes), in the order in which they are to be " +
+                           "written out, default '%default'")
+    parser.add_option("--shape", type="int", default=None, nargs=3)
+    parser.add_option("--linear", action="store_true", default=False)
+    parser.add_option("--dtype", default="uint16")
+    parser.add_option("--indtype", default="uint16")
+    parser.add_option("--stages", default=None,
+                      help="Comma-separated list of pre-reduction stages to run on the first queue's data before " +
+                           "it is written out, for example 'detrend:0.01,clip:-500:500'. See feeder/stages.py.")
+    parser.add_option("--prefix-regex-file", default=None)
+    parser.add_option("--timepoint-regex-file", default=None)
+    parser.add_option("--check-size", action="store_true", default=False,
+                      help="If set, assume all files should be the same size as the first encountered file of that " +
+                           "type, and discard with a warning files that have different sizes.")
+    parser.add_option("--write-manifests", action="store_true", default=False,
+                      help="If set, write a hidden manifest next to each series file, recording when each " +
+                           "timepoint was written and fed, for latency tracing. See feeder/manifest.py.")
+    add_batching_options(parser)
+    add_prefetch_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
+    add_queue_spec_options(parser)
+    add_sharding_options(parser)
+    opts, args = parser.parse_args()
+
+    if len(args) < 2:
+        print >> sys.stderr, parser.get_usage()
+        sys.exit(1)
+
+    setattr(opts, "datadirs", args[:-1])
+    setattr(opts, "outdir", args[-1])
+    if opts.shards <= 0:
+        opts.shards = opts.workers
+
+    return opts
+
+
+def run_worker(opts, name, port_offset):
+    """Runs a single feeder worker, feeding the timepoints of the shards assigned to it, until interrupted.
+
+    Metrics, if requested, are exported on the metrics port plus port_offset.
+    """
+    filename_parser = get_filename_parser(opts)
+    qnames = opts.queues.split(",")
+    stages = {qnames[0]: StagePipeline.fromSpec(opts.stages)} if opts.stages else None
+    feeder = SyncSeriesFeeder(opts.outdir, opts.linger_time, qnames,
+                              shape=opts.shape, linear=opts.linear, dtype=opts.dtype, indtype=opts.indtype,
+                              filename_parser=filename_parser,
+                              check_file_size=opts.check_size,
+                              # each worker only sees some of the timepoints
+                              check_skip_in_sequence=False,
+                              stages=stages,
+                              emission_policy=get_emission_policy(opts),
+                              prefetcher=get_prefetcher(opts),
+                              queue_specs=get_queue_specs(opts),
+                              write_manifests=opts.write_manifests)
+    worker = ShardWorker(feeder, opts.coordinator, name, filename_parser)
+    file_checkers = build_filecheck_generators(opts.datadirs, opts.mod_buffer_time,
+                                               max_files=opts.max_files,
+                                               filename_predicate=filename_parser.queueName)
+    start_metrics(opts, process_name=name, port_offset=port_offset)
+    start_profiling(opts, process_name=name)
+    try:
+        run_loop(file_checkers, worker, opts.poll_time, opts)
+    except KeyboardInterrupt:
+        pass
+    # an event loop returns once interrupted, rather than raising KeyboardInterrupt
+    worker.close()
+
+
+def main():
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(process)d:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+
+    if opts.worker_name:
+        # on the port after those of the workers started by the coordinating process
+        run_worker(opts, opts.worker_name, opts.workers)
+        return
+
+    # workers are started before any ZeroMQ context is created in this process
+    workers = []
+    for workeridx in xrange(opts.workers):
+        worker = Process(target=run_worker, args=(opts, "w%d" % workeridx, workeridx), name="w%d" % workeridx)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    def handler(signum, stack):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handler)
+
+    coordinator = ShardCoordinator(opts.coordinator, opts.shards, nworkers=opts.workers, block=opts.shard_block,
+                                   timeout=opts.heartbeat_timeout)
+    try:
+        coordinator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,23 @@
 
 This script will monitor a directory tree passed as a argument. When new files are added inside this tree
 (provided that they are lexicographically later than the last file fed into the stream - see updating_walk.py)
-they will be first copied into a temporary directory, then moved into the passed output directory. After a specified
-lag time, they will be automatically deleted from the output directory.
+they will be first copied (or with --link-files, hard linked) into a hidden staging directory inside the output
+directory, then moved into the output directory itself. After a specified lag time, they will be automatically
+deleted from the output directory.
 
-The temporary directory must be on the same filesystem as the output directory, or else errors will likely be
-thrown by os.rename. The root of the temporary directory tree can be set on most linux systems by the TMP environment
-variable.
+Since the staging directory is always on the same filesystem as the output directory, the final os.rename is atomic.
 """
 import logging
 import sys
 
-from thunder_streaming.feeder.core import build_filecheck_generators, runloop
+from thunder_streaming.feeder.backpressure import add_backlog_options, get_backlog_monitor
+from thunder_streaming.feeder.core import build_filecheck_generators
+from thunder_streaming.feeder.eventloop import add_eventloop_options, run_loop
 from thunder_streaming.feeder.feeders import CopyAndMoveFeeder
 
 from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import add_metrics_options, start_metrics
+from thunder_streaming.feeder.utils.profiling import add_profiling_options, start_profiling
 from thunder_streaming.feeder.utils.regex import RegexMatchToPredicate
 
 
@@ -37,6 +40,14 @@ def parse_options():
     parser.add_option("--filter-regex-file", default=None,
                       help="File containing python regular expression. If passed, only move files for which " +
                            "the base filename matches the given regex.")
+    parser.add_option("--link-files", action="store_true", default=False,
+                      help="Hard link input files into outdir where possible instead of copying them. Linked files " +
+                           "keep the modification time of the input file, so Spark ignores any written longer ago " +
+                           "than it remembers; only use this when files are fed as soon as they are written")
+    add_backlog_options(parser)
+    add_metrics_options(parser)
+    add_profiling_options(parser)
+    add_eventloop_options(parser)
     opts, args = parser.parse_args()
 
     if len(args) != 2:
@@ -65,7 +76,10 @@ def main():
     feeder = CopyAndMoveFeeder.fromOptions(opts)
     file_checkers = build_filecheck_generators(opts.indir, opts.mod_buffer_time,
                                                max_files=opts.max_files, filename_predicate=pred_fcn)
-    runloop(file_checkers, feeder, opts.poll_time)
+    feeder.backlog_monitor = get_backlog_monitor(opts)
+    start_metrics(opts)
+    start_profiling(opts)
+    run_loop(file_checkers, feeder, opts.poll_time, opts)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
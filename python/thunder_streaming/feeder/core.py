@@ -4,9 +4,10 @@ import errno
 import os
 import time
 
-from thunder_streaming.feeder.utils.filenames import getFilenamePostfix, getFilenamePrefix
 from thunder_streaming.feeder.utils.logger import global_logger
-from thunder_streaming.feeder.utils.regex import RegexMatchToQueueName, RegexMatchToTimepointString
+from thunder_streaming.feeder.utils.metrics import global_metrics
+from thunder_streaming.feeder.utils.profiling import global_profiler
+from thunder_streaming.feeder.utils.regex import FilenameParser
 from thunder_streaming.feeder.utils.updating_walk import updating_walk as uw
 
 
@@ -15,24 +16,33 @@ def file_check_generator(source_dir, mod_buffer_time, max_files=-1, filename_pre
 
     This generator will restart the underlying updating_walk at the last seen file if the updating walk runs
     out of available files.
+
+    Time spent walking the directory tree and stat'ing files is recorded in the 'walk' and 'stat' stage timers.
     """
+    walk_timer, stat_timer = global_metrics.stage_timer("walk"), global_metrics.stage_timer("stat")
     next_batch_file, walker_restart_file = None, None
     walker = uw(source_dir, filefilterfunc=filename_predicate)
     while True:
         filebatch = []
         files_left = max_files
+        start = time.time()
+        stat_time = 0.0
         try:
             if not next_batch_file:
                 next_batch_file = next(walker)
                 walker_restart_file = next_batch_file
 
-            delta = time.time() - os.stat(next_batch_file).st_mtime
+            stat_start = time.time()
+            delta = stat_start - os.stat(next_batch_file).st_mtime
+            stat_time += time.time() - stat_start
             while delta > mod_buffer_time and files_left:
                 filebatch.append(next_batch_file)
                 files_left -= 1
                 next_batch_file = None  # reset in case of exception on next line
                 next_batch_file = next(walker)
-                delta = time.time() - os.stat(next_batch_file).st_mtime
+                stat_start = time.time()
+                delta = stat_start - os.stat(next_batch_file).st_mtime
+                stat_time += time.time() - stat_start
                 walker_restart_file = next_batch_file
 
         except StopIteration:
@@ -40,6 +50,9 @@ def file_check_generator(source_dir, mod_buffer_time, max_files=-1, filename_pre
             if not filebatch:
                 global_logger.get().info("Out of files, waiting...")
             walker = uw(source_dir, walker_restart_file, filefilterfunc=filename_predicate)
+        walk_timer.observe(time.time() - start - stat_time)
+        if filebatch:
+            stat_timer.observe(stat_time)
         yield filebatch
 
 
@@ -55,42 +68,110 @@ def build_filecheck_generators(source_dir_or_dirs, mod_buffer_time, max_files=-1
     return file_checkers
 
 
-def runloop(file_checkers, feeder, poll_time):
-    """ Main program loop. This will check for new files in the passed input directories using file_check_generator,
-    push any new files found into the passed Feeder subclass via its feed() method, wait for poll_time,
-    and repeat forever.
+class FeedCycle(object):
+    """One iteration of the feeder main loop: checks for new files in the passed input directories using
+    file_check_generator and pushes any new files found into the passed Feeder subclass via its feed() method.
+
+    If the feeder has a backlog_monitor set, then new files are held back while the consumer's backlog is too large.
+    Held files are merged into the next batch once the backlog clears, and if too many files are held, no new files
+    are picked up at all until then.
     """
-    last_time = time.time()
-    while True:
-        for file_checker in file_checkers:
+    def __init__(self, file_checkers, feeder):
+        self.file_checkers = file_checkers
+        self.feeder = feeder
+        # input files set aside while the consumer is behind, as opposed to the matched timepoints a feeder holds
+        # until its emission policy writes them out (see Feeder.nheld())
+        self.held_files = []
+        self.throttled = False
+        self._nfound = global_metrics.counter("feeder_files_found_total", "Input files found ready to be fed")
+        self._npushed = global_metrics.counter("feeder_files_pushed_total", "Input files pushed out by the feeder")
+        self._nremoved = global_metrics.counter("feeder_files_removed_total", "Output files removed by clean()")
+        self._clean_timer = global_metrics.stage_timer("clean")
+        global_metrics.gauge_callback("feeder_backpressure_held_files", lambda: len(self.held_files),
+                                      "Input files held back while the consumer's backlog is too large")
+        global_metrics.gauge_callback("feeder_backpressure_throttled", lambda: int(self.throttled),
+                                      "1 while new files are held back, 0 otherwise")
+
+    def feed(self):
+        """Checks for and feeds new files, returning the list of files pushed.
+        """
+        feeder, held = self.feeder, self.held_files
+        monitor = feeder.backlog_monitor
+        was_throttled, self.throttled = self.throttled, monitor is not None and monitor.exceeded()
+        if self.throttled and not was_throttled:
+            global_logger.get().warn("Consumer backlog of %d files reached, holding back new files",
+                                     monitor.max_backlog)
+
+        pushed = []
+        for file_checker in self.file_checkers:
+            if self.throttled:
+                if len(held) < monitor.max_held_files:
+                    filebatch = next(file_checker)
+                    self._nfound.inc(len(filebatch))
+                    held.extend(filebatch)
+                continue
             # this should never throw StopIteration, will just yield an empty list if nothing is avail:
-            filebatch = feeder.feed(next(file_checker))
+            filebatch = next(file_checker)
+            self._nfound.inc(len(filebatch))
+            if held:
+                global_logger.get().info("Consumer caught up, merging %d held files into next batch", len(held))
+                filebatch = held + filebatch
+                del held[:]
+            filebatch = global_profiler.call("feed", feeder.feed, filebatch)
             if filebatch:
                 global_logger.get().info("Pushed %d files, last: %s", len(filebatch), os.path.basename(filebatch[-1]))
+                self._npushed.inc(len(filebatch))
+                pushed.extend(filebatch)
+        return pushed
 
-        removedfiles = feeder.clean()
+    def clean(self):
+        """Removes expired files from the feeder output directory, returning the list of files removed.
+        """
+        start = time.time()
+        removedfiles = self.feeder.clean()
         if removedfiles:
+            self._clean_timer.observe(time.time() - start)
+            self._nremoved.inc(len(removedfiles))
             global_logger.get().info("Removed %d temp files, last: %s", len(removedfiles), os.path.basename(removedfiles[-1]))
+        return removedfiles
+
+
+def runloop(file_checkers, feeder, poll_time):
+    """ Main program loop. This will check for new files in the passed input directories using file_check_generator,
+    push any new files found into the passed Feeder subclass via its feed() method, wait for poll_time,
+    and repeat forever.
+
+    Backpressure is handled as described for FeedCycle. See also eventloop.py, which runs many feeders
+    in a single process.
 
-        next_time = last_time + poll_time
+    If the feeder's emission policy asks to be checked sooner than the next poll (see
+    EmissionPolicy.next_check_time()), an extra cycle is run at that time.
+    """
+    cycle = FeedCycle(file_checkers, feeder)
+    policy = getattr(feeder, "emission_policy", None)
+    next_time = time.time() + poll_time
+    while True:
+        cycle.feed()
+        cycle.clean()
+
+        wake_time = next_time
+        if policy is not None:
+            check_time = policy.next_check_time(feeder.nheld(), time.time())
+            if check_time is not None and check_time < wake_time:
+                wake_time = check_time
         try:
-            time.sleep(next_time - time.time())
+            time.sleep(wake_time - time.time())
         except IOError, e:
             if e.errno == errno.EINVAL:
                 # passed a negative number, which is fine, just don't sleep
                 pass
             else:
                 raise e
-        last_time = next_time
+        if wake_time >= next_time:
+            next_time += poll_time
 
 
-def get_parsing_functions(opts):
-    if opts.prefix_regex_file:
-        fname_to_qname_fcn = RegexMatchToQueueName.fromFile(opts.prefix_regex_file).queueName
-    else:
-        fname_to_qname_fcn = getFilenamePrefix
-    if opts.timepoint_regex_file:
-        fname_to_timepoint_fcn = RegexMatchToTimepointString.fromFile(opts.timepoint_regex_file).timepoint
-    else:
-        fname_to_timepoint_fcn = getFilenamePostfix
-    return fname_to_qname_fcn, fname_to_timepoint_fcn
\ No newline at end of file
+def get_filename_parser(opts):
+    """Returns a FilenameParser using the regular expression files given in the passed script options, if any.
+    """
+    return FilenameParser.fromFiles(opts.prefix_regex_file, opts.timepoint_regex_file)
@@ -0,0 +1,374 @@
+"""A single-threaded event loop for running many feeders in one process.
+
+The loop waits in select() on file descriptors, a wakeup pipe and the next timer deadline, so an idle process uses
+no CPU between events. Blocking work (directory scans, transposes, file I/O) is handed off to a shared pool of
+worker threads, whose results are delivered back to the loop thread as callbacks. Polling and cleaning are
+scheduled as timers on the loop, so no source needs a thread of its own.
+
+Existing Feeder subclasses are run through FeederSource, which drives a FeedCycle, the same logic used by
+core.runloop(), from loop timers. The feeder scripts run their feeder on an event loop when given --event-loop (see
+add_eventloop_options() and run_loop()).
+"""
+from collections import deque
+import errno
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+import os
+import select
+import signal
+import sys
+import time
+
+from thunder_streaming.feeder.core import FeedCycle, runloop
+from thunder_streaming.feeder.utils.logger import global_logger
+
+
+class TimerHandle(object):
+    """Returned by EventLoop.call_later(); may be used to cancel the call.
+    """
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def _call_capturing(fcn, args):
+    """Runs on a worker thread, returning (True, result) or (False, exc_info) so that errors reach the loop.
+    """
+    try:
+        return True, fcn(*args)
+    except Exception:
+        return False, sys.exc_info()
+
+
+class EventLoop(object):
+    """Minimal reactor, with timers, file descriptor readers, signal handlers and a thread pool executor.
+
+    All callbacks run on the thread that calls run_forever(). The only methods safe to call from other threads
+    (or from signal handlers) are call_soon_threadsafe() and stop().
+
+    Parameters
+    ----------
+    nworkers: int
+        Number of threads in the pool used by run_in_executor().
+    """
+    def __init__(self, nworkers=4):
+        self._timers = []  # heap of (deadline, seq, TimerHandle)
+        self._seq = itertools.count()
+        self._ready = deque()
+        self._readers = {}  # fd -> callback
+        self._running = False
+        self._pool = ThreadPool(nworkers)
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            _set_nonblocking(fd)
+
+    def time(self):
+        return time.time()
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Schedules callback(*args) to run on the loop thread as soon as possible, waking the loop if necessary.
+        """
+        self._ready.append((callback, args))
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError, e:
+            # a full pipe means a wakeup is already pending
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) to run after delay seconds. Returns a TimerHandle.
+        """
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(callback, args)
+        heapq.heappush(self._timers, (when, next(self._seq), handle))
+        return handle
+
+    def add_reader(self, fd_or_file, callback, *args):
+        """Calls callback(*args) whenever the passed file descriptor, or object with a fileno() method, is readable.
+        """
+        fd = fd_or_file if isinstance(fd_or_file, (int, long)) else fd_or_file.fileno()
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd_or_file):
+        fd = fd_or_file if isinstance(fd_or_file, (int, long)) else fd_or_file.fileno()
+        self._readers.pop(fd, None)
+
+    def add_zmq_reader(self, socket, callback, *args):
+        """Calls callback(*args) whenever the passed ZeroMQ socket has messages waiting.
+
+        ZeroMQ signals its file descriptor in an edge-triggered fashion, so the callback is called repeatedly
+        until the socket has no more messages; it should receive at most one message per call, without blocking.
+        """
+        import zmq
+
+        def on_readable():
+            while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                callback(*args)
+        self.add_reader(socket.getsockopt(zmq.FD), on_readable)
+        # messages may have arrived before registration, without the descriptor becoming readable:
+        self.call_soon_threadsafe(on_readable)
+
+    def add_signal_handler(self, signum, callback, *args):
+        """Calls callback(*args) on the loop thread when the passed signal is received.
+        """
+        signal.signal(signum, lambda sig, frame: self.call_soon_threadsafe(callback, *args))
+
+    def run_in_executor(self, fcn, args=(), callback=None, errback=None):
+        """Runs fcn(*args) on a worker thread.
+
+        On success, callback(result) is then called on the loop thread. If fcn raises, errback(exc_info) is called
+        instead, or the error is logged if no errback is given.
+        """
+        def on_done(outcome):
+            ok, value = outcome
+            if ok:
+                if callback is not None:
+                    callback(value)
+            elif errback is not None:
+                errback(value)
+            else:
+                global_logger.get().error("Error in executor call to %s", getattr(fcn, '__name__', fcn),
+                                          exc_info=value)
+        self._pool.apply_async(_call_capturing, (fcn, args),
+                               callback=lambda outcome: self.call_soon_threadsafe(on_done, outcome))
+
+    def stop(self):
+        """Stops the loop after the current iteration.
+        """
+        self.call_soon_threadsafe(self._set_stopped)
+
+    def _set_stopped(self):
+        self._running = False
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0.0
+        elif self._timers:
+            timeout = max(0.0, self._timers[0][0] - self.time())
+
+        rfds = [self._wakeup_read] + self._readers.keys()
+        try:
+            readable, _, _ = select.select(rfds, [], [], timeout)
+        except (select.error, IOError, OSError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        for fd in readable:
+            if fd == self._wakeup_read:
+                self._drain_wakeups()
+            elif fd in self._readers:
+                callback, args = self._readers[fd]
+                callback(*args)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            handle = heapq.heappop(self._timers)[2]
+            if not handle.cancelled:
+                self._ready.append((handle.callback, handle.args))
+
+        # only run callbacks ready at this point; any scheduled by these will run on the next iteration
+        for _ in xrange(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self._run_once()
+
+    def close(self):
+        """Waits for outstanding executor calls to finish and releases the loop's resources.
+        """
+        self._pool.close()
+        self._pool.join()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class FeederSource(object):
+    """Adapter running an existing Feeder and its file checkers on an EventLoop.
+
+    Every poll_time seconds a FeedCycle, which checks for and feeds new files, is run on a worker thread, and every
+    clean_time seconds the feeder's clean() is run likewise. Since Feeders are not thread-safe, all work for a given
+    source is serialized: at most one call is in flight at a time, and calls that come due while one is in flight
+    are queued behind it. Ticks that come due while the previous one of the same kind is still queued are skipped.
+
+    As in core.runloop(), if the feeder's emission policy asks to be checked sooner than the next poll (see
+    EmissionPolicy.next_check_time()), an extra FeedCycle is run at that time.
+
+    Parameters
+    ----------
+    loop: EventLoop
+    file_checkers: list of generators, as returned by core.build_filecheck_generators()
+    feeder: Feeder
+    poll_time: float
+        Time between checks for new files in s.
+    clean_time: float, optional
+        Time between calls to the feeder's clean() in s. Defaults to poll_time.
+    name: string, optional
+        Name to use for this source in log messages.
+    """
+    def __init__(self, loop, file_checkers, feeder, poll_time, clean_time=None, name=None):
+        self.loop = loop
+        self.cycle = FeedCycle(file_checkers, feeder)
+        self.poll_time = float(poll_time)
+        self.clean_time = self.poll_time if clean_time is None else float(clean_time)
+        self.name = name or type(feeder).__name__
+        self._work = deque()
+        self._busy = False
+        self._running = None
+        self._stopped = False
+        self._timers = []
+        # next scheduled poll, and timer for an extra one requested by the feeder's emission policy
+        self._next_poll = None
+        self._check_timer = None
+
+    def start(self):
+        now = self.loop.time()
+        self._schedule(now, self.poll_time, self.cycle.feed)
+        self._schedule(now + self.clean_time, self.clean_time, self.cycle.clean)
+
+    def stop(self):
+        self._stopped = True
+        for timer in self._timers:
+            timer.cancel()
+        if self._check_timer is not None:
+            self._check_timer.cancel()
+        self._work.clear()
+
+    def _schedule(self, when, interval, fcn):
+        """Submits fcn at when, and every interval s afterwards, keeping to the original schedule.
+        """
+        def tick():
+            if self._stopped:
+                return
+            if fcn not in self._work:
+                self._submit(fcn)
+            # skip over any deadlines already missed
+            next_when = when + interval
+            now = self.loop.time()
+            if next_when < now:
+                next_when += interval * int((now - next_when) / interval + 1)
+            self._schedule(next_when, interval, fcn)
+        if fcn == self.cycle.feed:
+            self._next_poll = when
+        self._timers = [timer for timer in self._timers if not timer.cancelled] + [self.loop.call_at(when, tick)]
+
+    def _schedule_check(self):
+        """Schedules an extra FeedCycle at the time asked for by the feeder's emission policy, if any, when this is
+        sooner than the next poll.
+        """
+        feeder = self.cycle.feeder
+        policy = getattr(feeder, "emission_policy", None)
+        if policy is None:
+            return
+        check_time = policy.next_check_time(feeder.nheld(), self.loop.time())
+        if check_time is None or (self._next_poll is not None and check_time >= self._next_poll):
+            return
+        if self._check_timer is not None:
+            self._check_timer.cancel()
+        self._check_timer = self.loop.call_at(check_time, self._check)
+
+    def _check(self):
+        self._check_timer = None
+        if not self._stopped and self.cycle.feed not in self._work:
+            self._submit(self.cycle.feed)
+
+    def _submit(self, fcn):
+        self._work.append(fcn)
+        self._run_next()
+
+    def _run_next(self):
+        if self._busy or not self._work or self._stopped:
+            return
+        self._busy = True
+        fcn = self._running = self._work.popleft()
+        self.loop.run_in_executor(fcn, callback=self._on_done, errback=self._on_error)
+
+    def _on_done(self, result):
+        fcn, self._running = self._running, None
+        self._busy = False
+        if fcn == self.cycle.feed and not self._stopped:
+            # the feeder is idle here, so its held timepoints can be inspected from the loop thread
+            self._schedule_check()
+        self._run_next()
+
+    def _on_error(self, exc_info):
+        global_logger.get().error("Error in feeder source '%s'", self.name, exc_info=exc_info)
+        self._on_done(None)
+
+
+def run_sources(sources_args, nworkers=4, clean_time=None):
+    """Runs several feeders in a single process until interrupted by SIGINT or SIGTERM.
+
+    Parameters
+    ----------
+    sources_args: sequence of (file_checkers, feeder, poll_time) tuples
+        As would be passed to core.runloop() for each feeder.
+    nworkers: int
+        Number of worker threads shared between all feeders.
+    clean_time: float, optional
+        Time between cleanups of each feeder's output directory in s. Defaults to each feeder's poll time.
+    """
+    loop = EventLoop(nworkers=nworkers)
+    sources = [FeederSource(loop, file_checkers, feeder, poll_time, clean_time=clean_time)
+               for file_checkers, feeder, poll_time in sources_args]
+
+    def shutdown(signame):
+        global_logger.get().info("Received %s, shutting down", signame)
+        for source in sources:
+            source.stop()
+        loop.stop()
+    loop.add_signal_handler(signal.SIGINT, shutdown, "SIGINT")
+    loop.add_signal_handler(signal.SIGTERM, shutdown, "SIGTERM")
+
+    for source in sources:
+        source.start()
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+
+
+def add_eventloop_options(parser):
+    """Adds options for running a feeder script's feeder on an EventLoop to the passed optparse.OptionParser.
+    """
+    parser.add_option("--event-loop", action="store_true", default=False,
+                      help="Run the feeder on a select()-based event loop, with its blocking work done on a pool " +
+                           "of --event-loop-workers threads, rather than in a sleeping polling loop")
+    parser.add_option("--event-loop-workers", type="int", default=4,
+                      help="Number of worker threads with --event-loop, default %default")
+
+
+def run_loop(file_checkers, feeder, poll_time, opts):
+    """Runs the passed feeder until interrupted, as specified by the options added by add_eventloop_options():
+    either with core.runloop(), or as the only source on an EventLoop.
+    """
+    if opts.event_loop:
+        run_sources([(file_checkers, feeder, poll_time)], nworkers=opts.event_loop_workers)
+    else:
+        runloop(file_checkers, feeder, poll_time)
@@ -1,25 +1,37 @@
 """Feeder and subclasses, which abstract a queue or queues of files.
 """
+import atexit
 from collections import deque
-from itertools import imap, groupby, tee, izip
-from itertools import product as iproduct
-import numpy as np
-from operator import itemgetter
+import errno
+import heapq
 import os
+from Queue import Queue
 import shutil
 import tempfile
+from threading import Thread
 import time
 
-from thunder_streaming.feeder.transpose import transpose_files, transpose_files_to_series, \
-    transpose_files_to_linear_series
-from thunder_streaming.feeder.utils.filenames import getFilenamePostfix, getFilenamePrefix
+import numpy as np
+
+from thunder_streaming.feeder.batching import EmissionPolicy
+from thunder_streaming.feeder.join import TimepointJoiner
+from thunder_streaming.feeder.manifest import build_manifest, write_manifest
+from thunder_streaming.feeder.transpose import transpose_matches_to_series_arrays
 from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import global_metrics
+from thunder_streaming.feeder.utils.regex import FilenameParser
+from thunder_streaming.feeder.utils.transfer import transfer_file
 
 
 class Feeder(object):
     """Superclass for objects that take in a set of filenames and push the corresponding files out
     to a consumer.
+
+    If a BacklogMonitor is set as backlog_monitor, implementations should record each file they publish with it,
+    so that the runloop can hold back new data while the consumer is behind.
     """
+    backlog_monitor = None
+
     def feed(self, filenames):
         """Abstract method that when called, pushes the passed files out to a consumer.
 
@@ -28,6 +40,22 @@ class Feeder(object):
         """
         raise NotImplementedError
 
+    def nheld(self):
+        """Returns the number of matched timepoints passed to feed() that have not yet been pushed out, being held
+        until the feeder's emission policy writes them out.
+
+        This implementation holds nothing back.
+        """
+        return 0
+
+    def held_matches(self):
+        """Returns the matched timepoints counted by nheld(), as a list of (timepoint, {qname: filename}) pairs
+        sorted by timepoint.
+
+        This implementation holds nothing back.
+        """
+        return []
+
     def clean(self):
         """Performs any required cleanup, such as deleting copied files.
 
@@ -42,14 +70,54 @@ class Feeder(object):
         return []
 
 
+class _BackgroundDeleter(Thread):
+    """Daemon thread that removes files passed to delete(), so that callers never block on unlink calls.
+
+    Names of files that have been removed are accumulated until collected by a call to drain_removed().
+    """
+    def __init__(self):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._pending = Queue()
+        self._removed = deque()
+
+    def delete(self, absnames):
+        self._pending.put(list(absnames))
+
+    def drain_removed(self):
+        removed = []
+        while self._removed:
+            removed.append(self._removed.popleft())
+        return removed
+
+    def run(self):
+        while True:
+            for absname in self._pending.get():
+                try:
+                    os.remove(absname)
+                    self._removed.append(absname)
+                except OSError, e:
+                    # may already have been removed by someone else, which is fine
+                    if e.errno != errno.ENOENT:
+                        global_logger.get().warn("Could not remove '%s': %s", absname, e)
+
+
 class LastModifiedCleaner(Feeder):
     """Abstract subclass of Feeder that provides a "delete after delay" clean() method.
+
+    Subclasses should call _record_published() for each file that they write into the feeder directory. These files
+    are kept in a heap ordered by expiry time, so that clean() need only look at files that have expired. In addition,
+    the whole feeder directory is scanned every reconcile_time seconds (and on the first call to clean()), to pick up
+    files that were not recorded, for instance those left over from a previous run.
+
+    Files are deleted on a background thread.
     """
-    def __init__(self, feeder_dir, linger_time):
+    def __init__(self, feeder_dir, linger_time, reconcile_time=60.0):
         """
         Specifies a directory and a delay time after which files found in the directory are to be deleted.
 
-        The delay time is measured from the file's last modification time.
+        The delay time is measured from the time the file was published, or for files found by a directory scan,
+        from the file's last modification time.
 
         Parameters
         ----------
@@ -57,26 +125,85 @@ class LastModifiedCleaner(Feeder):
             Path to directory from which files are to be deleted.
         linger_time: float
             Time in seconds.
+        reconcile_time: float
+            Time in seconds between full scans of feeder_dir.
         :return:
         """
         self.feeder_dir = str(feeder_dir)
         self.linger_time = float(linger_time)
+        self.reconcile_time = float(reconcile_time)
 
         if not os.path.isdir(feeder_dir):
             raise ValueError("Feeder directory must be an existing directory path; got '%s'" % self.feeder_dir)
 
+        # heap of (expiry time, absolute filename):
+        self._expiry_heap = []
+        # latest expiry time for each file in the heap, to detect stale heap entries for republished files:
+        self._expiries = {}
+        self._next_reconcile_time = 0.0
+        self._deleter = None
+        self._npublished = global_metrics.counter("feeder_files_published_total",
+                                                  "Files published into the feeder directory")
+
+    def _record_published(self, absname, sidecar=False):
+        """Records that the passed file has just been written into the feeder directory, to be deleted after
+        self.linger_time has passed, and to be tracked by self.backlog_monitor if set.
+
+        Sidecar files, such as manifests, are only scheduled for deletion.
+        """
+        now = time.time()
+        if not sidecar:
+            self._npublished.inc()
+            if self.backlog_monitor is not None:
+                self.backlog_monitor.record(absname, now)
+        if self.linger_time < 0:
+            return
+        expiry = now + self.linger_time
+        self._expiries[absname] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, absname))
+
+    def _pop_expired(self, now):
+        expired = []
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expiry, absname = heapq.heappop(heap)
+            if self._expiries.get(absname) == expiry:
+                del self._expiries[absname]
+                expired.append(absname)
+        return expired
+
+    def _reconcile(self, now):
+        """Scans the feeder directory for unrecorded files whose last modified time is longer ago than
+        self.linger_time.
+        """
+        expired = []
+        for fname in os.listdir(self.feeder_dir):
+            absname = os.path.join(self.feeder_dir, fname)
+            if absname not in self._expiries and os.path.isfile(absname) and \
+                    now - os.stat(absname).st_mtime > self.linger_time:
+                expired.append(absname)
+        return expired
+
     def clean(self):
-        """Deletes files found in self.feeder_dir whose last modified time is longer ago than self.linger_time.
+        """Deletes files in self.feeder_dir that were published, or last modified, longer ago than self.linger_time.
+
+        Files are removed asynchronously; the returned names are those of files removed since the last call.
         """
         if self.linger_time < 0:
             return []
+        if self._deleter is None:
+            self._deleter = _BackgroundDeleter()
+            self._deleter.start()
+
         now = time.time()
-        removed = []
-        for fname in os.listdir(self.feeder_dir):
-            absname = os.path.join(self.feeder_dir, fname)
-            if os.path.isfile(absname) and now - os.stat(absname).st_mtime > self.linger_time:
-                os.remove(absname)
-                removed.append(fname)
+        expired = self._pop_expired(now)
+        if now >= self._next_reconcile_time:
+            expired.extend(self._reconcile(now))
+            self._next_reconcile_time = now + self.reconcile_time
+        if expired:
+            self._deleter.delete(expired)
+
+        removed = [os.path.basename(absname) for absname in self._deleter.drain_removed()]
         removed.sort()
         return removed
 
@@ -84,241 +211,247 @@ class LastModifiedCleaner(Feeder):
 class CopyAndMoveFeeder(LastModifiedCleaner):
     """Concrete feeder implementation that copies files into the specified output directory.
 
-    This first copies files into a temporary directory, which should be on the same filesystem
-    as the ultimate output directory. (This can be controlled by the TMP environment var - see documentation
-    in the python tempfile module.) After this copy, the files are moved into the final output directory
-    by an os.rename() call, which advertises that it will be an atomic operation for files on the same filesystem.
-    This rename() call may throw an exception if the temp directory is on a different filesystem.
+    Files are first placed into a hidden staging directory inside the output directory, and then moved into
+    the output directory itself by an os.rename() call, which is atomic since both are on the same filesystem.
+    Spark, like most consumers, ignores hidden entries, so files are only seen once they are complete.
+
+    Files are placed into the staging directory with the cheapest available method that makes a new file: a
+    reflink if the input file is on the same copy-on-write filesystem as the output directory, or an in-kernel copy
+    otherwise. See transfer_file(). Copies are touched before being published, so that their modification time is
+    the time they were published.
+
+    If link_files is set, input files on the same filesystem as the output directory are hard linked instead, which
+    copies nothing on any filesystem. A hard link shares its modification time with the input file, which must not
+    be touched, so Spark's fileStream() ignores linked files that were written longer ago than it remembers (for
+    instance a backlog picked up late), and AccessTimeTracker cannot tell whether they have been consumed. Only use
+    it when input files are fed as soon as they are written.
     """
+    STAGING_DIR_PREFIX = ".feeder-staging-"
+
+    def __init__(self, feeder_dir, linger_time, link_files=False):
+        super(CopyAndMoveFeeder, self).__init__(feeder_dir, linger_time)
+        self.link_files = link_files
+        # one staging directory per feeder, so that several feeders can share an output directory
+        self.staging_dir = tempfile.mkdtemp(prefix=self.STAGING_DIR_PREFIX, dir=self.feeder_dir)
+        atexit.register(shutil.rmtree, self.staging_dir, True)
+        self._transfer_method = None
+        self._write_timer = global_metrics.stage_timer("write")
+        self._rename_timer = global_metrics.stage_timer("rename")
+        self._nbytes_written = global_metrics.counter("feeder_bytes_written_total",
+                                                      "Bytes written into the feeder directory")
+
     @classmethod
     def fromOptions(cls, opts):
-        return cls(opts.outdir, opts.linger_time)
+        return cls(opts.outdir, opts.linger_time, link_files=opts.link_files)
+
+    def _log_transfer_method(self, method):
+        if method != self._transfer_method:
+            global_logger.get().info("Publishing files to '%s' by %s", self.feeder_dir, method)
+            self._transfer_method = method
 
     def feed(self, filenames):
-        copydir = tempfile.mkdtemp()
+        if not filenames:
+            return filenames
+        stagednames, linked = [], set()
         try:
-            basenames = []
+            start = time.time()
             for fname in filenames:
-                bname = os.path.basename(fname)
-                shutil.copyfile(fname, os.path.join(copydir, bname))
-                basenames.append(bname)
-            for fname in basenames:
-                srcname = os.path.join(copydir, fname)
-                # touch prior to atomic move operation to delay slurping by spark
-                os.utime(srcname, None)
-                os.rename(srcname, os.path.join(self.feeder_dir, fname))
+                stagedname = os.path.join(self.staging_dir, os.path.basename(fname))
+                method = transfer_file(fname, stagedname, clone=True, link=self.link_files)
+                self._log_transfer_method(method)
+                stagednames.append(stagedname)
+                if method == "link":
+                    linked.add(stagedname)
+                self._nbytes_written.inc(os.lstat(stagedname).st_size)
+            rename_start = time.time()
+            self._write_timer.observe(rename_start - start)
+            for stagedname in stagednames:
+                # touch prior to atomic move operation to delay slurping by spark; a hard link shares its
+                # modification time with the input file, which must not be changed
+                if stagedname not in linked:
+                    os.utime(stagedname, None)
+                publishedname = os.path.join(self.feeder_dir, os.path.basename(stagedname))
+                os.rename(stagedname, publishedname)
+                self._record_published(publishedname)
+            self._rename_timer.observe(time.time() - rename_start)
         finally:
-            shutil.rmtree(copydir)
+            for stagedname in stagednames:
+                if os.path.lexists(stagedname):
+                    os.remove(stagedname)
         return filenames
 
 
-def unique_justseen(iterable, key=None):
-    """List unique elements, preserving order. Remember only the element just seen.
-    Taken from python itertools recipes.
-    """
-    # unique_justseen('AAAABBBCCDAABBB') --> A B C D A B
-    # unique_justseen('ABBCcAD', str.lower) --> A B C A D
-    return imap(next, imap(itemgetter(1), groupby(iterable, key)))
-
-
-def pairwise(iterable):
-    # this and is_sorted from stackoverflow user hughdbrown:
-    # http://stackoverflow.com/questions/3755136/pythonic-way-to-check-if-a-list-is-sorted-or-not/4404056#4404056
-    a, b = tee(iterable)
-    next(b, None)
-    return izip(a, b)
-
+class TimepointMatcher(object):
+    """Mixin for feeders that wait for files from several queues to be matched by timepoint.
 
-def is_sorted(iterable, key=lambda a, b: a < b):
-    # tests for strict ordering, will be false for dups
-    return all(key(a, b) for a, b in pairwise(iterable))
-
-
-class SyncCopyAndMoveFeeder(CopyAndMoveFeeder):
-    """This feeder will wait for matching pairs of files, as described in the module docstring,
-    before copying the pair into the passed output directory. Its behavior is otherwise the
-    same as CopyAndMoveFeeder.
+    Filenames are added to a join table indexed by timepoint (see TimepointJoiner), and a timepoint is
+    matched as soon as files for it have arrived on all queues, whatever order they arrive in. Files that
+    are not matched within mismatch_wait_time seconds are discarded with a warning. Different wait times for
+    particular queues can be given in the qname_to_wait_time dict.
 
-    Filenames that are not immediately matched on a first call to feed() are stored in internal queues,
-    to be checked on the next feed() call. The internal queues are sorted alphabetically by file name, and
-    at each feed() call only the head of the queue is checked for a possible match. This can lead to
-    waiting forever for a match for one particular file, as described in the module docstring.
+    Queue names and timepoints are extracted from filenames by the passed FilenameParser. By default, these are
+    the filename prefix and postfix around the first '_' character.
     """
-    def __init__(self, feeder_dir, linger_time, qnames,
-                 fname_to_qname_fcn=getFilenamePrefix,
-                 fname_to_timepoint_fcn=getFilenamePostfix,
+    def __init__(self, qnames,
+                 filename_parser=None,
                  check_file_size_mismatch=False,
-                 check_skip_in_sequence=True):
-        super(SyncCopyAndMoveFeeder, self).__init__(feeder_dir=feeder_dir, linger_time=linger_time)
-        self.qname_to_queue = {}
-        for qname in qnames:
-            self.qname_to_queue[qname] = deque()
-        self.keys_to_fullnames = {}
-        self.fname_to_qname_fcn = fname_to_qname_fcn
-        self.fname_to_timepoint_fcn = fname_to_timepoint_fcn
+                 check_skip_in_sequence=True,
+                 mismatch_wait_time=5.0,
+                 qname_to_wait_time=None):
+        self.joiner = TimepointJoiner(qnames, wait_time=mismatch_wait_time, qname_to_wait_time=qname_to_wait_time)
+        self.filename_parser = filename_parser if filename_parser is not None else FilenameParser()
         self.qname_to_expected_size = {} if check_file_size_mismatch else None
         self.do_check_sequence = check_skip_in_sequence
         self.last_timepoint = None
-        self.last_mismatch = None
-        self.last_mismatch_time = None
-        # time in s to wait after detecting a mismatch before popping mismatching elements:
-        self.mismatch_wait_time = 5.0
-
-    def check_and_pop_mismatches(self, first_elts):
-        """Checks for a mismatched first elements across queues.
-
-        If the first mismatched element has remained the same for longer than
-        self.mismatch_wait_time, then start popping out mismatching elements.
-
-        Updates self.last_mismatch and self.last_mismatch_time
+        # time in s to wait for matching files before discarding a timepoint:
+        self.mismatch_wait_time = mismatch_wait_time
+        self._match_timer = global_metrics.stage_timer("match")
+        self._nunparsed = global_metrics.counter("feeder_files_skipped_total",
+                                                 "Input files skipped for want of a queue name or timepoint")
+        self._nsize_mismatched = global_metrics.counter("feeder_timepoints_discarded_total",
+                                                        "Timepoints discarded before being written out",
+                                                        reason="size_mismatch")
+        self._nmissing = global_metrics.counter("feeder_timepoints_missing_total",
+                                                "Timepoints missing from the sequence of matched timepoints")
+        joiner = self.joiner
+        global_metrics.counter_callback("feeder_timepoints_discarded_total", lambda: joiner.ndiscarded,
+                                        "Timepoints discarded before being written out", reason="unmatched")
+        global_metrics.gauge_callback("feeder_unmatched_timepoints", joiner.npending,
+                                      "Timepoints waiting for files from some of their queues")
+
+    def filter_size_mismatch_files(self, matches):
+        """Filters out timepoints with files that are a different size from the first file seen on the same queue.
+
+        Takes and returns a list of (timepoint, {qname: filename}) pairs, as returned by TimepointJoiner.
         """
-        comp_elt = first_elts[0]
-        # the below list comprehension Does The Right Thing for first_elts of length 1
-        # and returns [], and all([]) is True.
-        if comp_elt is not None and all([elt == comp_elt for elt in first_elts[1:]]):
-            matched = comp_elt
-            self.last_mismatch = None
-            self.last_mismatch_time = None
-        else:
-            matched = None
-            # this returns None if there are any Nones in the list:
-            cur_mismatch = reduce(min, first_elts)
-            if cur_mismatch is None:
-                # if there is at least one None, then there is some empty queue
-                # we don't consider it a mismatch unless there are first elements in each queue, and
-                # they don't match - so if a queue is empty, we don't have a mismatch
-                self.last_mismatch = None
-                self.last_mismatch_time = None
-            else:
-                now = time.time()
-                if self.last_mismatch:  # we already had a mismatch last time through, presumably on the same elt
-                    if self.last_mismatch != cur_mismatch:
-                        # blow up
-                        raise Exception("Current mismatch '%s' doesn't match last mismatch '%s' " %
-                                        (cur_mismatch, self.last_mismatch) + "- this shouldn't happen")
-                    if now - self.last_mismatch_time > self.mismatch_wait_time:
-                        # we have been stuck on this element for longer than mismatch_wait_time
-                        # find the next-lowest element - this is not None, since the other queues are not empty
-                        next_elts = first_elts[:]  # copy
-                        next_elts.remove(cur_mismatch)
-                        next_elt = reduce(min, next_elts)
-                        # cycle through *all* queues, removing any elts less than next_elt
-                        popping = True
-                        while popping:
-                            popping = False
-                            for qname, q in self.qname_to_queue.iteritems():
-                                if q and q[0] < next_elt:
-                                    discard = q.popleft()
-                                    popping = True
-                                    global_logger.get().warn("Discarding item '%s' from queue '%s'; " % (discard, qname) +
-                                                       "waited for match for more than %g s" % self.mismatch_wait_time)
-                        # finished popping all mismatching elements less than next_elt
-                        # we might have a match at this point, but wait for next iteration to pick up
-                        self.last_mismatch = None
-                        self.last_mismatch_time = None
-                else:
-                    self.last_mismatch = cur_mismatch
-                    self.last_mismatch_time = now
-        return matched
-
-    def get_matching_first_entry(self):
-        """Pops and returns the first entry across all queues if the first entry
-        is the same on all queues, otherwise return None and leave queues unchanged
-        """
-        first_elts = []
-        for q in self.qname_to_queue.itervalues():
-            first_elts.append(q[0] if q else None)
-
-        matched = self.check_and_pop_mismatches(first_elts)
-
-        if matched is not None:
-            for queue in self.qname_to_queue.itervalues():
-                queue.popleft()
-        return matched
-
-    def filter_size_mismatch_files(self, filenames):
-        filtered_timepoints = []
-        for filename in filenames:
-            size = os.path.getsize(filename)
-            bname = os.path.basename(filename)
-            queuename = self.fname_to_qname_fcn(bname)
-            timepoint = self.fname_to_timepoint_fcn(bname)
-            expected_size = self.qname_to_expected_size.setdefault(queuename, size)
-            if size != expected_size:
-                filtered_timepoints.append(timepoint)
-                global_logger.get().warn(
-                    "Size mismatch on '%s', discarding timepoint '%s'. (Expected %d bytes, got %d bytes.)",
-                    filename, timepoint, expected_size, size)
-        if filtered_timepoints:
-            return [filename for filename in filenames if
-                    self.fname_to_timepoint_fcn(os.path.basename(filename)) not in filtered_timepoints]
-        else:
-            return filenames
-
-    def check_sequence(self, timepoint_string):
+        filtered = []
+        for timepoint, qname_to_filename in matches:
+            mismatched = False
+            for queuename, filename in qname_to_filename.iteritems():
+                size = os.path.getsize(filename)
+                expected_size = self.qname_to_expected_size.setdefault(queuename, size)
+                if size != expected_size:
+                    mismatched = True
+                    self._nsize_mismatched.inc()
+                    global_logger.get().warn(
+                        "Size mismatch on '%s', discarding timepoint '%s'. (Expected %d bytes, got %d bytes.)",
+                        filename, timepoint, expected_size, size)
+            if not mismatched:
+                filtered.append((timepoint, qname_to_filename))
+        return filtered
+
+    def check_sequence(self, timepoint):
         if self.last_timepoint is None:
-            self.last_timepoint = int(timepoint_string)
+            self.last_timepoint = int(timepoint)
             return
-        cur_timepoint = int(timepoint_string)
+        cur_timepoint = int(timepoint)
         if cur_timepoint != self.last_timepoint + 1:
+            if cur_timepoint > self.last_timepoint:
+                self._nmissing.inc(cur_timepoint - self.last_timepoint - 1)
             global_logger.get().warn("Missing timepoints detected, went from '%d' to '%d'",
                                self.last_timepoint, cur_timepoint)
         self.last_timepoint = cur_timepoint
 
-    def match_filenames(self, filenames):
-        """Update internal queues with passed filenames. Returns names that match across the head of all queues if
-        any are found, or an empty list otherwise.
+    def match_timepoints(self, filenames):
+        """Update internal join table with passed filenames. Returns a list of (timepoint, {qname: filename})
+        pairs, sorted by timepoint, for all timepoints that have been matched across all queues.
         """
-        # insert
-        # we assume that usually we'll just be appending to the end - other options
-        # include heapq and bisect, but it probably doesn't really matter
+        now = time.time()
         for filename in filenames:
-            qname = self.fname_to_qname_fcn(filename)
+            parsed = self.filename_parser.parse(filename)
+            qname = parsed.queue
             if qname is None:
                 global_logger.get().warn("Could not get queue name for file '%s', skipping" % filename)
+                self._nunparsed.inc()
+                continue
+            if qname not in self.joiner.qname_to_wait_time:
+                global_logger.get().warn("Unexpected queue name '%s' for file '%s', skipping" % (qname, filename))
+                self._nunparsed.inc()
                 continue
-            tpname = self.fname_to_timepoint_fcn(filename)
+            tpname = parsed.timepoint
             if tpname is None:
                 global_logger.get().warn("Could not get timepoint for file '%s', skipping" % filename)
+                self._nunparsed.inc()
                 continue
-            self.qname_to_queue[qname].append(tpname)
-            self.keys_to_fullnames[(qname, tpname)] = filename
-
-        # maintain sorting and dedup:
-        for qname, queue in self.qname_to_queue.iteritems():
-            if not is_sorted(queue):
-                self.qname_to_queue[qname] = deque(unique_justseen(sorted(list(queue))))
-
-        # all queues are now sorted and unique-ified
-
-        # check for matching first entries across queues
-        matching = self.get_matching_first_entry()
-        matches = []
-        dcs = self.do_check_sequence
-        while matching:
-            if dcs:
-                self.check_sequence(matching)
-            matches.append(matching)
-            matching = self.get_matching_first_entry()
-
-        # convert matches back to full filenames
-        fullnamekeys = list(iproduct(self.qname_to_queue.iterkeys(), matches))
-        fullnames = [self.keys_to_fullnames.pop(key) for key in fullnamekeys]
-        fullnames.sort()
+            self.joiner.add(qname, tpname, filename, now)
+        self.joiner.expire(now)
+
+        matches = self.joiner.pop_complete()
+        if self.do_check_sequence:
+            for timepoint, _ in matches:
+                self.check_sequence(timepoint)
 
         # filter out files that are smaller than the first file to be added to the queue, if requested
         # this attempts to check for and work around an error state where some files are incompletely
         # transferred
         if self.qname_to_expected_size is not None:
-            fullnames = self.filter_size_mismatch_files(fullnames)
+            matches = self.filter_size_mismatch_files(matches)
+        if filenames or matches:
+            self._match_timer.observe(time.time() - now)
+        return matches
 
+    def match_filenames(self, filenames):
+        """Update internal join table with passed filenames. Returns names of files for all timepoints that
+        have been matched across all queues, or an empty list if there are none.
+        """
+        matches = self.match_timepoints(filenames)
+        fullnames = [filename for _, qname_to_filename in matches for filename in qname_to_filename.itervalues()]
+        fullnames.sort()
         return fullnames
 
+
+class SyncCopyAndMoveFeeder(TimepointMatcher, CopyAndMoveFeeder):
+    """This feeder will wait for matching pairs of files, as described in the module docstring,
+    before copying the pair into the passed output directory. Its behavior is otherwise the
+    same as CopyAndMoveFeeder.
+
+    A timepoint is copied out as soon as files for it have arrived on all queues; see TimepointMatcher.
+    """
+    def __init__(self, feeder_dir, linger_time, qnames,
+                 filename_parser=None,
+                 check_file_size_mismatch=False,
+                 check_skip_in_sequence=True,
+                 mismatch_wait_time=5.0,
+                 qname_to_wait_time=None,
+                 link_files=False):
+        CopyAndMoveFeeder.__init__(self, feeder_dir=feeder_dir, linger_time=linger_time, link_files=link_files)
+        TimepointMatcher.__init__(self, qnames,
+                                  filename_parser=filename_parser,
+                                  check_file_size_mismatch=check_file_size_mismatch,
+                                  check_skip_in_sequence=check_skip_in_sequence,
+                                  mismatch_wait_time=mismatch_wait_time,
+                                  qname_to_wait_time=qname_to_wait_time)
+
     def feed(self, filenames):
         fullnames = self.match_filenames(filenames)
         return super(SyncCopyAndMoveFeeder, self).feed(fullnames)
 
 
+class _TimedReader(object):
+    """Reader function for the functions in transpose.py, wrapping the passed reader function or np.fromfile(), that
+    keeps count of the time spent in and the number of bytes returned by it. The array read from the file named
+    'keep', if any, is kept as 'kept'.
+    """
+    def __init__(self, reader=None, keep=None):
+        self.reader = reader
+        self.keep = keep
+        self.kept = None
+        self.elapsed = 0.0
+        self.nbytes = 0
+
+    def __call__(self, filename, dtype):
+        start = time.time()
+        if self.reader is None:
+            ary = np.fromfile(filename, dtype=dtype)
+        else:
+            ary = self.reader(filename, dtype)
+        self.elapsed += time.time() - start
+        self.nbytes += ary.nbytes
+        if filename == self.keep:
+            self.kept = ary
+        return ary
+
+
 class SyncSeriesFeeder(SyncCopyAndMoveFeeder):
     """A Feeder implementation that looks for matching pairs of files, as in SyncCopyAndMoveFeeder, and
     them writes out these matching pairs as a single Series binary file.
@@ -330,13 +463,30 @@ class SyncSeriesFeeder(SyncCopyAndMoveFeeder):
 
     If a shape tuple is given at construction, then the output will have valid subscript indices according
     to this expected shape. See transpose_files() (no shape passed) and transpose_files_to_series() (with shape).
+
+    If a 'stages' dict is given at construction, it should map queue names (prefixes) to StagePipeline
+    instances. Data from these queues will be run through the corresponding pipeline before being written out.
+
+    Matched timepoints are held until the passed EmissionPolicy decides that they should be written out. By default,
+    they are written out immediately.
+
+    If a Prefetcher is passed, input files are read ahead in the background from the time they are passed to feed(),
+    and dropped from the page cache once written out.
+
+    If a PreviewTap is passed, it is offered the last frame from the first queue of each batch written out, as read
+    for transposing.
+
+    If a 'queue_specs' dict is given, it should map queue names to QueueSpecs describing how the input files of
+    those queues are to be decoded and keyed, overriding indtype. See queuespec.py.
+
+    If write_manifests is set, a manifest recording when each timepoint's files were last modified and fed is
+    written next to each series file, for latency tracing. See manifest.py.
     """
     def __init__(self, feeder_dir, linger_time, prefixes, shape=None, linear=False, dtype='uint16', indtype='uint16',
-                 fname_to_qname_fcn=getFilenamePrefix, fname_to_timepoint_fcn=getFilenamePostfix,
-                 check_file_size=False, check_skip_in_sequence=True):
+                 filename_parser=None, check_file_size=False, check_skip_in_sequence=True, stages=None,
+                 emission_policy=None, prefetcher=None, preview=None, queue_specs=None, write_manifests=False):
         super(SyncSeriesFeeder, self).__init__(feeder_dir, linger_time, prefixes,
-                                               fname_to_qname_fcn=fname_to_qname_fcn,
-                                               fname_to_timepoint_fcn=fname_to_timepoint_fcn,
+                                               filename_parser=filename_parser,
                                                check_file_size_mismatch=check_file_size,
                                                check_skip_in_sequence=check_skip_in_sequence)
         self.prefixes = list(prefixes)
@@ -344,52 +494,177 @@ class SyncSeriesFeeder(SyncCopyAndMoveFeeder):
         self.linear = linear
         self.dtype = dtype
         self.indtype = indtype
+        self.stages = dict(stages) if stages else {}
+        self.queue_specs = dict(queue_specs) if queue_specs else {}
+        for qname in self.queue_specs:
+            if qname not in self.prefixes:
+                global_logger.get().warn("Queue spec given for '%s', which is not one of the queues %s",
+                                         qname, self.prefixes)
+        self.emission_policy = emission_policy if emission_policy is not None else EmissionPolicy()
+        self.prefetcher = prefetcher
+        self.preview = preview
+        # added to output file names, to keep them distinct between feeders writing to the same directory:
+        self.output_tag = None
+        # list of (match time, (timepoint, {qname: filename})) for matched timepoints not yet written out:
+        self._held = []
+        self.write_manifests = write_manifests
+        # timepoint -> match time, for timepoints not yet in a manifest:
+        self._fed_times = {}
+        self._read_timer = global_metrics.stage_timer("read")
+        self._transpose_timer = global_metrics.stage_timer("transpose")
+        self._nbytes_read = global_metrics.counter("feeder_bytes_read_total", "Bytes of input files read")
+        self._nwritten = global_metrics.counter("feeder_timepoints_written_total", "Timepoints written out")
+        global_metrics.gauge_callback("feeder_held_timepoints", self.nheld,
+                                      "Matched timepoints held until the emission policy writes them out")
+        if prefetcher is not None:
+            global_metrics.counter_callback("feeder_prefetch_hits_total", lambda: prefetcher.nhits,
+                                            "Input files read from the prefetcher")
+            global_metrics.counter_callback("feeder_prefetch_misses_total", lambda: prefetcher.nmisses,
+                                            "Input files read directly, not having been prefetched")
 
     def get_series_filename(self, srcfilenames, bytesize):
-        startcount = self.fname_to_timepoint_fcn(os.path.basename(srcfilenames[0]))
-        endcount = self.fname_to_timepoint_fcn(os.path.basename(srcfilenames[-1]))
+        startcount = self.filename_parser.parse(srcfilenames[0]).timepoint_string
+        endcount = self.filename_parser.parse(srcfilenames[-1]).timepoint_string
+        if self.output_tag:
+            return "series-%s-%s-%s_bytes%d.bin" % (startcount, endcount, self.output_tag, bytesize)
         return "series-%s-%s_bytes%d.bin" % (startcount, endcount, bytesize)
 
+    def nheld(self):
+        return len(self._held)
+
+    def held_matches(self):
+        return [match for _, match in self._held]
+
+    def ready_matches(self, filenames):
+        """Matches the passed filenames by timepoint, and returns a list of batches of matches that the emission
+        policy has decided are ready to be written out. Each batch is a list of (timepoint, {qname: filename})
+        pairs sorted by timepoint.
+        """
+        now = time.time()
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(filenames)
+        matches = self.match_timepoints(filenames)
+        self.emission_policy.record_arrivals(len(matches), now)
+        self._held.extend((now, match) for match in matches)
+        if self.write_manifests:
+            for timepoint, _ in matches:
+                self._fed_times[timepoint] = now
+
+        batches = []
+        nheld = len(self._held)
+        while nheld:
+            nready = self.emission_policy.nready(nheld, self._held[0][0], now)
+            if not nready:
+                break
+            batches.append([match for _, match in self._held[:nready]])
+            del self._held[:nready]
+            nheld -= nready
+        return batches
+
     def feed(self, filenames):
-        fullnames = self.match_filenames(filenames)
+        fullnames = []
+        for matches in self.ready_matches(filenames):
+            start = time.time()
+            fullnames.extend(self.write_series(matches))
+            self._nwritten.inc(len(matches))
+            self.emission_policy.record_publish(len(matches), time.time() - start)
+        fullnames.sort()
+        return fullnames
+
+    def series_arrays(self, matches, reader=None):
+        """Transposes the passed matches, a list of (timepoint, {qname: filename}) pairs sorted by timepoint,
+        into Series records.
+
+        Files are read with the passed reader function if given (see transpose.py), or otherwise through the
+        feeder's Prefetcher if it has one.
+
+        Returns
+        -------
+        (list of arrays, to be written out in order; list of input filenames; output filename)
+        """
+        if reader is None and self.prefetcher is not None:
+            # no-op for files already being prefetched, otherwise reads the whole batch in parallel
+            self.prefetcher.prefetch([filename for _, qname_to_filename in matches
+                                      for filename in qname_to_filename.itervalues()])
+            reader = self.prefetcher.fromfile
+        start = time.time()
+        preview_timepoint, qname_to_filename = matches[-1]
+        preview_filename = qname_to_filename[self.prefixes[0]] if self.preview is not None else None
+        reader = _TimedReader(reader, keep=preview_filename)
+        arrays, fullnames, recordsize = transpose_matches_to_series_arrays(
+            matches, self.prefixes, shape=self.shape, linear=self.linear, dtype=self.dtype, indtype=self.indtype,
+            stages=self.stages, reader=reader, queue_specs=self.queue_specs)
+        if reader.kept is not None:
+            self.preview.offer(preview_timepoint, reader.kept, preview_filename)
+        self._read_timer.observe(reader.elapsed)
+        self._transpose_timer.observe(time.time() - start - reader.elapsed)
+        self._nbytes_read.inc(reader.nbytes)
+        for prefix, stages in self.stages.iteritems():
+            stages.maybe_report(prefix)
+        newname = self.get_series_filename([qname_to_filename[self.prefixes[0]]
+                                            for _, qname_to_filename in matches], recordsize)
+        return arrays, fullnames, newname
+
+    def pop_manifest(self, matches):
+        """Returns a manifest for the passed matches (see manifest.build_manifest()), if this feeder writes manifests,
+        or otherwise None.
+        """
+        if not self.write_manifests:
+            return None
+        fed_times = dict((timepoint, self._fed_times.pop(timepoint, None)) for timepoint, _ in matches)
+        return build_manifest(matches, fed_times)
+
+    def publish_series(self, arrays, newname, manifest=None):
+        """Writes the passed arrays out in order to a single file named newname in the feeder directory, along with
+        the passed manifest, if any.
 
-        if fullnames:
-            tmpfd, tmpfname = tempfile.mkstemp()
-            tmpfp = os.fdopen(tmpfd, 'w')
-            try:
-                nindices_written = 0
-                ninput_files = 0
-                for prefix in self.prefixes:
-                    curnames = [fn for fn in fullnames if self.fname_to_qname_fcn(fn) == prefix]
-                    curnames.sort()
-                    ninput_files = len(curnames)  # should be same for all prefixes
-                    if (not self.linear) and (self.shape is None):
-                        nindices_written += transpose_files(curnames, tmpfp, dtype=self.dtype)
-                    elif self.linear:
-                        nindices_written += transpose_files_to_linear_series(curnames, tmpfp,
-                                                                             dtype=self.dtype, indtype=self.indtype,
-                                                                             startlinidx=nindices_written)
-                    else:
-                        nindices_written += transpose_files_to_series(curnames, tmpfp, tuple(self.shape),
-                                                                      dtype=self.dtype, indtype=self.indtype,
-                                                                      startlinidx=nindices_written)
+        The manifest is written before the series file is moved into the feeder directory, so that it is there by the
+        time the series file can be seen; its publish time is taken just before the move.
+        """
+        start = time.time()
+        tmpfd, tmpfname = tempfile.mkstemp(dir=self.staging_dir)
+        tmpfp = os.fdopen(tmpfd, 'w')
+        manifestname = None
+        try:
+            for ary in arrays:
+                ary.tofile(tmpfp)
+            tmpfp.close()
+            if manifest is not None:
+                manifestname = write_manifest(self.feeder_dir, newname, manifest, time.time())
+            rename_start = time.time()
+            self._write_timer.observe(rename_start - start)
+            self._nbytes_written.inc(sum(ary.nbytes for ary in arrays))
+
+            # touch prior to atomic move operation to delay slurping by spark
+            os.utime(tmpfname, None)
+            publishedname = os.path.join(self.feeder_dir, newname)
+            os.rename(tmpfname, publishedname)
+            self._record_published(publishedname)
+            if manifestname is not None:
+                self._record_published(manifestname, sidecar=True)
+            self._rename_timer.observe(time.time() - rename_start)
+        except:
+            # a manifest must not be left without its series file
+            if manifestname is not None and os.path.isfile(manifestname):
+                os.remove(manifestname)
+            raise
+        finally:
+            if not tmpfp.closed:
                 tmpfp.close()
+            if os.path.isfile(tmpfname):
+                os.remove(tmpfname)
+
+    def write_series(self, matches):
+        """Writes the passed matches, a list of (timepoint, {qname: filename}) pairs sorted by timepoint, out
+        as a single Series binary file.
 
-                record_vals_size = ninput_files * np.dtype(self.dtype).itemsize
-                if self.linear:
-                    recordsize = np.dtype(self.dtype).itemsize + record_vals_size
-                elif self.shape:
-                    recordsize = len(self.shape)*2 + record_vals_size  # key size in bytes + values size in bytes
-                else:
-                    recordsize = record_vals_size
-                newname = self.get_series_filename(fullnames, recordsize)
-
-                # touch prior to atomic move operation to delay slurping by spark
-                os.utime(tmpfname, None)
-                os.rename(tmpfname, os.path.join(self.feeder_dir, newname))
-            finally:
-                if not tmpfp.closed:
-                    tmpfp.close()
-                if os.path.isfile(tmpfname):
-                    os.remove(tmpfname)
-        return fullnames
\ No newline at end of file
+        Returns the list of input filenames that were written out.
+        """
+        if not matches:
+            return []
+        manifest = self.pop_manifest(matches)
+        arrays, fullnames, newname = self.series_arrays(matches)
+        self.publish_series(arrays, newname, manifest)
+        if self.prefetcher is not None:
+            self.prefetcher.release(fullnames)
+        return fullnames
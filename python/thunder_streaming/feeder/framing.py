@@ -0,0 +1,50 @@
+"""Framing of batches of Series records for sending over sockets.
+
+Each batch is sent as a two-part message: a fixed-size header, followed by the records themselves as a raw buffer,
+exactly as they would be written to a Series binary file. The header is little-endian, 32 bytes:
+
+offset  size  field
+0       4     magic, "TSRB"
+4       2     version, currently 1
+6       2     number of key dimensions per record (0 for unkeyed records)
+8       4     record size in bytes, including keys
+12      4     number of records in the buffer
+16      8     send time, as a double in seconds since the epoch
+24      8     numpy dtype string of the record values (e.g. "<u2"), padded with NULs
+
+This is simple to parse from other languages, for instance in a Spark custom receiver.
+"""
+from collections import namedtuple
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b"TSRB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIId8s")
+
+SeriesBatchHeader = namedtuple("SeriesBatchHeader", ["version", "nkeys", "record_size", "nrecords", "send_time",
+                                                     "dtype"])
+
+
+def pack_header(record_size, nrecords, dtype, nkeys=0, send_time=None):
+    """Returns a header for a batch of nrecords Series records of record_size bytes each.
+    """
+    send_time = time.time() if send_time is None else send_time
+    return HEADER.pack(MAGIC, VERSION, nkeys, record_size, nrecords, send_time, np.dtype(dtype).str.encode("ascii"))
+
+
+def unpack_header(buf):
+    """Parses a header as written by pack_header(), returning a SeriesBatchHeader.
+
+    Raises ValueError if the buffer is not a valid header.
+    """
+    if len(buf) != HEADER.size:
+        raise ValueError("Expected a %d byte header, got %d bytes" % (HEADER.size, len(buf)))
+    magic, version, nkeys, record_size, nrecords, send_time, dtype = HEADER.unpack(buf)
+    if magic != MAGIC:
+        raise ValueError("Bad magic number %r in Series batch header" % magic)
+    if version != VERSION:
+        raise ValueError("Unsupported Series batch header version %d" % version)
+    return SeriesBatchHeader(version, nkeys, record_size, nrecords, send_time, np.dtype(dtype.rstrip(b"\0")))
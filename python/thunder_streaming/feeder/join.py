@@ -0,0 +1,106 @@
+"""Matching of files arriving on several queues (for instance imaging and behavioral data) by timepoint.
+"""
+from collections import deque, OrderedDict
+from operator import itemgetter
+import time
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+
+class TimepointJoiner(object):
+    """A join table indexed by timepoint, which tracks which queues have delivered a value for each timepoint.
+
+    A timepoint is complete as soon as every queue has delivered a value for it, regardless of the order in which
+    timepoints arrive. Values are typically filenames.
+
+    Each value added from a queue waits at most that queue's wait time for the other queues to deliver matching
+    values. Once that deadline passes, the incomplete timepoint is discarded with a warning. Since wait times are
+    fixed per queue, deadlines for each queue are stored in a queue of their own in arrival order, so that both
+    adding a value and expiring deadlines are O(1) per value.
+
+    Memory is bounded: at most max_pending incomplete timepoints are held, with the oldest discarded first
+    if this limit is exceeded, and only the last max_done completed or discarded timepoints are remembered in order
+    to detect late or duplicate arrivals.
+    """
+    def __init__(self, qnames, wait_time=5.0, qname_to_wait_time=None, max_pending=10000, max_done=10000):
+        self.qnames = list(qnames)
+        self.qname_to_wait_time = dict((qname, float(wait_time)) for qname in self.qnames)
+        if qname_to_wait_time:
+            self.qname_to_wait_time.update(qname_to_wait_time)
+        self.max_pending = max_pending
+        # timepoint -> {qname: value}, in order of first arrival:
+        self._pending = OrderedDict()
+        # qname -> deque of (deadline, timepoint), in order of arrival:
+        self._deadlines = dict((qname, deque()) for qname in self.qnames)
+        self._complete = []
+        self._done = deque(maxlen=max_done)
+        self._done_set = set()
+        self.ndiscarded = 0
+
+    def _mark_done(self, timepoint):
+        if len(self._done) == self._done.maxlen:
+            self._done_set.discard(self._done[0])
+        self._done.append(timepoint)
+        self._done_set.add(timepoint)
+
+    def _discard(self, timepoint, reason):
+        entry = self._pending.pop(timepoint)
+        self._mark_done(timepoint)
+        self.ndiscarded += 1
+        missing = [qname for qname in self.qnames if qname not in entry]
+        global_logger.get().warn("Discarding timepoint '%s' (missing from queue(s) %s); %s",
+                                 timepoint, ", ".join("'%s'" % qname for qname in missing), reason)
+        return timepoint, entry
+
+    def add(self, qname, timepoint, value, now=None):
+        """Adds a value for the passed queue and timepoint.
+
+        Returns True if this completes the timepoint, False otherwise.
+        """
+        if timepoint in self._done_set:
+            global_logger.get().warn("Ignoring late or duplicate item '%s' for timepoint '%s' from queue '%s'",
+                                     value, timepoint, qname)
+            return False
+        now = time.time() if now is None else now
+
+        entry = self._pending.get(timepoint)
+        if entry is None:
+            entry = self._pending[timepoint] = {}
+            if len(self._pending) > self.max_pending:
+                self._discard(next(iter(self._pending)), "more than %d timepoints pending" % self.max_pending)
+        entry[qname] = value
+
+        if len(entry) == len(self.qnames):
+            del self._pending[timepoint]
+            self._mark_done(timepoint)
+            self._complete.append((timepoint, entry))
+            return True
+        self._deadlines[qname].append((now + self.qname_to_wait_time[qname], timepoint))
+        return False
+
+    def expire(self, now=None):
+        """Discards incomplete timepoints for which some queue's deadline has passed.
+
+        Returns a list of discarded (timepoint, {qname: value}) pairs.
+        """
+        now = time.time() if now is None else now
+        discarded = []
+        for qname, deadlines in self._deadlines.iteritems():
+            while deadlines and deadlines[0][0] <= now:
+                timepoint = deadlines.popleft()[1]
+                # the timepoint may since have been completed or discarded
+                if timepoint in self._pending:
+                    discarded.append(self._discard(
+                        timepoint, "waited for match for more than %g s" % self.qname_to_wait_time[qname]))
+        return discarded
+
+    def pop_complete(self):
+        """Returns a list of (timepoint, {qname: value}) pairs for all timepoints completed since the last call,
+        sorted by timepoint.
+        """
+        complete, self._complete = self._complete, []
+        complete.sort(key=itemgetter(0))
+        return complete
+
+    def npending(self):
+        return len(self._pending)
@@ -0,0 +1,69 @@
+"""Manifest sidecar files, recording when each timepoint in a series file landed on disk and was fed, for tracing
+latency from the acquisition of a frame to the analysis of its data (see shell/latency.py).
+
+A manifest is written next to each series file, as a hidden file so that Spark ignores it, named after the series
+file: ".series-0001-0010_bytes20.bin.manifest.json". It holds a JSON object of the form:
+    {"series": "series-0001-0010_bytes20.bin", "published": 1420000012.3,
+     "timepoints": [{"timepoint": "0001", "mtime": 1420000010.1, "fed": 1420000011.2}, ...]}
+where, for each timepoint, mtime is the latest modification time of its input files, and fed is the time it was
+matched by the feeder. published is the time just before the series file was moved into the feeder directory; the
+manifest is written before that move, so that it exists whenever its series file does. All times are in seconds since
+the epoch.
+"""
+import json
+import os
+
+MANIFEST_PREFIX = "."
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_name(series_name):
+    """Returns the name of the manifest for the series file of the passed name.
+    """
+    return MANIFEST_PREFIX + series_name + MANIFEST_SUFFIX
+
+
+def is_manifest_name(name):
+    return name.startswith(MANIFEST_PREFIX) and name.endswith(MANIFEST_SUFFIX)
+
+
+def build_manifest(matches, fed_times):
+    """Returns a manifest, without series name or publish time, for the passed matches, a list of
+    (timepoint, {qname: filename}) pairs sorted by timepoint, given a dict of timepoint to the time it was fed.
+    """
+    timepoints = []
+    for timepoint, qname_to_filename in matches:
+        mtime = None
+        for filename in qname_to_filename.itervalues():
+            try:
+                mtime = max(mtime, os.stat(filename).st_mtime)
+            except OSError:
+                # input files may already have been removed
+                pass
+        timepoints.append({"timepoint": timepoint, "mtime": mtime, "fed": fed_times.get(timepoint)})
+    return {"timepoints": timepoints}
+
+
+def write_manifest(dirname, series_name, manifest, publish_time):
+    """Writes the passed manifest for the named series file into dirname, returning the manifest's path.
+
+    The manifest is written to a temporary name and then renamed, so that readers never see a partial file.
+    """
+    manifest = dict(manifest, series=series_name, published=publish_time)
+    path = os.path.join(dirname, manifest_name(series_name))
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as fp:
+        json.dump(manifest, fp, default=str)
+    os.rename(tmppath, path)
+    return path
+
+
+def read_manifest(path):
+    """Returns the manifest in the passed file, or None if it cannot be read (for instance if it has since been
+    cleaned up).
+    """
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
@@ -0,0 +1,396 @@
+"""Multi-process mode for the series feeders, splitting the work of a SyncSeriesFeeder into separate processes,
+so that it is not limited by a single interpreter lock.
+
+The stages are:
+* discovery: polls the input directories for new files.
+* match: matches files by timepoint, and decides when matched timepoints are to be written out.
+* transform: reads, runs pre-reduction stages on and transposes batches of matched files into Series records.
+  Any number of transform processes may be run, unless pre-reduction stages that keep state across batches (such
+  as detrend and dff) are used: each process has its own copy of the stages, so these need a single transform
+  process, which sees every batch in order.
+* publish: writes Series records out to the feeder directory, and cleans up old files.
+
+Stages are connected by bounded queues, so that a slow stage holds back the stages before it instead of
+accumulating an unbounded backlog. Series records are passed from the transform to the publish stage in a fixed
+pool of shared memory buffers, of which only the index is sent through the queue, rather than being pickled.
+
+Every stage periodically logs its utilization: the fraction of time it spends working, and the fraction of time it
+spends blocked waiting for a later stage. The limiting stage is the one that is busy nearly all the time; if this
+is the transform stage, more transform processes should be added.
+
+If metrics are requested (see utils/metrics.py), each stage process exports its own, labelled with the process
+name, on successive ports starting from --metrics-port, in the order discovery, match, transform processes, publish.
+
+On SIGINT or SIGTERM, discovery stops, and the stages exit in turn once they have processed all data in flight.
+"""
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from Queue import Empty
+import signal
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.eventloop import run_loop
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import global_metrics, start_metrics
+from thunder_streaming.feeder.utils.profiling import global_profiler, start_profiling
+
+# passed down the pipeline to tell each stage to exit:
+_STOP = None
+
+
+class StageStats(object):
+    """Accumulates the time that a pipeline stage spends working and blocked, and periodically logs its utilization.
+    """
+    def __init__(self, name, report_interval=30.0):
+        self.name = name
+        self.report_interval = float(report_interval)
+        self._start = self._last_report = time.time()
+        self.busy_time = self.blocked_time = 0.0
+        self.nitems = 0
+        self._busy_total = global_metrics.counter("feeder_pipeline_busy_seconds_total",
+                                                  "Time each pipeline stage has spent working", stage=name)
+        self._blocked_total = global_metrics.counter("feeder_pipeline_blocked_seconds_total",
+                                                     "Time each pipeline stage has spent blocked on later stages",
+                                                     stage=name)
+        self._items_total = global_metrics.counter("feeder_pipeline_items_total",
+                                                   "Items processed by each pipeline stage", stage=name)
+
+    def busy(self, elapsed, nitems=1):
+        self.busy_time += elapsed
+        self.nitems += nitems
+        self._busy_total.inc(elapsed)
+        self._items_total.inc(nitems)
+
+    def blocked(self, elapsed):
+        self.blocked_time += elapsed
+        self._blocked_total.inc(elapsed)
+
+    def maybe_report(self):
+        if self.report_interval > 0 and time.time() - self._last_report >= self.report_interval:
+            self.report()
+
+    def report(self):
+        """Logs utilization since the last report, and resets the counts.
+        """
+        now = time.time()
+        wall = max(now - self._start, 1e-9)
+        global_logger.get().info("Stage '%s': %.0f%% busy, %.0f%% blocked on later stages, %d items (%.1f/s)",
+                                 self.name, 100.0 * self.busy_time / wall, 100.0 * self.blocked_time / wall,
+                                 self.nitems, self.nitems / wall)
+        self._start = self._last_report = now
+        self.busy_time = self.blocked_time = 0.0
+        self.nitems = 0
+
+    def put(self, queue, item):
+        """Puts item on the passed queue, counting any time spent waiting for space as blocked time.
+        """
+        start = time.time()
+        queue.put(item)
+        self.blocked(time.time() - start)
+
+
+class SlotPool(object):
+    """A fixed number of equally-sized shared memory buffers ("slots"), which are passed between processes by index.
+
+    The pool must be created before the processes that use it are started.
+    """
+    def __init__(self, nslots, slot_bytes):
+        self.slot_bytes = int(slot_bytes)
+        self.slots = [RawArray(ctypes.c_char, self.slot_bytes) for _ in xrange(nslots)]
+        self._free = multiprocessing.Queue()
+        for slotidx in xrange(nslots):
+            self._free.put(slotidx)
+
+    def acquire(self):
+        """Returns the index of a free slot, blocking until one is available.
+        """
+        return self._free.get()
+
+    def release(self, slotidx):
+        self._free.put(slotidx)
+
+    def view(self, slotidx, nbytes):
+        """Returns a uint8 array sharing memory with the first nbytes of the passed slot.
+        """
+        return np.frombuffer(self.slots[slotidx], dtype=np.uint8, count=nbytes)
+
+
+def _ignore_interrupts():
+    # the parent process coordinates shutdown; children drain their queues rather than dying mid-write
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _queue_depth(queue, name):
+    global_metrics.gauge_callback("feeder_pipeline_queue_depth", queue.qsize,
+                                  "Items waiting in each queue between pipeline stages", queue=name)
+
+
+def _discovery_stage(file_checkers, poll_time, outq, stop_event, report_interval):
+    _ignore_interrupts()
+    stats = StageStats("discovery", report_interval)
+    _queue_depth(outq, "files")
+    last_time = time.time()
+    while not stop_event.is_set():
+        for file_checker in file_checkers:
+            start = time.time()
+            filebatch = global_profiler.call("discover", next, file_checker)
+            stats.busy(time.time() - start, len(filebatch))
+            if filebatch:
+                stats.put(outq, filebatch)
+        stats.maybe_report()
+        next_time = last_time + poll_time
+        stop_event.wait(max(0.0, next_time - time.time()))
+        last_time = next_time
+    stats.report()
+    outq.put(_STOP)
+
+
+def _match_stage(feeder, poll_time, inq, outq, feedbackq, ntransform, report_interval):
+    _ignore_interrupts()
+    stats = StageStats("match", report_interval)
+    _queue_depth(outq, "matches")
+    policy = feeder.emission_policy
+    # files are prefetched by the transform processes that read them
+    feeder.prefetcher = None
+    while True:
+        timeout = poll_time
+        check_time = policy.next_check_time(feeder.nheld(), time.time())
+        if check_time is not None:
+            timeout = min(timeout, max(0.001, check_time - time.time()))
+        try:
+            filebatch = inq.get(timeout=timeout)
+        except Empty:
+            # still check whether held timepoints are due to be written out
+            filebatch = []
+        if filebatch is _STOP:
+            break
+        start = time.time()
+        while True:
+            try:
+                policy.record_publish(*feedbackq.get_nowait())
+            except Empty:
+                break
+        batches = global_profiler.call("match", feeder.ready_matches, filebatch)
+        stats.busy(time.time() - start, len(filebatch))
+        for matches in batches:
+            # manifests record match times, which are only known to this stage
+            stats.put(outq, (matches, feeder.pop_manifest(matches)))
+        stats.maybe_report()
+
+    # write out anything still held
+    remaining = feeder.held_matches()
+    if remaining:
+        outq.put((remaining, feeder.pop_manifest(remaining)))
+    stats.report()
+    for _ in xrange(ntransform):
+        outq.put(_STOP)
+
+
+def _transform_stage(name, feeder, pool, inq, outq, report_interval):
+    _ignore_interrupts()
+    stats = StageStats(name, report_interval)
+    _queue_depth(outq, "records")
+    while True:
+        item = inq.get()
+        if item is _STOP:
+            break
+        matches, manifest = item
+        start = time.time()
+        arrays, fullnames, newname = global_profiler.call("transform", feeder.series_arrays, matches)
+        nbytes = sum(ary.nbytes for ary in arrays)
+        if nbytes <= pool.slot_bytes:
+            acquire_start = time.time()
+            slotidx = pool.acquire()
+            stats.blocked(time.time() - acquire_start)
+            buf = pool.view(slotidx, nbytes)
+            offset = 0
+            for ary in arrays:
+                buf[offset:offset+ary.nbytes] = ary.reshape(-1).view(np.uint8)
+                offset += ary.nbytes
+            arrays = None
+        else:
+            global_logger.warnIfNotAlreadyGiven(
+                "Series output is larger than shared memory slots of %d bytes; passing to the publish stage " +
+                "by copy instead. Consider increasing --slot-mb.", pool.slot_bytes)
+            slotidx = None
+        elapsed = time.time() - start
+        stats.busy(elapsed, len(matches))
+        if feeder.prefetcher is not None:
+            feeder.prefetcher.release(fullnames)
+        stats.put(outq, (newname, len(fullnames), len(matches), elapsed, slotidx, nbytes, arrays, manifest))
+        stats.maybe_report()
+    stats.report()
+    outq.put(_STOP)
+
+
+def _publish_stage(feeder, pool, inq, feedbackq, ntransform, poll_time, report_interval):
+    _ignore_interrupts()
+    stats = StageStats("publish", report_interval)
+    clean_timer = global_metrics.stage_timer("clean")
+    monitor = feeder.backlog_monitor
+    throttled = False
+    nstopped = 0
+    while nstopped < ntransform:
+        if monitor is not None:
+            # hold back the whole pipeline while the consumer is behind
+            was_throttled, throttled = throttled, monitor.exceeded()
+            if throttled:
+                if not was_throttled:
+                    global_logger.get().warn("Consumer backlog of %d files reached, holding back new files",
+                                             monitor.max_backlog)
+                feeder.clean()
+                time.sleep(poll_time)
+                continue
+
+        try:
+            item = inq.get(timeout=poll_time)
+        except Empty:
+            pass
+        else:
+            if item is _STOP:
+                nstopped += 1
+            else:
+                newname, nfiles, nmatches, transform_time, slotidx, nbytes, arrays, manifest = item
+                start = time.time()
+                if slotidx is not None:
+                    try:
+                        global_profiler.call("publish", feeder.publish_series, [pool.view(slotidx, nbytes)], newname,
+                                             manifest)
+                    finally:
+                        pool.release(slotidx)
+                else:
+                    global_profiler.call("publish", feeder.publish_series, arrays, newname, manifest)
+                elapsed = time.time() - start
+                stats.busy(elapsed, nmatches)
+                feeder._nwritten.inc(nmatches)
+                feedbackq.put((nmatches, transform_time + elapsed))
+                global_logger.get().info("Pushed %d files as %s", nfiles, newname)
+
+        start = time.time()
+        removedfiles = feeder.clean()
+        if removedfiles:
+            clean_timer.observe(time.time() - start)
+            global_logger.get().info("Removed %d temp files, last: %s", len(removedfiles), removedfiles[-1])
+        stats.busy(time.time() - start, 0)
+        stats.maybe_report()
+    stats.report()
+
+
+def _stage_main(stage, metrics_opts, name, port_offset, args):
+    if metrics_opts is not None:
+        start_metrics(metrics_opts, process_name=name, port_offset=port_offset)
+        start_profiling(metrics_opts, process_name=name)
+    stage(*args)
+
+
+def run_pipeline(file_checkers, feeder, poll_time, ntransform=1, slot_bytes=64*1024*1024, queue_size=4,
+                 report_interval=30.0, metrics_opts=None):
+    """Runs the passed SyncSeriesFeeder as a multi-process pipeline until interrupted by SIGINT or SIGTERM.
+
+    This takes the same arguments as core.runloop(), and produces the same output. Raises ValueError if the feeder
+    has stateful pre-reduction stages and ntransform is more than one, which would split their state between
+    processes. See testutils/pipeline_check.py.
+
+    Parameters
+    ----------
+    ntransform: int
+        Number of transform processes to run.
+    slot_bytes: int
+        Size of each shared memory buffer used to pass Series records between the transform and publish stages.
+        Batches larger than this are still published, but are passed between processes by copy.
+    queue_size: int
+        Maximum number of items held in each queue between stages. The number of shared memory buffers
+        is queue_size + ntransform.
+    report_interval: float
+        Time in seconds between utilization reports from each stage (zero or negative disables, apart from a
+        final report on exit).
+    metrics_opts: optparse.Values, optional
+        Options added by add_metrics_options(), if each stage process is to export its metrics.
+    """
+    stateful = sorted(prefix for prefix, stages in feeder.stages.iteritems() if stages.stateful)
+    if ntransform > 1 and stateful:
+        raise ValueError("Stages for queue(s) %s keep state across batches, and so need a single transform " %
+                         ", ".join(stateful) + "process, got %d" % ntransform)
+    pool = SlotPool(queue_size + ntransform, slot_bytes)
+    stop_event = multiprocessing.Event()
+    filesq = multiprocessing.Queue(queue_size)
+    matchesq = multiprocessing.Queue(queue_size)
+    recordsq = multiprocessing.Queue(queue_size)
+    # publish timings fed back to the emission policy in the match stage; at most one entry per batch in flight:
+    feedbackq = multiprocessing.Queue()
+
+    procs = []
+
+    def add_stage(stage, name, *args):
+        procs.append(multiprocessing.Process(target=_stage_main, name="feeder-" + name,
+                                             args=(stage, metrics_opts, name, len(procs), args)))
+
+    add_stage(_discovery_stage, "discovery", file_checkers, poll_time, filesq, stop_event, report_interval)
+    add_stage(_match_stage, "match", feeder, poll_time, filesq, matchesq, feedbackq, ntransform, report_interval)
+    for tidx in xrange(ntransform):
+        name = "transform-%d" % tidx
+        add_stage(_transform_stage, name, name, feeder, pool, matchesq, recordsq, report_interval)
+    add_stage(_publish_stage, "publish", feeder, pool, recordsq, feedbackq, ntransform, poll_time, report_interval)
+
+    def shutdown(signum, frame):
+        global_logger.get().info("Received signal %d, shutting down feeder pipeline", signum)
+        stop_event.set()
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    global_logger.get().info("Starting feeder pipeline with %d transform process(es)", ntransform)
+    for proc in procs:
+        proc.start()
+    try:
+        while any(proc.is_alive() for proc in procs):
+            for proc in procs:
+                if proc.exitcode:
+                    raise RuntimeError("Feeder pipeline process '%s' exited with code %d" % (proc.name, proc.exitcode))
+            time.sleep(0.5)
+    except:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        raise
+    finally:
+        for proc in procs:
+            proc.join()
+
+
+def add_pipeline_options(parser):
+    """Adds options controlling multi-process mode to the passed optparse.OptionParser.
+    """
+    parser.add_option("--transform-workers", type="int", default=0,
+                      help="Run as a multi-process pipeline with this many transform processes " +
+                           "(zero runs everything in a single process; at most one with stateful --stages such " +
+                           "as detrend), default %default")
+    parser.add_option("--slot-mb", type="float", default=64.0,
+                      help="Size in MB of the shared memory buffers passing output between processes " +
+                           "with --transform-workers, default %default")
+    parser.add_option("--pipeline-queue-size", type="int", default=4,
+                      help="Maximum number of batches waiting between each pair of stages " +
+                           "with --transform-workers, default %default")
+
+
+def run_feeder(file_checkers, feeder, poll_time, opts):
+    """Runs the passed feeder as specified by the options added by add_pipeline_options(): either in a
+    single process, with core.runloop() or on an event loop as specified by the options added by
+    eventloop.add_eventloop_options(), or as a multi-process pipeline.
+
+    Metrics are exported as specified by the options added by add_metrics_options(), and profiling is set up as
+    specified by those added by add_profiling_options().
+    """
+    if opts.transform_workers > 0:
+        if getattr(opts, "event_loop", False):
+            global_logger.get().warn("--event-loop is ignored with --transform-workers")
+        run_pipeline(file_checkers, feeder, poll_time, ntransform=opts.transform_workers,
+                     slot_bytes=int(opts.slot_mb * 1024 * 1024), queue_size=opts.pipeline_queue_size,
+                     metrics_opts=opts)
+    else:
+        start_metrics(opts)
+        start_profiling(opts)
+        run_loop(file_checkers, feeder, poll_time, opts)
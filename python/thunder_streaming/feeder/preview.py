@@ -0,0 +1,197 @@
+"""A low-latency preview of the frames passing through a feeder, published over ZeroMQ for display in the shell.
+
+A PreviewTap is offered the last frame of the first queue in each batch, as already read by the feeder for
+transposing, so that previews cost no further reads. A sender thread decodes the latest frame offered, as the
+feeder does (see queuespec.py), downsamples it and scales it to uint8, and publishes it on a topic of the shell's
+MessageProxy, at no more than max_rate frames per second. Frames offered in between are conflated, keeping only the
+newest, so neither a slow viewer nor a high frame rate can hold up the feeder: the feeder only ever swaps a
+reference, and publishing never blocks, dropping frames once the socket's small high-water mark is reached.
+
+Each message has two parts, as for shell.message_proxy.Publisher: the topic, and a payload consisting of a JSON
+header line (timepoint, shape, dtype and time the frame was read), a newline, and the frame's bytes in C order.
+Frames are published with their dimensions reversed relative to the feeders' 'shape' option, as (z,) y, x.
+"""
+import json
+import os
+from threading import Condition, Thread
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.queuespec import get_queue_specs
+from thunder_streaming.feeder.utils.logger import global_logger
+
+DEFAULT_TOPIC = "feeder_preview"
+
+
+def downsample_frame(frame, factor):
+    """Averages the passed frame over blocks of factor x factor pixels in its first two dimensions, trimming any
+    remainder.
+    """
+    if factor <= 1:
+        return frame.astype('float32')
+    ny, nx = frame.shape[0] // factor, frame.shape[1] // factor
+    trimmed = frame[:ny*factor, :nx*factor].astype('float32')
+    blocks = trimmed.reshape((ny, factor, nx, factor) + frame.shape[2:])
+    return blocks.mean(axis=3).mean(axis=1)
+
+
+def to_uint8(frame, vmin=None, vmax=None):
+    """Scales the passed frame linearly so that vmin maps to 0 and vmax to 255, clipping values outside this range.
+    If not given, vmin and vmax are the frame's own minimum and maximum.
+    """
+    lo = frame.min() if vmin is None else vmin
+    hi = frame.max() if vmax is None else vmax
+    scale = 255.0 / (hi - lo) if hi > lo else 0.0
+    return np.clip((frame - lo) * scale, 0, 255).astype('uint8')
+
+
+def encode_preview(frame, timepoint, matched_time):
+    header = {"timepoint": timepoint, "shape": list(frame.shape), "dtype": frame.dtype.str, "time": matched_time}
+    return json.dumps(header) + "\n" + np.ascontiguousarray(frame).tostring()
+
+
+def decode_preview(payload):
+    """Returns (header dict, frame array) for a payload published by a PreviewTap.
+    """
+    headerstr, sep, data = payload.partition("\n")
+    header = json.loads(headerstr)
+    frame = np.frombuffer(data, dtype=np.dtype(str(header["dtype"]))).reshape(header["shape"])
+    return header, frame
+
+
+class PreviewTap(object):
+    """Publishes downsampled uint8 previews of the most recent frames offered.
+
+    Parameters
+    ----------
+    addr: string
+        Address of the MessageProxy's publisher-facing (XSUB) socket, such as "tcp://localhost:9060".
+    shape: tuple of ints
+        Dimensions of each frame, in Fortran order as for the feeders' 'shape' option.
+    topic: string
+        ZeroMQ topic to publish on.
+    dtype: string
+        Data type of the input files, as for the feeders' 'indtype' option.
+    queue_spec: QueueSpec, optional
+        Decoding of the input files, if given for their queue; overrides dtype where it gives one.
+    downsample: int
+        Factor by which to downsample the first two dimensions of each frame.
+    max_rate: float
+        Maximum number of frames to publish per second.
+    vmin, vmax: float, optional
+        Input values mapped to 0 and 255. Defaults to each frame's own range.
+    """
+    def __init__(self, addr, shape, topic=DEFAULT_TOPIC, dtype='uint16', queue_spec=None, downsample=4,
+                 max_rate=5.0, vmin=None, vmax=None):
+        self.addr = addr
+        self.shape = tuple(shape)
+        self.topic = topic
+        self.dtype = np.dtype(dtype)
+        self.queue_spec = queue_spec
+        self.downsample = max(1, int(downsample))
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.vmin = vmin
+        self.vmax = vmax
+        self.nsent = 0
+        self.nconflated = 0
+        self._latest = None
+        self._cond = Condition()
+        # the sender thread and its socket are started lazily, so that a feeder may be handed to another process
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._latest = None
+            thread = Thread(target=self._run, name="PreviewTap")
+            thread.setDaemon(True)
+            thread.start()
+
+    def offer(self, timepoint, data, filename=""):
+        """Makes the passed frame the next to be published, replacing any frame not yet published.
+
+        data is the contents of an input file as read by the feeder: a 1d array of any dtype, which is decoded here.
+        It must not be modified afterwards.
+        """
+        self._ensure_started()
+        with self._cond:
+            if self._latest is not None:
+                self.nconflated += 1
+            self._latest = (timepoint, data, filename, time.time())
+            self._cond.notify()
+
+    def _decode_frame(self, data, filename):
+        if self.queue_spec is not None:
+            values = self.queue_spec.decode(data.view(np.uint8), self.dtype, filename)
+        else:
+            values = data.view(self.dtype)
+        frame = values.reshape(self.shape, order='F')
+        # published as (z,) y, x, so that each plane is a conventionally oriented image
+        return to_uint8(downsample_frame(frame, self.downsample), self.vmin, self.vmax).T
+
+    def _run(self):
+        import zmq
+        socket = zmq.Context.instance().socket(zmq.PUB)
+        socket.setsockopt(zmq.SNDHWM, 2)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.addr)
+        last_send = 0.0
+        while True:
+            with self._cond:
+                while self._latest is None:
+                    self._cond.wait()
+            # wait out the rate limit before taking the frame, so that the newest one is published
+            delay = last_send + self.min_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                timepoint, data, filename, read_time = self._latest
+                self._latest = None
+            try:
+                frame = self._decode_frame(data, filename)
+            except ValueError, e:
+                global_logger.warnIfNotAlreadyGiven("Could not make preview of '%s': %s" % (filename, e))
+                continue
+            try:
+                socket.send_multipart([self.topic, encode_preview(frame, timepoint, read_time)], zmq.NOBLOCK)
+                self.nsent += 1
+            except zmq.Again:
+                pass
+            last_send = time.time()
+
+
+def add_preview_options(parser):
+    """Adds options controlling the preview tap to the passed optparse.OptionParser.
+    """
+    parser.add_option("--preview-addr", default=None,
+                      help="Address of the shell's MessageProxy, such as tcp://localhost:9060, to publish " +
+                           "downsampled previews of the first queue's frames to (none disables), default %default")
+    parser.add_option("--preview-topic", default=DEFAULT_TOPIC,
+                      help="Topic to publish previews on, default %default")
+    parser.add_option("--preview-shape", default=None,
+                      help="Comma-separated frame dimensions for previews; defaults to --shape")
+    parser.add_option("--preview-downsample", type="int", default=4,
+                      help="Factor by which previews are downsampled in x and y, default %default")
+    parser.add_option("--preview-rate", type="float", default=5.0,
+                      help="Maximum number of previews published per second, default %default")
+
+
+def get_preview_tap(opts, qname=None):
+    """Returns a PreviewTap as specified by the options added by add_preview_options(), or None.
+
+    Frames are decoded as the feeder decodes the files of the queue qname: with --indtype, or as given for that
+    queue by the options added by queuespec.add_queue_spec_options().
+    """
+    if not opts.preview_addr:
+        return None
+    shape = opts.preview_shape or getattr(opts, "shape", None)
+    if not shape:
+        global_logger.get().warn("No frame shape given with --preview-shape or --shape; previews disabled")
+        return None
+    if isinstance(shape, basestring):
+        shape = [int(dim) for dim in shape.split(",")]
+    queue_specs = get_queue_specs(opts) if hasattr(opts, "queue_spec_file") else None
+    queue_spec = queue_specs.get(qname) if queue_specs and qname else None
+    return PreviewTap(opts.preview_addr, shape, topic=opts.preview_topic, dtype=getattr(opts, "indtype", "uint16"),
+                      queue_spec=queue_spec, downsample=opts.preview_downsample, max_rate=opts.preview_rate)
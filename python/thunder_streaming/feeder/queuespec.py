@@ -0,0 +1,186 @@
+"""Per-queue descriptions of how input files are to be decoded, for queues whose files don't match the feeder-wide
+--indtype and --shape, for instance behavioural data written as big-endian floats behind a fixed-size header.
+
+Queue specs are read from a text file with one line per queue, giving the queue name followed by whitespace-
+separated key=value options. Lines starting with '#' are comments. For instance:
+    # queue  options
+    images   dtype=uint16 shape=512,512,4
+    behav    dtype=float32 byteorder=big offset=64 count=12 keys=own origin=0,0,4
+
+The available options are:
+    dtype: data type of the elements in the file, as understood by numpy, for instance 'int16' or '>f4'. Defaults
+        to the feeder's --indtype.
+    byteorder: 'little', 'big' or 'native', overriding any byte order given in dtype.
+    offset: number of header bytes to skip at the start of each file, default 0.
+    count: number of elements to read after the header; any trailing bytes are ignored. Defaults to all of them.
+    shape: comma-separated dimensions of a single frame of this queue, in x, y, z order as for --shape. Implies
+        count if that is not given.
+    keys: how this queue's records are keyed, when the feeder writes out keys. 'continue' (the default) continues
+        the index from the end of the previous queue, so that with a --shape, later queues are appended to the
+        image as extra z planes. 'own' keys records by their subscripts within this queue's own shape (or by their
+        position, if no shape is given), shifted by origin.
+    origin: comma-separated offsets added to 'own' keys, one per output key dimension, default all zero.
+
+Records of all queues are written to the same series file, so they are all converted to the feeder's --dtype, and
+all carry the same number of keys.
+"""
+import numpy as np
+
+BYTEORDERS = {'little': '<', 'big': '>', 'native': '='}
+KEY_STRATEGIES = ('continue', 'own')
+
+
+def _ints(value):
+    return tuple(int(v) for v in value.split(',') if v.strip())
+
+
+class QueueSpec(object):
+    """Decoding of the input files of a single queue.
+
+    Parameters
+    ----------
+    name: string
+        Queue name.
+    dtype: numpy dtype or string, optional
+        Type of the elements in the file. If None, the feeder's input dtype is used.
+    byteorder: string, optional
+        One of 'little', 'big' or 'native', overriding the byte order of dtype.
+    offset: int
+        Number of header bytes to skip.
+    count: int, optional
+        Number of elements to read after the header. If None, all complete elements are read.
+    shape: sequence of int, optional
+        Shape of a single frame, in x, y, z order.
+    keys: string
+        One of 'continue' or 'own'; see module documentation.
+    origin: sequence of int, optional
+        Offsets added to 'own' keys.
+    """
+    def __init__(self, name, dtype=None, byteorder=None, offset=0, count=None, shape=None, keys='continue',
+                 origin=None):
+        self.name = name
+        if byteorder is not None and byteorder not in BYTEORDERS:
+            raise ValueError("Queue '%s': byteorder must be one of %s, got '%s'" %
+                             (name, ", ".join(sorted(BYTEORDERS)), byteorder))
+        self.byteorder = byteorder
+        self.dtype = None if dtype is None else self._with_byteorder(np.dtype(dtype))
+        self.offset = int(offset)
+        if self.offset < 0:
+            raise ValueError("Queue '%s': offset must be non-negative, got %d" % (name, self.offset))
+        self.shape = tuple(shape) if shape else None
+        if count is None and self.shape:
+            count = int(np.prod(self.shape))
+        elif count is not None and self.shape and int(count) != np.prod(self.shape):
+            raise ValueError("Queue '%s': count %d doesn't match shape %s" % (name, int(count), self.shape))
+        self.count = None if count is None else int(count)
+        if keys not in KEY_STRATEGIES:
+            raise ValueError("Queue '%s': keys must be one of %s, got '%s'" % (name, ", ".join(KEY_STRATEGIES), keys))
+        self.keys = keys
+        self.origin = tuple(origin) if origin else None
+
+    def _with_byteorder(self, dtype):
+        if self.byteorder is None:
+            return dtype
+        return dtype.newbyteorder(BYTEORDERS[self.byteorder])
+
+    def input_dtype(self, default):
+        """Returns the dtype of this queue's elements, using the passed default if none was given.
+        """
+        if self.dtype is not None:
+            return self.dtype
+        return self._with_byteorder(np.dtype(default))
+
+    def decode(self, raw, default_dtype, filename=""):
+        """Returns a view of the elements in the passed raw file contents, a 1d uint8 array, skipping the header.
+
+        No copy or conversion is made here; the returned view may be unaligned or non-native, and is expected to be
+        converted on assignment into the record buffer.
+        """
+        dtype = self.input_dtype(default_dtype)
+        navailable = max(0, raw.size - self.offset) // dtype.itemsize
+        count = navailable if self.count is None else self.count
+        if count > navailable:
+            raise ValueError("File '%s' of queue '%s' holds %d %s elements after its %d byte header, expected %d" %
+                             (filename, self.name, navailable, dtype, self.offset, count))
+        return raw[self.offset:self.offset + count * dtype.itemsize].view(dtype)
+
+    def own_keys(self, size, ndim):
+        """Returns a list of ndim arrays of 'own' keys for size elements of this queue.
+        """
+        linidxs = np.arange(size)
+        if ndim == 1:
+            subs = [linidxs]
+        else:
+            shape = self.shape or (size,)
+            if len(shape) > ndim:
+                raise ValueError("Queue '%s': shape %s has more dimensions than the %d output key dimensions" %
+                                 (self.name, shape, ndim))
+            if np.prod(shape) != size:
+                raise ValueError("Queue '%s': shape %s doesn't match the %d elements read" % (self.name, shape, size))
+            subs = list(np.unravel_index(linidxs, shape, order='F'))
+            subs += [np.zeros(size, dtype=linidxs.dtype)] * (ndim - len(shape))
+        if self.origin:
+            if len(self.origin) != ndim:
+                raise ValueError("Queue '%s': origin %s should have one offset for each of the %d output key "
+                                 "dimensions" % (self.name, self.origin, ndim))
+            subs = [sub + offset for sub, offset in zip(subs, self.origin)]
+        return subs
+
+    @classmethod
+    def fromLine(cls, line):
+        """Factory to build a QueueSpec from a single line of a queue spec file, as described in the module
+        documentation.
+        """
+        splits = line.split()
+        kwargs = {}
+        for option in splits[1:]:
+            key, sep, value = option.partition('=')
+            if not sep:
+                raise ValueError("Queue '%s': expected key=value, got '%s'" % (splits[0], option))
+            if key in ('dtype', 'byteorder', 'keys'):
+                kwargs[key] = value
+            elif key in ('offset', 'count'):
+                kwargs[key] = int(value)
+            elif key in ('shape', 'origin'):
+                kwargs[key] = _ints(value)
+            else:
+                raise ValueError("Queue '%s': unknown option '%s'" % (splits[0], key))
+        return cls(splits[0], **kwargs)
+
+    @classmethod
+    def fromFile(cls, filename_or_handle):
+        """Reads a queue spec file, returning a dict of queue name to QueueSpec.
+        """
+        def parse_file(handle):
+            specs = {}
+            for line in handle:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    spec = cls.fromLine(line)
+                    specs[spec.name] = spec
+            return specs
+        if isinstance(filename_or_handle, basestring):
+            with open(filename_or_handle, 'r') as fp:
+                return parse_file(fp)
+        return parse_file(filename_or_handle)
+
+    def __repr__(self):
+        return "QueueSpec(%r, dtype=%s, offset=%d, count=%s, shape=%s, keys=%s)" % (
+            self.name, self.dtype, self.offset, self.count, self.shape, self.keys)
+
+
+def add_queue_spec_options(parser):
+    """Adds the option giving a queue spec file to the passed optparse.OptionParser.
+    """
+    parser.add_option("--queue-spec-file", default=None,
+                      help="File giving the dtype, byte order, header size, element count or shape and key " +
+                           "strategy of individual queues' input files. See feeder/queuespec.py.")
+
+
+def get_queue_specs(opts):
+    """Returns a dict of queue name to QueueSpec as read from the file given by the option added by
+    add_queue_spec_options(), or None if no file is given.
+    """
+    if not opts.queue_spec_file:
+        return None
+    return QueueSpec.fromFile(opts.queue_spec_file)
@@ -0,0 +1,315 @@
+"""Sharding of the input timepoints across several feeder processes, coordinated over ZeroMQ.
+
+Timepoints are divided into nshards shards: timepoint t belongs to shard (t // block) % nshards, so that with a
+block of 1, shards take turns timepoint by timepoint, and with larger blocks, each shard takes runs of consecutive
+timepoints. A ShardCoordinator assigns each shard to exactly one live worker. Each worker is a ShardWorker wrapped
+around an ordinary feeder, which it only feeds the files belonging to its shards, so that workers never fight over
+the same timepoints.
+
+Workers send a heartbeat to the coordinator on each feed cycle, and as soon as they have written anything out,
+reporting the highest timepoint they have written out for each shard, and are sent their current assignment in
+reply. Once workers have started (or startup_wait has
+passed), the coordinator assigns each unowned shard to the live worker with the fewest shards. A worker not heard
+from within timeout seconds is taken to have died, and its shards are reassigned. Workers set aside the files of
+shards they don't own, so that a worker taking over a shard can go back and feed those of its timepoints above the
+highest one written out by the previous owner. Delivery is at least once, not exactly once: timepoints a worker had
+written out but not yet reported when it died, which are those of a batch it was killed in the middle of publishing,
+are written out again by the new owner, so that a consumer may see them twice.
+
+Output files are tagged with the name of the worker writing them (see SyncSeriesFeeder.output_tag), so that file
+names stay distinct across workers.
+"""
+import json
+import time
+
+from thunder_streaming.feeder.feeders import Feeder
+from thunder_streaming.feeder.utils.logger import global_logger
+
+DEFAULT_PORT = 5570
+
+
+class ShardCoordinator(object):
+    """Assigns shards to workers, and reassigns them when workers die.
+
+    Parameters
+    ----------
+    endpoint: string
+        ZeroMQ endpoint to bind to, such as "tcp://127.0.0.1:5570".
+    nshards: int
+        Number of shards.
+    nworkers: int, optional
+        Number of workers expected at startup; shards are first assigned once this many have checked in, or
+        startup_wait s have passed. Defaults to nshards.
+    block: int
+        Number of consecutive timepoints in each run belonging to the same shard.
+    timeout: float
+        Time in s after which a worker that has not been heard from is taken to have died.
+    startup_wait: float
+        Maximum time in s to wait for nworkers workers before assigning shards.
+    """
+    def __init__(self, endpoint, nshards, nworkers=None, block=1, timeout=10.0, startup_wait=10.0):
+        self.endpoint = endpoint
+        self.nshards = int(nshards)
+        self.nworkers = int(nworkers) if nworkers else self.nshards
+        self.block = max(1, int(block))
+        self.timeout = float(timeout)
+        self.startup_wait = float(startup_wait)
+        self.owners = {}  # shard -> worker name
+        self.last_heard = {}  # worker name -> time
+        self.watermarks = {}  # shard -> highest timepoint written out
+        self._start_time = time.time()
+        self._assigning = False
+
+    def shards_of(self, worker):
+        return sorted(shard for shard, owner in self.owners.iteritems() if owner == worker)
+
+    def handle(self, worker, msg, now):
+        """Updates the coordinator state for a message from the named worker.
+        """
+        if msg.get("type") == "bye":
+            self._remove(worker, "left")
+            return
+        if worker not in self.last_heard:
+            global_logger.get().info("Worker '%s' joined", worker)
+        self.last_heard[worker] = now
+        for shard, timepoint in msg.get("done", {}).iteritems():
+            shard = int(shard)
+            # reports from a worker that has lost the shard are ignored
+            if self.owners.get(shard) == worker:
+                self.watermarks[shard] = max(timepoint, self.watermarks.get(shard, timepoint))
+
+    def _remove(self, worker, reason):
+        # a worker already expired may still say goodbye
+        if self.last_heard.pop(worker, None) is None:
+            return
+        orphaned = self.shards_of(worker)
+        for shard in orphaned:
+            del self.owners[shard]
+        global_logger.get().warn("Worker '%s' %s; shard(s) %s to be reassigned", worker, reason, orphaned)
+
+    def expire(self, now):
+        for worker, last in self.last_heard.items():
+            if now - last > self.timeout:
+                self._remove(worker, "not heard from in %.1f s" % (now - last))
+
+    def assign(self, now):
+        """Assigns any unowned shards to the least loaded live workers.
+        """
+        if not self._assigning:
+            if len(self.last_heard) < self.nworkers and now - self._start_time < self.startup_wait:
+                return
+            self._assigning = True
+        if not self.last_heard:
+            return
+        for shard in xrange(self.nshards):
+            if shard not in self.owners:
+                worker = min(self.last_heard, key=lambda name: (len(self.shards_of(name)), name))
+                self.owners[shard] = worker
+                global_logger.get().info("Assigned shard %d to worker '%s', from timepoint %s", shard, worker,
+                                         self.watermarks.get(shard, "start"))
+
+    def assignment(self, worker):
+        return {"type": "assign", "nshards": self.nshards, "block": self.block, "shards": self.shards_of(worker),
+                "watermarks": dict((str(shard), tp) for shard, tp in self.watermarks.iteritems())}
+
+    def run(self, stop_event=None):
+        """Serves workers until stop_event (a threading or multiprocessing Event), if given, is set.
+        """
+        import zmq
+        socket = zmq.Context.instance().socket(zmq.ROUTER)
+        socket.setsockopt(zmq.LINGER, 0)
+        if hasattr(zmq, "ROUTER_HANDOVER"):
+            # a restarted worker may reuse its name before its old connection is noticed to be gone
+            socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        socket.bind(self.endpoint)
+        global_logger.get().info("Shard coordinator for %d shard(s) listening on %s", self.nshards, self.endpoint)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                replies = set()
+                if socket.poll(500):
+                    while True:
+                        try:
+                            identity, payload = socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        try:
+                            msg = json.loads(payload)
+                        except ValueError:
+                            global_logger.get().warn("Ignoring malformed message from '%s'", identity)
+                            continue
+                        self.handle(identity, msg, time.time())
+                        if identity in self.last_heard:
+                            replies.add(identity)
+                now = time.time()
+                self.expire(now)
+                self.assign(now)
+                for identity in replies:
+                    if identity in self.last_heard:
+                        socket.send_multipart([identity, json.dumps(self.assignment(identity))])
+        finally:
+            socket.close()
+
+
+class ShardWorker(Feeder):
+    """Feeder that passes on to the wrapped feeder only those files belonging to the shards assigned to it by a
+    ShardCoordinator, and reports its progress to the coordinator.
+
+    The wrapped feeder should return the input files it has written out from feed(), as SyncSeriesFeeder does, and
+    should not check for skipped timepoints, since each worker only sees some of them.
+
+    Parameters
+    ----------
+    feeder: Feeder
+        Feeder to pass files on to.
+    endpoint: string
+        ZeroMQ endpoint of the coordinator.
+    name: string
+        Name of this worker, unique among the coordinator's workers.
+    filename_parser: FilenameParser
+        Parser for the timepoints of input files.
+    heartbeat_interval: float
+        Minimum time in s between heartbeats.
+    """
+    def __init__(self, feeder, endpoint, name, filename_parser, heartbeat_interval=1.0):
+        self.feeder = feeder
+        self.endpoint = endpoint
+        self.name = name
+        self.filename_parser = filename_parser
+        self.heartbeat_interval = float(heartbeat_interval)
+        if hasattr(feeder, "output_tag"):
+            feeder.output_tag = name
+        self.shards = set()
+        self.nshards = None
+        self.block = 1
+        self.watermarks = {}
+        self.done = {}  # shard -> highest timepoint written out
+        # (timepoint, filename) for files not (yet) belonging to this worker's shards:
+        self._parked = []
+        self._socket = None
+        self._last_heartbeat = 0.0
+
+    @property
+    def backlog_monitor(self):
+        return self.feeder.backlog_monitor
+
+    @property
+    def emission_policy(self):
+        return getattr(self.feeder, "emission_policy", None)
+
+    def nheld(self):
+        return self.feeder.nheld()
+
+    def held_matches(self):
+        return self.feeder.held_matches()
+
+    def shard_of(self, timepoint):
+        return (int(timepoint) // self.block) % self.nshards
+
+    def _get_socket(self):
+        if self._socket is None:
+            import zmq
+            socket = zmq.Context.instance().socket(zmq.DEALER)
+            socket.setsockopt(zmq.IDENTITY, self.name)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.endpoint)
+            self._socket = socket
+        return self._socket
+
+    def _exchange(self):
+        """Sends a heartbeat if one is due, and applies any assignments received, returning any parked files that
+        now belong to this worker.
+        """
+        import zmq
+        socket = self._get_socket()
+        if time.time() - self._last_heartbeat >= self.heartbeat_interval:
+            self._heartbeat()
+        msg = None
+        while True:
+            try:
+                msg = json.loads(socket.recv(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        if msg is None:
+            return []
+        return self._apply(msg)
+
+    def _heartbeat(self):
+        self._get_socket().send(json.dumps({"type": "heartbeat", "shards": sorted(self.shards),
+                                            "done": dict((str(shard), tp) for shard, tp in self.done.iteritems())}))
+        self._last_heartbeat = time.time()
+
+    def _apply(self, msg):
+        self.nshards = msg["nshards"]
+        self.block = msg["block"]
+        self.watermarks = dict((int(shard), tp) for shard, tp in msg["watermarks"].iteritems())
+        shards = set(msg["shards"])
+        if shards != self.shards:
+            global_logger.get().info("Worker '%s' now has shard(s) %s", self.name, sorted(shards))
+        self.shards = shards
+
+        claimed, parked = [], []
+        for timepoint, filename in self._parked:
+            shard = self.shard_of(timepoint)
+            if timepoint <= self.watermarks.get(shard, -1):
+                # already written out by another worker
+                continue
+            if shard in self.shards:
+                claimed.append(filename)
+            else:
+                parked.append((timepoint, filename))
+        self._parked = parked
+        if claimed:
+            global_logger.get().info("Worker '%s' feeding %d set-aside file(s) of its new shard(s)", self.name,
+                                     len(claimed))
+        return claimed
+
+    def feed(self, filenames):
+        mine = self._exchange()
+        for filename in filenames:
+            timepoint = self.filename_parser.parse(filename).timepoint
+            if timepoint is None:
+                # left to the wrapped feeder to warn about
+                mine.append(filename)
+            elif self.nshards is not None and self.shard_of(timepoint) in self.shards:
+                mine.append(filename)
+            else:
+                self._parked.append((int(timepoint), filename))
+
+        written = self.feeder.feed(mine)
+        for filename in written:
+            timepoint = self.filename_parser.parse(filename).timepoint
+            if timepoint is not None:
+                shard = self.shard_of(timepoint)
+                self.done[shard] = max(int(timepoint), self.done.get(shard, -1))
+        if written:
+            # report progress at once, so that as little as possible is written out again should this worker die
+            self._heartbeat()
+        return written
+
+    def clean(self):
+        return self.feeder.clean()
+
+    def close(self):
+        """Tells the coordinator that this worker is leaving, so that its shards are reassigned at once.
+        """
+        if self._socket is not None:
+            self._socket.send(json.dumps({"type": "bye"}))
+            self._socket.close()
+            self._socket = None
+
+
+def add_sharding_options(parser):
+    """Adds options controlling sharding to the passed optparse.OptionParser.
+    """
+    parser.add_option("--workers", type="int", default=2,
+                      help="Number of worker processes to start, default %default")
+    parser.add_option("--shards", type="int", default=-1,
+                      help="Number of shards (non-positive for one per worker), default %default")
+    parser.add_option("--shard-block", type="int", default=1,
+                      help="Number of consecutive timepoints assigned to a shard at a time, default %default")
+    parser.add_option("--coordinator", default="tcp://127.0.0.1:%d" % DEFAULT_PORT,
+                      help="ZeroMQ endpoint of the shard coordinator, default %default")
+    parser.add_option("--heartbeat-timeout", type="float", default=10.0,
+                      help="Time in s after which a silent worker's shards are reassigned, default %default")
+    parser.add_option("--worker-name", default=None,
+                      help="If given, run only a single worker of this name, joining an existing coordinator")
@@ -0,0 +1,260 @@
+"""A ring buffer of batches of Series records in a shared memory file, for consumers on the same node as the feeder.
+
+The ring is a file, normally under /dev/shm, laid out as a 64 byte ring header followed by nslots fixed-size slots.
+The ring header is little-endian:
+
+offset  size  field
+0       4     magic, "TSRG"
+4       2     version, currently 2
+8       4     number of slots
+12      8     size in bytes of the data area of each slot
+24      8     sequence number of the next batch to be written; batches already written are below this
+32      4     generation, incremented each time a writer lays the ring out anew
+
+Batch number seq is written to slot seq % nslots, which starts with a 64 byte slot header:
+
+offset  size  field
+0       8     lock, 2 * seq + 1 while batch seq is being written and 2 * seq + 2 once it is complete
+8       8     sequence number of the batch
+16      8     valid length of the data area in bytes
+24      32    a Series batch header, as in framing.py, giving record size, number of records, dtype and send time
+
+The records themselves follow the slot header, exactly as they would be written to a Series binary file.
+
+The writer never waits for readers. A reader that falls more than nslots batches behind loses the oldest batches,
+which RingReader.next() counts and skips. Since batches are returned as views onto the shared memory rather than
+copies, a batch may be overwritten while it is being used; RingBatch.valid() checks the slot's lock, and should be
+called once the reader is done with a batch to confirm that what it read was intact (a seqlock).
+
+A writer restarted on an existing ring file reopens it in place rather than replacing it, so that readers keep
+mapping the file being written. With the same number and size of slots, it carries on from the ring's sequence
+number, and readers do not notice the restart. Otherwise it lays the ring out anew, starting again from sequence
+number 0, and bumps the generation, upon which readers map the file again and start from its first batch.
+"""
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.framing import HEADER, pack_header, unpack_header
+
+MAGIC = b"TSRG"
+VERSION = 2
+RING_HEADER = struct.Struct("<4sHxxIQ4xQI")
+RING_HEADER_SIZE = 64
+WRITE_SEQ = struct.Struct("<Q")
+WRITE_SEQ_OFFSET = 24
+GENERATION = struct.Struct("<I")
+GENERATION_OFFSET = 32
+SLOT_HEADER = struct.Struct("<QQQ%ds" % HEADER.size)
+SLOT_HEADER_SIZE = 64
+LOCK = struct.Struct("<Q")
+
+
+def _slot_offset(seq, nslots, slot_bytes):
+    return RING_HEADER_SIZE + (seq % nslots) * (SLOT_HEADER_SIZE + slot_bytes)
+
+
+def _read_ring_header(path):
+    """Returns the fields of the header of the ring buffer file at path, or None if there is no such file of this
+    version.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read(RING_HEADER.size)
+    except IOError:
+        return None
+    if len(data) < RING_HEADER.size:
+        return None
+    fields = RING_HEADER.unpack(data)
+    if fields[:2] != (MAGIC, VERSION):
+        return None
+    return fields
+
+
+class RingWriter(object):
+    """Writes batches of Series records into a ring buffer file.
+
+    An existing ring buffer file at the passed path is reopened in place, as described in the module documentation;
+    any other file there is replaced.
+
+    Parameters
+    ----------
+    path: string
+        Ring buffer file, normally under /dev/shm.
+    nslots: int
+        Number of batches held at once.
+    slot_bytes: int
+        Maximum size of a batch in bytes.
+    """
+    def __init__(self, path, nslots=8, slot_bytes=64*1024*1024):
+        self.path = path
+        self.nslots = int(nslots)
+        self.slot_bytes = int(slot_bytes)
+        size = RING_HEADER_SIZE + self.nslots * (SLOT_HEADER_SIZE + self.slot_bytes)
+        previous = _read_ring_header(path)
+        if previous is None and os.path.exists(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            # never shrink the file, as readers may still be mapping all of it
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if previous is not None and previous[2:4] == (self.nslots, self.slot_bytes):
+            self.next_seq = previous[4]
+            return
+        # the generation is bumped last, so that readers remapping the ring find it already laid out
+        generation = previous[5] if previous is not None else 0
+        RING_HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.nslots, self.slot_bytes, 0, generation)
+        for seq in xrange(self.nslots):
+            LOCK.pack_into(self._mmap, _slot_offset(seq, self.nslots, self.slot_bytes), 0)
+        if previous is not None:
+            GENERATION.pack_into(self._mmap, GENERATION_OFFSET, generation + 1)
+        self.next_seq = 0
+
+    def write(self, arrays, record_size, dtype, nkeys=0):
+        """Writes the passed arrays, concatenated, into the next slot as a single batch of records of record_size
+        bytes, returning the batch's sequence number.
+        """
+        nbytes = sum(ary.nbytes for ary in arrays)
+        if nbytes > self.slot_bytes:
+            raise ValueError("Batch of %d bytes does not fit in ring buffer slots of %d bytes" % (
+                nbytes, self.slot_bytes))
+        seq = self.next_seq
+        offset = _slot_offset(seq, self.nslots, self.slot_bytes)
+        LOCK.pack_into(self._mmap, offset, 2 * seq + 1)
+        pos = offset + SLOT_HEADER_SIZE
+        for ary in arrays:
+            view = np.ascontiguousarray(ary).reshape(-1).view(np.uint8)
+            np.ndarray(view.size, dtype=np.uint8, buffer=self._mmap, offset=pos)[:] = view
+            pos += view.size
+        header = pack_header(record_size, nbytes // record_size, dtype, nkeys=nkeys)
+        SLOT_HEADER.pack_into(self._mmap, offset, 2 * seq + 1, seq, nbytes, header)
+        LOCK.pack_into(self._mmap, offset, 2 * seq + 2)
+        WRITE_SEQ.pack_into(self._mmap, WRITE_SEQ_OFFSET, seq + 1)
+        self.next_seq = seq + 1
+        return seq
+
+    def close(self, unlink=False):
+        self._mmap.close()
+        if unlink and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RingBatch(object):
+    """A batch read from a ring buffer.
+
+    'records' is a read-only 2d uint8 array of shape (number of records, record size), viewing the shared memory
+    directly; 'header' is a framing.SeriesBatchHeader.
+    """
+    def __init__(self, ring, seq, header, records, offset):
+        self.ring = ring
+        self.seq = seq
+        self.header = header
+        self.records = records
+        self._mmap = ring._mmap
+        self._offset = offset
+
+    def valid(self):
+        """Returns True if this batch has not been overwritten since it was read.
+        """
+        return LOCK.unpack_from(self._mmap, self._offset)[0] == 2 * self.seq + 2
+
+
+class RingReader(object):
+    """Reads batches from a ring buffer file written by a RingWriter.
+
+    Parameters
+    ----------
+    path: string
+        Ring buffer file.
+    from_oldest: boolean
+        If True, start from the oldest batch still in the ring; otherwise start from the next batch written.
+
+    When a restarted writer lays the ring out anew, next() maps it again and carries on from its first batch.
+    """
+    def __init__(self, path, from_oldest=False):
+        self.path = path
+        write_seq = self._map()
+        self.next_seq = self.oldest_seq() if from_oldest else write_seq
+        self.nlost = 0
+
+    def _map(self):
+        """Maps the ring buffer file, returning the sequence number of the next batch to be written.
+        """
+        # any previous mapping is left to be closed once no batch read from it is referenced
+        with open(self.path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nslots, self.slot_bytes, write_seq, self.generation = RING_HEADER.unpack_from(
+            self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a ring buffer file" % self.path)
+        if version != VERSION:
+            raise ValueError("Unsupported ring buffer version %d in '%s'" % (version, self.path))
+        return write_seq
+
+    def write_seq(self):
+        """Returns the sequence number of the next batch to be written.
+        """
+        return WRITE_SEQ.unpack_from(self._mmap, WRITE_SEQ_OFFSET)[0]
+
+    def oldest_seq(self):
+        """Returns the sequence number of the oldest batch that may still be read.
+        """
+        # the slot after the newest batch may already be being overwritten
+        return max(0, self.write_seq() - self.nslots + 1)
+
+    def read(self, seq):
+        """Returns batch number seq as a RingBatch, or None if it has not been completely written yet.
+
+        Raises ValueError if the batch has already been overwritten.
+        """
+        offset = _slot_offset(seq, self.nslots, self.slot_bytes)
+        lock, slotseq, nbytes, header = SLOT_HEADER.unpack_from(self._mmap, offset)
+        if lock < 2 * seq + 2:
+            return None
+        if lock > 2 * seq + 2:
+            raise ValueError("Batch %d has been overwritten in ring buffer '%s'" % (seq, self.path))
+        header = unpack_header(header)
+        records = np.frombuffer(self._mmap, dtype=np.uint8, count=nbytes, offset=offset + SLOT_HEADER_SIZE)
+        batch = RingBatch(self, slotseq, header, records.reshape(header.nrecords, header.record_size), offset)
+        # the header may have been read while the slot was being rewritten
+        if not batch.valid():
+            raise ValueError("Batch %d has been overwritten in ring buffer '%s'" % (seq, self.path))
+        return batch
+
+    def next(self, timeout=-1.0, poll_interval=0.001):
+        """Returns the next batch in sequence as a RingBatch, waiting up to timeout s for it to be written (forever
+        if timeout is negative), or None on a timeout.
+
+        If the reader has fallen so far behind that batches have been overwritten, these are skipped and counted
+        in nlost.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if GENERATION.unpack_from(self._mmap, GENERATION_OFFSET)[0] != self.generation:
+                self._map()
+                self.next_seq = 0
+            oldest = self.oldest_seq()
+            if self.next_seq < oldest:
+                self.nlost += oldest - self.next_seq
+                self.next_seq = oldest
+            try:
+                batch = self.read(self.next_seq)
+            except ValueError:
+                # overwritten between the check above and the read
+                continue
+            if batch is not None:
+                self.next_seq += 1
+                return batch
+            if 0 <= timeout and deadline <= time.time():
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        self._mmap.close()
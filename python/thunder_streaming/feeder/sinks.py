@@ -0,0 +1,508 @@
+"""Sinks, which deliver the same matched input files to several consumers, each in its own format.
+
+A FanOutFeeder walks, reads and matches each input file once, and passes the matched timepoints to any number of
+sinks. Each sink has its own output directory, linger time, and emission policy deciding how many timepoints go into
+each output file, and runs on its own thread behind a bounded queue. A sink that falls behind has new data dropped,
+with a warning, once its queue is full, rather than holding back the other sinks.
+
+An ArchiveSink keeps the input frames in a compressed archive for offline analysis; see archive.py.
+
+Sinks may also be given on the command line as specifications of the form "kind:outdir[:key=value...]", for
+instance "series:/mnt/spark/in:batch=10:linger=5:shape=512,512,4". See Sink.fromSpec().
+"""
+import atexit
+from collections import deque
+from Queue import Queue, Empty, Full
+import os
+from threading import Thread
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.archive import ArchiveWriter
+from thunder_streaming.feeder.batching import AdaptiveBatchController, ClockAlignedEmission
+from thunder_streaming.feeder.batching import EmissionPolicy, FixedSizeBatches
+from thunder_streaming.feeder.feeders import Feeder, TimepointMatcher, CopyAndMoveFeeder, SyncSeriesFeeder
+from thunder_streaming.feeder.framing import pack_header
+from thunder_streaming.feeder.queuespec import QueueSpec
+from thunder_streaming.feeder.shmring import RingWriter
+from thunder_streaming.feeder.stages import StagePipeline
+from thunder_streaming.feeder.transpose import transpose_matches_to_series_arrays
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import global_metrics
+from thunder_streaming.feeder.utils.prefetch import read_file
+
+
+def _contents_reader(contents):
+    """Returns a reader function for the functions in transpose.py, taking file contents from the passed dict of
+    filename to contents where present.
+    """
+    def reader(filename, dtype):
+        data = contents.get(filename)
+        if data is None:
+            data = read_file(filename)
+        dtype = np.dtype(dtype)
+        return np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+    return reader
+
+
+class Sink(Thread):
+    """Abstract daemon thread that receives batches of matched timepoints from a FanOutFeeder, and writes them out.
+
+    Subclasses implement emit(), and should set needs_data to True if they use the contents of the input files.
+
+    Parameters
+    ----------
+    name: string
+        Name of this sink, for log messages.
+    emission_policy: EmissionPolicy, optional
+        Decides how many timepoints to write out at a time. By default, all received timepoints are written out
+        immediately.
+    queue_size: int
+        Maximum number of batches waiting to be written out. Batches received while the queue is full are dropped.
+    clean_time: float
+        Time between calls to clean() in s.
+    """
+    needs_data = False
+
+    def __init__(self, name, emission_policy=None, queue_size=16, clean_time=1.0):
+        Thread.__init__(self, name="sink-" + name)
+        self.setDaemon(True)
+        self.sink_name = name
+        self.emission_policy = emission_policy if emission_policy is not None else EmissionPolicy()
+        self.clean_time = float(clean_time)
+        self._queue = Queue(queue_size)
+        self._removed = deque()
+        self.ndropped = 0
+        self._emit_timer = global_metrics.histogram("feeder_sink_emit_seconds", "Time each sink spends writing out "
+                                                    "a batch", sink=name)
+        global_metrics.gauge_callback("feeder_sink_queue_depth", self._queue.qsize,
+                                      "Batches waiting to be written out by each sink", sink=name)
+        global_metrics.counter_callback("feeder_sink_dropped_timepoints_total", lambda: self.ndropped,
+                                        "Timepoints dropped by each sink", sink=name)
+
+    def submit(self, matches, contents):
+        """Queues the passed matches, a list of (timepoint, {qname: filename}) pairs sorted by timepoint, to be
+        written out. contents is a dict of filename to file contents as a string, which is empty unless
+        needs_data is set.
+
+        Returns False if the sink's queue is full and the matches have been dropped, True otherwise.
+        """
+        try:
+            self._queue.put_nowait((time.time(), matches, contents))
+            return True
+        except Full:
+            self.ndropped += len(matches)
+            global_logger.get().warn("Sink '%s' is falling behind, dropped %d timepoint(s) (%d in total)",
+                                     self.sink_name, len(matches), self.ndropped)
+            return False
+
+    def emit(self, matches, contents):
+        """Abstract method that writes out the passed matches, as passed to submit(), as a single batch.
+        """
+        raise NotImplementedError
+
+    def clean(self):
+        """Performs any required cleanup, returning a list of filenames deleted, as for Feeder.clean().
+        """
+        return []
+
+    def drain_removed(self):
+        """Returns the names of files removed by this sink's clean() since the last call.
+        """
+        removed = []
+        while self._removed:
+            removed.append(self._removed.popleft())
+        return removed
+
+    def run(self):
+        held = []  # list of (arrival time, match)
+        contents = {}
+        next_clean_time = time.time() + self.clean_time
+        while True:
+            timeout = self.clean_time
+            check_time = self.emission_policy.next_check_time(len(held), time.time())
+            if check_time is not None:
+                timeout = min(timeout, max(0.001, check_time - time.time()))
+            try:
+                arrival, matches, batch_contents = self._queue.get(timeout=timeout)
+                self.emission_policy.record_arrivals(len(matches), arrival)
+                held.extend((arrival, match) for match in matches)
+                contents.update(batch_contents)
+            except Empty:
+                pass
+
+            while held:
+                nready = self.emission_policy.nready(len(held), held[0][0], time.time())
+                if not nready:
+                    break
+                ready = [match for _, match in held[:nready]]
+                del held[:nready]
+                start = time.time()
+                try:
+                    self.emit(ready, contents)
+                except Exception:
+                    global_logger.get().exception("Error writing out %d timepoint(s) in sink '%s'",
+                                                  len(ready), self.sink_name)
+                elapsed = time.time() - start
+                self._emit_timer.observe(elapsed)
+                self.emission_policy.record_publish(len(ready), elapsed)
+                for _, qname_to_filename in ready:
+                    for filename in qname_to_filename.itervalues():
+                        contents.pop(filename, None)
+
+            if time.time() >= next_clean_time:
+                self._removed.extend(self.clean())
+                next_clean_time = time.time() + self.clean_time
+
+    @staticmethod
+    def fromSpec(spec, filename_parser=None, qnames=None):
+        """Factory to instantiate a Sink from a specification string "kind:outdir[:key=value...]".
+
+        kind is one of 'raw', 'series', 'socket', 'shm' or 'archive'. For socket sinks, outdir is instead a ZeroMQ
+        endpoint such as "tcp://localhost:5557", and for shm sinks a ring buffer file such as "/dev/shm/feeder".
+        Recognized keys are:
+        * batch: number of timepoints per output file
+        * wait: maximum time in s to wait for a full batch
+        * latency: target latency in s, to choose the number of timepoints per output file with an
+          AdaptiveBatchController, in which case 'batch' gives the maximum
+        * align: Spark batch time in s, to write out one file shortly before each batch boundary with a
+          ClockAlignedEmission; takes precedence over the above
+        * linger: time in s to keep output files before deleting them
+        * queue: maximum number of batches waiting to be written out
+        and for series sinks, which are keyed if either shape or linear is given:
+        * shape: comma-separated dimensions, for subscript keys
+        * linear: 1 for linear keys
+        * dtype, indtype: output and input data types
+        * specs: queue spec file giving per-queue input decoding, as read by QueueSpec.fromFile()
+        * stages: pre-reduction stages for the first queue, as for StagePipeline.fromSpec(); since stage
+          specifications contain ':', this must be the last key
+        and for socket sinks, which take the same keys as series sinks apart from linger:
+        * bind: 1 to bind to the endpoint rather than connect to it
+        * hwm: send high-water mark, in batches
+        * timeout: time in s after which a batch that cannot be sent is dropped
+        and for shm sinks, which take the same keys as series sinks apart from linger:
+        * slots: number of batches held in the ring buffer
+        * slotmb: maximum size of a batch in MB
+        and for archive sinks, for which linger is ignored:
+        * chunk: number of timepoints per compressed chunk
+        * codec: compression codec, one of the keys of archive.CODECS
+        * level: compression level
+
+        qnames gives the queue names in order, as for SyncSeriesFeeder prefixes.
+        """
+        parts = spec.split(":")
+        if len(parts) < 2:
+            raise ValueError("Sink specification must be of the form 'kind:outdir[:key=value...]', got '%s'" % spec)
+        kind = parts[0]
+        # the target may itself contain ':', as in "tcp://host:port"
+        firstparam = 2
+        while firstparam < len(parts) and "=" not in parts[firstparam]:
+            firstparam += 1
+        outdir = ":".join(parts[1:firstparam])
+        params = {}
+        for partidx in xrange(firstparam, len(parts)):
+            key, sep, value = parts[partidx].partition("=")
+            if not sep:
+                raise ValueError("Expected key=value in sink specification '%s', got '%s'" % (spec, parts[partidx]))
+            if key == "stages":
+                params[key] = ":".join([value] + parts[partidx+1:])
+                break
+            params[key] = value
+
+        emission_policy = None
+        batch = int(params.pop("batch", -1))
+        wait = float(params.pop("wait", -1.0))
+        latency = float(params.pop("latency", -1.0))
+        align = float(params.pop("align", -1.0))
+        if align > 0:
+            emission_policy = ClockAlignedEmission(align)
+        elif latency > 0:
+            emission_policy = AdaptiveBatchController(latency, max_batch=batch)
+        elif batch > 0:
+            emission_policy = FixedSizeBatches(batch, max_wait=wait)
+        common = dict(linger_time=float(params.pop("linger", 5.0)), emission_policy=emission_policy,
+                      queue_size=int(params.pop("queue", 16)))
+
+        if kind == "raw":
+            sink = RawCopySink(outdir, **common)
+        elif kind in ("series", "socket", "shm"):
+            shape = params.pop("shape", None)
+            stages = params.pop("stages", None)
+            specs = params.pop("specs", None)
+            series_params = dict(shape=tuple(int(dim) for dim in shape.split(",")) if shape else None,
+                                 linear=bool(int(params.pop("linear", 0))),
+                                 dtype=params.pop("dtype", "uint16"),
+                                 indtype=params.pop("indtype", "uint16"),
+                                 stages=StagePipeline.fromSpec(stages) if stages else None,
+                                 queue_specs=QueueSpec.fromFile(specs) if specs else None)
+            series_params.update(common)
+            if kind == "series":
+                sink = SeriesSink(outdir, qnames, filename_parser=filename_parser, **series_params)
+            elif kind == "shm":
+                del series_params["linger_time"]
+                sink = ShmRingSink(outdir, qnames,
+                                   nslots=int(params.pop("slots", 8)),
+                                   slot_bytes=int(float(params.pop("slotmb", 64)) * 1024 * 1024),
+                                   **series_params)
+            else:
+                del series_params["linger_time"]
+                sink = SocketSink(outdir, qnames,
+                                  bind=bool(int(params.pop("bind", 0))),
+                                  hwm=int(params.pop("hwm", 10)),
+                                  send_timeout=float(params.pop("timeout", -1.0)),
+                                  **series_params)
+        elif kind == "archive":
+            del common["linger_time"]
+            sink = ArchiveSink(outdir, qnames,
+                               chunk_timepoints=int(params.pop("chunk", 100)),
+                               codec=params.pop("codec", "zlib"),
+                               level=int(params.pop("level", 6)),
+                               **common)
+        else:
+            raise ValueError("Unknown sink kind '%s' in '%s'; expected 'raw', 'series', 'socket', 'shm' or "
+                             "'archive'" % (kind, spec))
+        if params:
+            raise ValueError("Unrecognized key(s) %s in sink specification '%s'" % (", ".join(sorted(params)), spec))
+        return sink
+
+
+class RawCopySink(Sink):
+    """Sink that publishes the input files themselves into an output directory, as CopyAndMoveFeeder does.
+    """
+    def __init__(self, output_dir, linger_time=5.0, emission_policy=None, queue_size=16):
+        super(RawCopySink, self).__init__("raw:" + output_dir, emission_policy=emission_policy, queue_size=queue_size)
+        self.feeder = CopyAndMoveFeeder(output_dir, linger_time)
+
+    def emit(self, matches, contents):
+        filenames = [filename for _, qname_to_filename in matches for filename in qname_to_filename.itervalues()]
+        filenames.sort()
+        self.feeder.feed(filenames)
+        global_logger.get().info("Sink '%s' pushed %d files", self.sink_name, len(filenames))
+
+    def clean(self):
+        return self.feeder.clean()
+
+
+class SeriesSink(Sink):
+    """Sink that writes matched timepoints out as Series binary files, as SyncSeriesFeeder does, from the
+    file contents read by the FanOutFeeder.
+
+    If either shape or linear is given, the output records are keyed; otherwise they are plain transposed
+    values. See SyncSeriesFeeder.
+    """
+    needs_data = True
+
+    def __init__(self, output_dir, prefixes, linger_time=5.0, shape=None, linear=False, dtype='uint16',
+                 indtype='uint16', stages=None, filename_parser=None, emission_policy=None, queue_size=16,
+                 queue_specs=None):
+        super(SeriesSink, self).__init__("series:" + output_dir, emission_policy=emission_policy,
+                                         queue_size=queue_size)
+        self.prefixes = list(prefixes)
+        stages = {self.prefixes[0]: stages} if stages is not None else None
+        self.feeder = SyncSeriesFeeder(output_dir, linger_time, self.prefixes, shape=shape, linear=linear,
+                                       dtype=dtype, indtype=indtype, filename_parser=filename_parser, stages=stages,
+                                       queue_specs=queue_specs)
+
+    def emit(self, matches, contents):
+        arrays, fullnames, newname = self.feeder.series_arrays(matches, reader=_contents_reader(contents))
+        self.feeder.publish_series(arrays, newname)
+        global_logger.get().info("Sink '%s' pushed %d files as %s", self.sink_name, len(fullnames), newname)
+
+    def clean(self):
+        return self.feeder.clean()
+
+
+class SocketSink(Sink):
+    """Sink that sends matched timepoints as batches of Series records over a ZeroMQ PUSH socket, framed as
+    described in framing.py, instead of writing files.
+
+    The socket's send high-water mark, hwm, bounds the number of batches queued for a receiver that is not keeping
+    up. Once it is reached, sends block, and so further batches wait in (and are eventually dropped from) this sink's
+    own queue. If send_timeout is positive, a batch that cannot be sent within that many seconds is dropped instead.
+
+    See testutils/socket_receiver.py for a stand-in receiver.
+    """
+    needs_data = True
+
+    def __init__(self, endpoint, prefixes, shape=None, linear=False, dtype='uint16', indtype='uint16', stages=None,
+                 bind=False, hwm=10, send_timeout=-1.0, emission_policy=None, queue_size=16, queue_specs=None):
+        super(SocketSink, self).__init__("socket:" + endpoint, emission_policy=emission_policy,
+                                         queue_size=queue_size)
+        self.endpoint = endpoint
+        self.prefixes = list(prefixes)
+        self.shape = shape
+        self.linear = linear
+        self.dtype = dtype
+        self.indtype = indtype
+        self.stages = {self.prefixes[0]: stages} if stages is not None else {}
+        self.queue_specs = queue_specs
+        self.bind = bind
+        self.hwm = int(hwm)
+        self.send_timeout = float(send_timeout)
+        if linear:
+            self.nkeys = 1
+        else:
+            self.nkeys = len(shape) if shape else 0
+        # ZeroMQ sockets may only be used from one thread, so this is created on the sink thread
+        self._socket = None
+        self.nsent = 0
+
+    def _get_socket(self):
+        if self._socket is None:
+            import zmq
+            socket = zmq.Context.instance().socket(zmq.PUSH)
+            socket.setsockopt(zmq.SNDHWM, self.hwm)
+            socket.setsockopt(zmq.LINGER, 1000)
+            if self.send_timeout > 0:
+                socket.setsockopt(zmq.SNDTIMEO, int(self.send_timeout * 1000))
+            if self.bind:
+                socket.bind(self.endpoint)
+            else:
+                socket.connect(self.endpoint)
+            self._socket = socket
+        return self._socket
+
+    def emit(self, matches, contents):
+        import zmq
+        arrays, fullnames, recordsize = transpose_matches_to_series_arrays(
+            matches, self.prefixes, shape=self.shape, linear=self.linear, dtype=self.dtype, indtype=self.indtype,
+            stages=self.stages, reader=_contents_reader(contents), queue_specs=self.queue_specs)
+        if not arrays:
+            return
+        # records with keys mix key and value types, so concatenate as bytes
+        buf = np.concatenate([np.ascontiguousarray(ary).reshape(-1).view(np.uint8) for ary in arrays])
+        header = pack_header(recordsize, buf.nbytes // recordsize, self.dtype, nkeys=self.nkeys)
+        try:
+            self._get_socket().send_multipart([header, buf], copy=False)
+            self.nsent += 1
+        except zmq.Again:
+            self.ndropped += len(matches)
+            global_logger.get().warn("Sink '%s' could not send within %g s, dropped %d timepoint(s) (%d in total)",
+                                     self.sink_name, self.send_timeout, len(matches), self.ndropped)
+
+
+class ShmRingSink(Sink):
+    """Sink that writes matched timepoints as batches of Series records into a shared memory ring buffer, for a
+    consumer on the same node to read without copies. See shmring.py.
+
+    The ring never blocks the sink; a consumer that falls behind loses the oldest batches.
+    """
+    needs_data = True
+
+    def __init__(self, path, prefixes, shape=None, linear=False, dtype='uint16', indtype='uint16', stages=None,
+                 nslots=8, slot_bytes=64*1024*1024, emission_policy=None, queue_size=16, queue_specs=None):
+        super(ShmRingSink, self).__init__("shm:" + path, emission_policy=emission_policy, queue_size=queue_size)
+        self.prefixes = list(prefixes)
+        self.shape = shape
+        self.linear = linear
+        self.dtype = dtype
+        self.indtype = indtype
+        self.stages = {self.prefixes[0]: stages} if stages is not None else {}
+        self.queue_specs = queue_specs
+        if linear:
+            self.nkeys = 1
+        else:
+            self.nkeys = len(shape) if shape else 0
+        self.writer = RingWriter(path, nslots=nslots, slot_bytes=slot_bytes)
+
+    def emit(self, matches, contents):
+        arrays, fullnames, recordsize = transpose_matches_to_series_arrays(
+            matches, self.prefixes, shape=self.shape, linear=self.linear, dtype=self.dtype, indtype=self.indtype,
+            stages=self.stages, reader=_contents_reader(contents), queue_specs=self.queue_specs)
+        if not arrays:
+            return
+        try:
+            seq = self.writer.write(arrays, recordsize, self.dtype, nkeys=self.nkeys)
+        except ValueError, e:
+            self.ndropped += len(matches)
+            global_logger.get().warn("Sink '%s' dropped %d timepoint(s): %s", self.sink_name, len(matches), e)
+            return
+        global_logger.get().info("Sink '%s' wrote %d files as batch %d", self.sink_name, len(fullnames), seq)
+
+
+class ArchiveSink(Sink):
+    """Sink that appends the input frames to a chunked, compressed archive, as written by ArchiveWriter.
+
+    Partial chunks are written out once their first timepoint has waited for max_chunk_wait seconds, and when the
+    process exits.
+    """
+    needs_data = True
+
+    def __init__(self, archive_dir, qnames, chunk_timepoints=100, codec="zlib", level=6, nworkers=2,
+                 max_chunk_wait=60.0, emission_policy=None, queue_size=16):
+        super(ArchiveSink, self).__init__("archive:" + archive_dir, emission_policy=emission_policy,
+                                          queue_size=queue_size)
+        self.writer = ArchiveWriter(archive_dir, qnames, chunk_timepoints=chunk_timepoints, codec=codec,
+                                    level=level, nworkers=nworkers, max_chunk_wait=max_chunk_wait)
+        atexit.register(self.writer.close)
+
+    def emit(self, matches, contents):
+        for timepoint, qname_to_filename in matches:
+            frames = []
+            arrival_time = None
+            for qname in self.writer.qnames:
+                filename = qname_to_filename[qname]
+                data = contents.get(filename)
+                frames.append(data if data is not None else read_file(filename))
+                try:
+                    arrival_time = max(arrival_time, os.stat(filename).st_mtime)
+                except OSError:
+                    pass
+            self.writer.append(timepoint, frames, arrival_time)
+
+    def clean(self):
+        self.writer.flush_if_stale()
+        return []
+
+
+class FanOutFeeder(TimepointMatcher, Feeder):
+    """A Feeder that matches files by timepoint as SyncCopyAndMoveFeeder does, reads each matched file once,
+    and passes the matched timepoints to each of the passed sinks.
+
+    Files are only read if some sink needs their contents, through the passed Prefetcher if given.
+
+    A timepoint is reported as pushed once it has been passed to the sinks, whether or not any sink has since
+    dropped it.
+    """
+    def __init__(self, sinks, qnames, filename_parser=None, check_file_size=False, check_skip_in_sequence=True,
+                 prefetcher=None):
+        TimepointMatcher.__init__(self, qnames, filename_parser=filename_parser,
+                                  check_file_size_mismatch=check_file_size,
+                                  check_skip_in_sequence=check_skip_in_sequence)
+        self.sinks = list(sinks)
+        self.prefetcher = prefetcher
+        for sink in self.sinks:
+            sink.start()
+
+    def feed(self, filenames):
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(filenames)
+        matches = self.match_timepoints(filenames)
+        if not matches:
+            return []
+        fullnames = [filename for _, qname_to_filename in matches for filename in qname_to_filename.itervalues()]
+        fullnames.sort()
+
+        contents = {}
+        if any(sink.needs_data for sink in self.sinks):
+            for filename in fullnames:
+                if self.prefetcher is not None:
+                    contents[filename] = self.prefetcher.fromfile(filename, np.uint8).tostring()
+                else:
+                    contents[filename] = read_file(filename)
+            if self.prefetcher is not None:
+                self.prefetcher.release(fullnames)
+
+        for sink in self.sinks:
+            sink.submit(matches, contents)
+        return fullnames
+
+    def clean(self):
+        """Returns the names of files removed by any sink since the last call. Sinks clean up on their own threads.
+        """
+        removed = []
+        for sink in self.sinks:
+            removed.extend(sink.drain_removed())
+        removed.sort()
+        return removed
@@ -0,0 +1,219 @@
+"""Vectorized pre-reduction stages, applied to batches of frames before they are written out as Thunder series.
+
+A stage operates on a batch buffer: a 2d numpy array of shape (ntimepoints, nelements), where each row holds
+a single flattened input frame, already converted to the output dtype of the feeder. Stages modify this buffer
+in place and may keep state across batches (for instance a running baseline).
+
+Stages are chained together in a StagePipeline, which checks that each stage accepts the output of the previous
+one, leaving the shape and dtype of frames unchanged, and keeps track of time spent in each stage.
+
+Pipelines can be built from a string specification, as passed to the feeder scripts with the --stages option:
+    detrend:0.01,clip:-500:500
+Each comma-separated element gives a stage name, followed by colon-separated numeric arguments to the stage
+constructor. See STAGES for the available stage names.
+"""
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+
+class Stage(object):
+    """Superclass for a single step in a StagePipeline.
+
+    Stages that keep state across batches must set 'stateful', since they must then see every batch, in order.
+    """
+    name = None
+    stateful = False
+
+    def output_spec(self, shape, dtype):
+        """Returns the (shape, dtype) of frames produced by this stage, given frames of the passed shape and dtype.
+
+        Shapes here are the shape of a single frame, not including the leading batch (timepoint) dimension.
+
+        Implementations should raise ValueError if frames of the passed shape and dtype cannot be processed.
+        This implementation declares that frames are passed through with shape and dtype unchanged.
+        """
+        return tuple(shape), np.dtype(dtype)
+
+    def process(self, batch):
+        """Abstract method that processes the passed 2d batch buffer in place.
+
+        Implementations should return the processed batch, which is expected to be either the passed buffer
+        itself or a view on it.
+        """
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name or self.__class__.__name__
+
+
+class ClipStage(Stage):
+    """Clips all values in the batch to the closed interval [minval, maxval].
+    """
+    name = "clip"
+
+    def __init__(self, minval, maxval):
+        self.minval = minval
+        self.maxval = maxval
+
+    def process(self, batch):
+        np.clip(batch, self.minval, self.maxval, out=batch)
+        return batch
+
+
+class _RunningBaselineStage(Stage):
+    """Abstract stage that maintains a per-element running baseline across batches, updated as an exponential
+    moving average with weight 'alpha' given to each new frame.
+
+    Each frame is processed against the baseline of the frames before it, and only then added to the baseline.
+    """
+    stateful = True
+
+    def __init__(self, alpha=0.01):
+        alpha = float(alpha)
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("Baseline weight must be in (0, 1], got %g" % alpha)
+        self.alpha = alpha
+        self.baseline = None
+
+    def output_spec(self, shape, dtype):
+        if np.dtype(dtype).kind != 'f':
+            raise ValueError("Stage '%s' requires floating point data, got dtype '%s'; " % (self, np.dtype(dtype)) +
+                             "set a floating point output dtype with --dtype")
+        return super(_RunningBaselineStage, self).output_spec(shape, dtype)
+
+    def _update_frame(self, frame):
+        raise NotImplementedError
+
+    def process(self, batch):
+        if self.baseline is None or self.baseline.shape != batch.shape[1:]:
+            self.baseline = batch[0].astype('float64')
+        for frame in batch:
+            raw = frame.astype('float64')
+            self._update_frame(frame)
+            self.baseline *= (1.0 - self.alpha)
+            self.baseline += self.alpha * raw
+        return batch
+
+
+class DetrendStage(_RunningBaselineStage):
+    """Removes slow drifts by subtracting a running baseline from each element.
+    """
+    name = "detrend"
+
+    def _update_frame(self, frame):
+        frame -= self.baseline
+
+
+class DffStage(_RunningBaselineStage):
+    """Converts raw fluorescence to dF/F, (F - F0) / F0, where F0 is a running baseline.
+
+    Elements with a zero baseline are set to zero.
+    """
+    name = "dff"
+
+    def _update_frame(self, frame):
+        frame -= self.baseline
+        np.divide(frame, self.baseline, out=frame, where=(self.baseline != 0))
+        frame[self.baseline == 0] = 0
+
+
+STAGES = {
+    ClipStage.name: ClipStage,
+    DetrendStage.name: DetrendStage,
+    DffStage.name: DffStage,
+}
+
+
+class StagePipeline(object):
+    """An ordered sequence of Stages, applied in turn to each batch.
+
+    The pipeline checks the declared input and output of each stage against the incoming batch whenever the
+    shape or dtype of batches changes, and accumulates the time spent in each stage, which maybe_report() logs at
+    most every report_interval s.
+    """
+    def __init__(self, stages, report_interval=30.0):
+        self.stages = list(stages)
+        self.report_interval = float(report_interval)
+        self._validated_spec = None
+        self.stage_times = [0.0] * len(self.stages)
+        self.nbatches = 0
+        self._last_report = time.time()
+
+    @classmethod
+    def fromSpec(cls, spec):
+        """Factory to build a StagePipeline from a string specification such as 'detrend:0.01,clip:-500:500'.
+        """
+        stages = []
+        for stage_spec in spec.split(','):
+            stage_spec = stage_spec.strip()
+            if not stage_spec:
+                continue
+            splits = stage_spec.split(':')
+            name, args = splits[0], [float(arg) for arg in splits[1:]]
+            if name not in STAGES:
+                raise ValueError("Unknown stage '%s'; available stages are: %s" %
+                                 (name, ", ".join(sorted(STAGES.iterkeys()))))
+            stages.append(STAGES[name](*args))
+        return cls(stages)
+
+    def validate(self, shape, dtype):
+        """Checks that the stages in this pipeline can be chained together, starting from frames of the passed
+        shape and dtype.
+
+        Raises ValueError if a stage does not accept the frames produced by the previous stage, or if a stage
+        would change the shape or dtype of the batch, which cannot be done in place: the transposed output is
+        sized from the input frames.
+        """
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        for stage in self.stages:
+            outshape, outdtype = stage.output_spec(shape, dtype)
+            if outdtype != dtype:
+                raise ValueError("Stage '%s' would convert dtype '%s' to '%s'; stages must run in place" %
+                                 (stage, dtype, outdtype))
+            if tuple(outshape) != shape:
+                raise ValueError("Stage '%s' would change the frame shape from %s to %s; stages must run in place" %
+                                 (stage, shape, tuple(outshape)))
+            shape, dtype = tuple(outshape), outdtype
+        return shape, dtype
+
+    def run(self, batch):
+        """Applies each stage in turn to the passed 2d batch buffer, returning the processed batch.
+        """
+        spec = (batch.shape[1:], batch.dtype)
+        if spec != self._validated_spec:
+            self.validate(*spec)
+            self._validated_spec = spec
+        for stageidx, stage in enumerate(self.stages):
+            start = time.time()
+            batch = stage.process(batch)
+            self.stage_times[stageidx] += time.time() - start
+        self.nbatches += 1
+        return batch
+
+    def maybe_report(self, label=""):
+        if self.report_interval > 0 and time.time() - self._last_report >= self.report_interval:
+            self.report(label)
+
+    def report(self, label=""):
+        """Logs the mean time per batch spent in each stage.
+        """
+        self._last_report = time.time()
+        if not self.nbatches:
+            return
+        timings = ", ".join("%s %.2f ms" % (stage, 1000.0 * tottime / self.nbatches)
+                            for stage, tottime in zip(self.stages, self.stage_times))
+        global_logger.get().info("Mean stage times per batch%s over %d batches: %s",
+                                 " for '%s'" % label if label else "", self.nbatches, timings)
+
+    @property
+    def stateful(self):
+        return any(stage.stateful for stage in self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __str__(self):
+        return ",".join(str(stage) for stage in self.stages)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""A throughput and latency benchmark of the feeder scripts in feeder/bin, run against synthetic sessions.
+
+For each mode benchmarked, a synthetic session of image frames, and for the grouping modes of matching behaviour
+files, is written into a fresh input directory at a fixed frame rate, while the feeder script of that mode runs as a
+child process. Once every frame has been published into the output directory, or a timeout has expired, the feeder
+is interrupted and the following are reported:
+* frames/s and bytes/s: frames and input bytes published, over the time from the first frame written to the last
+  frame published. With --rate 0, frames are written as fast as possible, so that these measure the maximum
+  throughput of the feeder rather than the frame rate.
+* p50, p99 and max latency from each frame's files having been written to its being published.
+* peak RSS of the feeder process, or of the largest of its stage processes when run as a multi-process pipeline
+  (which includes the shared memory slots it touches).
+* metrics overhead: the time spent recording metrics (see feeder/utils/metrics.py), as a fraction of the time spent
+  in the timed steps of the feeder. The number of steps and the time they took are read from the metrics that the
+  feeder dumps with --metrics-file, and the cost of recording a step is timed in this process, both with recording
+  on, as in the benchmarked feeders, and off, as when no metrics are exported.
+
+Publish times are read from the manifests written by the series modes (see feeder/manifest.py). For the copy modes,
+the output directory is listed every --watch-time s, and each file published is stamped with the time it was first
+seen, which is late by at most that interval; modification times cannot be used, as files published as hard links
+(--link-files) keep those of their input files. Input and output directories are kept in the same temporary
+directory, so should be on the same filesystem as they would be on the rig; use --tmpdir to choose it.
+
+Frames are drawn from a small pool of random frames generated up front from --seed, so that the same options always
+write the same session. Results are written as JSON, labelled with the current git commit, so that runs at different
+commits can be compared with --compare.
+
+Usage is:
+python feeder_benchmark.py [options]
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from threading import Event, Thread
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.manifest import is_manifest_name, read_manifest
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.metrics import MetricsRegistry
+
+# mode -> (script in feeder/bin, whether behaviour files are matched, whether output is series)
+MODES = OrderedDict([
+    ("copy", ("stream_feeder.py", False, False)),
+    ("grouping-copy", ("grouping_stream_feeder.py", True, False)),
+    ("series", ("series_stream_feeder.py", False, True)),
+    ("grouping-series", ("grouping_series_stream_feeder.py", True, True)),
+])
+
+# Number of distinct random frames written, in turn
+POOL_SIZE = 8
+
+# Name of the file each feeder dumps its metrics to in its working directory, and the interval between dumps in s
+METRICS_FILE = "metrics.jsonl"
+METRICS_INTERVAL = 0.5
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin")
+PYTHON_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+
+class Session(object):
+    """A synthetic acquisition session: nframes image frames of the passed shape and dtype, each optionally with a
+    behaviour file of nbehav values, written at a fixed rate.
+    """
+    def __init__(self, shape, dtype, nframes, rate, nbehav, seed):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nframes = nframes
+        self.rate = rate
+        self.nbehav = nbehav
+        rng = np.random.RandomState(seed)
+        maxval = min(np.iinfo(self.dtype).max, 4095) if self.dtype.kind in 'ui' else 1.0
+        self.frames = [(rng.rand(int(np.prod(self.shape))) * maxval).astype(self.dtype) for _ in xrange(POOL_SIZE)]
+        self.behavs = [(rng.rand(nbehav) * maxval).astype(self.dtype) for _ in xrange(POOL_SIZE)]
+
+    def frame_bytes(self, grouping):
+        return self.frames[0].nbytes + (self.behavs[0].nbytes if grouping else 0)
+
+    def write(self, imgdir, behavdir=None):
+        """Writes the session into the passed directories, returning the time before the first frame was written and
+        a list of the time each frame's files had been written.
+        """
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        written = []
+        start = time.time()
+        for idx in xrange(self.nframes):
+            delay = start + idx * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.frames[idx % POOL_SIZE].tofile(os.path.join(imgdir, "img_%06d.bin" % idx))
+            if behavdir:
+                self.behavs[idx % POOL_SIZE].tofile(os.path.join(behavdir, "behav_%06d.bin" % idx))
+            written.append(time.time())
+        return start, written
+
+
+def feeder_command(mode, session, imgdir, behavdir, outdir, metrics_file, opts):
+    script, grouping, series = MODES[mode]
+    cmd = [sys.executable, os.path.join(BIN_DIR, script), imgdir]
+    if grouping:
+        cmd.append(behavdir)
+    cmd += [outdir, "--poll-time", str(opts.poll_time), "--mod-buffer-time", str(opts.mod_buffer_time),
+            "--linger-time", "-1", "--metrics-file", metrics_file, "--metrics-interval", str(METRICS_INTERVAL)]
+    if series:
+        cmd += ["--shape"] + [str(dim) for dim in session.shape]
+        cmd += ["--indtype", session.dtype.name, "--write-manifests"]
+    if opts.feeder_args:
+        cmd += shlex.split(opts.feeder_args)
+    return cmd
+
+
+class PublishWatcher(Thread):
+    """Daemon thread keeping track of the time each frame is published into the output directory of a feeder, by
+    listing it every interval seconds until stopped; see the module documentation.
+    """
+    def __init__(self, outdir, series, files_per_frame, interval):
+        Thread.__init__(self, name="publish-watcher")
+        self.setDaemon(True)
+        self.outdir = outdir
+        self.interval = interval
+        self.series = series
+        self.files_per_frame = files_per_frame
+        self.published = {}  # frame index -> time its last file was published
+        self._seen = set()
+        self._first_seen = {}  # frame index -> times each of its files was first seen, for the copy modes
+        self._stopped = Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.poll()
+            self._stopped.wait(self.interval)
+        self.poll()
+
+    def poll(self):
+        names = os.listdir(self.outdir)
+        now = time.time()
+        for name in names:
+            if name in self._seen:
+                continue
+            if self.series:
+                if is_manifest_name(name):
+                    manifest = read_manifest(os.path.join(self.outdir, name))
+                    if manifest is None:
+                        continue
+                    for entry in manifest["timepoints"]:
+                        self.published[int(entry["timepoint"])] = manifest["published"]
+            elif not name.startswith(".") and name.endswith(".bin"):
+                idx = int(name[:-len(".bin")].rsplit("_", 1)[1])
+                times = self._first_seen.setdefault(idx, [])
+                times.append(now)
+                if len(times) == self.files_per_frame:
+                    self.published[idx] = max(times)
+            self._seen.add(name)
+
+
+def stage_totals(workdir):
+    """Returns the number of timed steps recorded by the feeder run in workdir, and the total time in s they took,
+    from the last metrics dumped by each of its processes.
+    """
+    nsteps, seconds = 0, 0.0
+    for name in os.listdir(workdir):
+        if not name.startswith(METRICS_FILE):
+            continue
+        with open(os.path.join(workdir, name)) as fp:
+            lines = fp.read().splitlines()
+        # the last line may have been cut short when the feeder was interrupted
+        for line in reversed(lines):
+            try:
+                metrics = json.loads(line)["metrics"]
+            except ValueError:
+                continue
+            for entry in metrics:
+                if entry["name"] == "feeder_stage_seconds":
+                    nsteps += entry["count"]
+                    seconds += entry["sum"]
+            break
+    return nsteps, seconds
+
+
+def timed_step_cost(enabled=True, nsteps=100000):
+    """Returns the time in s taken to record one timed step as the feeders do: reading the clock twice, observing a
+    stage timer and incrementing a counter, with recording on or off. This includes adding up the values recorded,
+    which happens when metrics are exported.
+    """
+    registry = MetricsRegistry(enabled=enabled)
+    timer, counter = registry.stage_timer("benchmark"), registry.counter("feeder_benchmark_steps_total")
+    start = time.time()
+    for _ in xrange(nsteps):
+        step_start = time.time()
+        timer.observe(time.time() - step_start)
+        counter.inc()
+    registry.snapshot()
+    return (time.time() - start) / nsteps
+
+
+def stop_feeder(proc):
+    """Interrupts the passed feeder process, returning its peak RSS in bytes.
+    """
+    # SIGINT, so that a multi-process pipeline shuts down its stage processes
+    proc.send_signal(signal.SIGINT)
+    deadline = time.time() + 10.0
+    while time.time() < deadline:
+        pid, _, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            # ru_maxrss is in kB on Linux
+            return rusage.ru_maxrss * 1024
+        time.sleep(0.05)
+    proc.kill()
+    _, _, rusage = os.wait4(proc.pid, 0)
+    return rusage.ru_maxrss * 1024
+
+
+def run_mode(mode, session, step_costs, opts):
+    _, grouping, series = MODES[mode]
+    workdir = tempfile.mkdtemp(prefix="feeder-benchmark-", dir=opts.tmpdir)
+    imgdir, behavdir, outdir = [os.path.join(workdir, name) for name in ("img", "behav", "out")]
+    for dirname in (imgdir, behavdir, outdir):
+        os.mkdir(dirname)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([PYTHON_ROOT] + filter(None, [env.get("PYTHONPATH")]))
+    with open(os.path.join(workdir, "feeder.log"), "w") as log:
+        cmd = feeder_command(mode, session, imgdir, behavdir, outdir, os.path.join(workdir, METRICS_FILE), opts)
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            time.sleep(opts.startup_time)
+            watcher = PublishWatcher(outdir, series, 2 if grouping else 1, opts.watch_time)
+            watcher.start()
+            try:
+                start, written = session.write(imgdir, behavdir if grouping else None)
+                deadline = time.time() + opts.timeout
+                while len(watcher.published) < session.nframes and time.time() < deadline and proc.poll() is None:
+                    time.sleep(opts.watch_time)
+            finally:
+                watcher.stop()
+            published = watcher.published
+        finally:
+            peak_rss = stop_feeder(proc) if proc.returncode is None else None
+    nsteps, stage_seconds = stage_totals(workdir)
+    if opts.keep:
+        print "Kept input, output and feeder log of mode '%s' in %s" % (mode, workdir)
+    else:
+        shutil.rmtree(workdir)
+
+    latencies = np.array([published[idx] - written[idx] for idx in published if idx < len(written)])
+    result = OrderedDict([("frames_written", session.nframes), ("frames_published", len(latencies))])
+    if len(latencies):
+        elapsed = max(published.values()) - start
+        result["frames_per_s"] = len(latencies) / elapsed
+        result["bytes_per_s"] = len(latencies) * session.frame_bytes(grouping) / elapsed
+        result["latency_p50_s"], result["latency_p99_s"] = np.percentile(latencies, (50, 99))
+        result["latency_max_s"] = latencies.max()
+    result["peak_rss_bytes"] = peak_rss
+    for key, step_cost in zip(("metrics_overhead", "metrics_off_overhead"), step_costs):
+        result[key] = nsteps * step_cost / stage_seconds if stage_seconds else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PYTHON_ROOT,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    columns = ("frames_published", "frames_per_s", "bytes_per_s", "latency_p50_s", "latency_p99_s",
+               "peak_rss_bytes", "metrics_overhead", "metrics_off_overhead")
+    print "%-16s" % "mode" + "".join("%21s" % column for column in columns)
+    for mode, result in results.iteritems():
+        print "%-16s" % mode + "".join("%21s" % _format(result.get(column)) for column in columns)
+        if previous and mode in previous:
+            changes = []
+            for column in columns:
+                new, old = result.get(column), previous[mode].get(column)
+                changes.append("%+.1f%%" % (100.0 * (new - old) / old) if new is not None and old else "")
+            print "%-16s" % "  vs previous" + "".join("%21s" % change for change in changes)
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "%.4g" % value
+    return str(value)
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--modes", default=",".join(MODES),
+                      help="Comma-separated feeder modes to benchmark, from %s; default all" % ", ".join(MODES))
+    parser.add_option("--shape", type="int", nargs=3, default=(256, 256, 4),
+                      help="Shape of an image frame in x, y, z order, default %default")
+    parser.add_option("--dtype", default="uint16",
+                      help="Data type of images and behaviour values, default %default")
+    parser.add_option("--behav-values", type="int", default=16,
+                      help="Number of values in each behaviour file, for the grouping modes, default %default")
+    parser.add_option("--frames", type="int", default=200,
+                      help="Number of frames in the session, default %default")
+    parser.add_option("--rate", type="float", default=20.0,
+                      help="Frames written per s (zero writes frames as fast as possible), default %default")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed of the random frames, default %default")
+    parser.add_option("--poll-time", type="float", default=0.05,
+                      help="Poll time of the feeder in s, default %default")
+    parser.add_option("--mod-buffer-time", type="float", default=0.1,
+                      help="Modification buffer time of the feeder in s, default %default")
+    parser.add_option("--feeder-args", default=None,
+                      help="Further arguments passed to each feeder script, for instance '--transform-workers 2'")
+    parser.add_option("--watch-time", type="float", default=0.005,
+                      help="Time in s between listings of the output directory, which bounds the error of the " +
+                           "publish times of the copy modes, default %default")
+    parser.add_option("--startup-time", type="float", default=2.0,
+                      help="Time in s given to each feeder to start before frames are written, default %default")
+    parser.add_option("--timeout", type="float", default=30.0,
+                      help="Time in s to wait for frames to be published after the last one is written, " +
+                           "default %default")
+    parser.add_option("--tmpdir", default=None,
+                      help="Directory in which input and output directories are created, default the system's")
+    parser.add_option("--keep", action="store_true", default=False,
+                      help="If set, keep input and output directories and feeder logs")
+    parser.add_option("-o", "--output", default=None,
+                      help="File to write results to as JSON")
+    parser.add_option("--compare", default=None,
+                      help="JSON results of a previous run to compare with")
+    parser.add_option("--verbose", action="store_true", default=False)
+    opts, args = parser.parse_args()
+    opts.modes = [mode.strip() for mode in opts.modes.split(",") if mode.strip()]
+    for mode in opts.modes:
+        if mode not in MODES:
+            parser.error("Unknown mode '%s', expected one of %s" % (mode, ", ".join(MODES)))
+    return opts
+
+
+def main():
+    opts = parse_options()
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO if opts.verbose else logging.WARN)
+
+    session = Session(opts.shape, opts.dtype, opts.frames, opts.rate, opts.behav_values, opts.seed)
+    step_costs = timed_step_cost(), timed_step_cost(enabled=False)
+    global_logger.get().info("Recording a timed step takes %.2g us, or %.2g us with recording off",
+                             *[cost * 1e6 for cost in step_costs])
+    results = OrderedDict()
+    for mode in opts.modes:
+        global_logger.get().info("Benchmarking mode '%s'", mode)
+        results[mode] = run_mode(mode, session, step_costs, opts)
+
+    report = OrderedDict([
+        ("commit", git_commit()),
+        ("time", time.time()),
+        ("host", socket.gethostname()),
+        ("params", OrderedDict((key, getattr(opts, key)) for key in (
+            "shape", "dtype", "behav_values", "frames", "rate", "seed", "poll_time", "mod_buffer_time",
+            "feeder_args"))),
+        ("metrics_step_cost_s", step_costs[0]),
+        ("metrics_off_step_cost_s", step_costs[1]),
+        ("results", results),
+    ])
+    previous = None
+    if opts.compare:
+        with open(opts.compare) as fp:
+            previous = json.load(fp)
+        print "Comparing with commit %s" % previous.get("commit")
+    print_results(results, previous["results"] if previous else None)
+    if opts.output:
+        with open(opts.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if [mode for mode, result in results.iteritems() if result["frames_published"] < result["frames_written"]]:
+        print >> sys.stderr, "Not all frames were published in some modes; rerun with --keep to inspect feeder logs"
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""A testing utility that writes synchronized data files for several queues, simulating an acquisition rig.
+
+Each queue (for instance images and behavioural data) gets one file per frame, named <queue>_<frame>.bin, written
+into its own directory at a fixed frame rate. File contents are taken in turn from a small pool of random buffers
+allocated up front, so that rates well beyond those of the rig can be reached.
+
+To stress-test the feeder's matching of files by timepoint and its detection of complete files, the arrival of files
+can be perturbed:
+* --jitter: each file is written up to this many seconds after its frame's scheduled time
+* --drop: fraction of files never written, leaving their frame unmatched
+* --reorder: fraction of files delayed until after the next frame's files
+* --partial: fraction of files written in two halves, --partial-delay seconds apart
+All perturbations are drawn from --seed, so that a run can be reproduced.
+
+Statistics on the rate actually achieved, and on how late files were written relative to their schedule, are
+logged every --stats-interval seconds and at the end.
+
+Usage is:
+python load_generator.py --queue img:/mnt/tmpram/feederimgs:1048576 --queue behav:/mnt/tmpram/feederbehav:2:uint16:128
+
+Queues are given as name:directory:elements per file[:dtype[:max value]], with dtype defaulting to uint16 and max
+value to 4096.
+"""
+import heapq
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.utils.logger import StreamFeederLogger as Logger
+
+
+_logger = Logger("load-generator")
+
+# Number of distinct random buffers written, in turn, for each queue
+POOL_SIZE = 8
+
+# Event kinds, in order of precedence for events due at the same time
+WRITE, FINISH = 0, 1
+
+
+class Queue(object):
+    """A queue of files of nelements values of dtype each, written into datadir.
+    """
+    def __init__(self, name, datadir, nelements, dtype="uint16", maxval=4096, files_per_subdir=0):
+        self.name = name
+        self.datadir = datadir
+        self.dtype = np.dtype(dtype)
+        self.files_per_subdir = files_per_subdir
+        self.buffers = [np.random.randint(0, maxval, int(nelements)).astype(self.dtype).tostring()
+                        for _ in xrange(POOL_SIZE)]
+
+    @classmethod
+    def fromSpec(cls, spec, files_per_subdir=0):
+        """Factory to build a Queue from a name:directory:elements[:dtype[:max value]] specification.
+        """
+        splits = spec.split(":")
+        if not 3 <= len(splits) <= 5:
+            raise ValueError("Expected queue as name:directory:elements[:dtype[:max value]], got '%s'" % spec)
+        kwargs = {}
+        if len(splits) > 3:
+            kwargs["dtype"] = splits[3]
+        if len(splits) > 4:
+            kwargs["maxval"] = int(splits[4])
+        return cls(splits[0], splits[1], int(splits[2]), files_per_subdir=files_per_subdir, **kwargs)
+
+    def path(self, frame):
+        dirname = self.datadir
+        if self.files_per_subdir > 0:
+            dirname = os.path.join(dirname, "%04d" % (frame // self.files_per_subdir))
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+        return os.path.join(dirname, "%s_%06d.bin" % (self.name, frame))
+
+    def data(self, frame):
+        return self.buffers[frame % POOL_SIZE]
+
+
+class LoadStats(object):
+    """Counts of files written and perturbed, and lateness of writes relative to their schedule.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.nframes = 0
+        self.nwritten = self.nbytes = 0
+        self.ndropped = self.nreordered = self.npartial = 0
+        self.lateness = []
+
+    def log(self, final=False):
+        elapsed = max(time.time() - self.start, 1e-9)
+        lateness = np.array(self.lateness) if self.lateness else np.zeros(1)
+        _logger.get().info("%s%d frames, %d files (%.1f frames/s, %.1f files/s, %.1f MB/s); dropped %d, reordered "
+                           "%d, partial %d; lateness p50 %.2f ms, p99 %.2f ms, max %.2f ms",
+                           "Done: " if final else "", self.nframes, self.nwritten, self.nframes / elapsed,
+                           self.nwritten / elapsed, self.nbytes / elapsed / 1e6, self.ndropped, self.nreordered,
+                           self.npartial, 1000 * np.percentile(lateness, 50), 1000 * np.percentile(lateness, 99),
+                           1000 * lateness.max())
+        if not final:
+            # lateness is reported over each interval
+            self.lateness = []
+
+
+def _sleep_until(target):
+    """Sleeps until the passed time, spinning for the last ms for precision.
+    """
+    delay = target - time.time()
+    if delay > 0.002:
+        time.sleep(delay - 0.001)
+    while time.time() < target:
+        pass
+
+
+class LoadGenerator(object):
+    """Writes a file for each of the passed queues every 1/rate s, perturbed as described in the module
+    documentation.
+    """
+    def __init__(self, queues, rate, jitter=0.0, drop=0.0, reorder=0.0, partial=0.0, partial_delay=0.2,
+                 seed=None):
+        self.queues = queues
+        self.interval = 1.0 / rate
+        self.jitter = jitter
+        self.drop = drop
+        self.reorder = reorder
+        self.partial = partial
+        self.partial_delay = partial_delay
+        self.rng = np.random.RandomState(seed)
+        self.stats = LoadStats()
+        self._events = []
+        self._seq = 0
+
+    def _push(self, due, kind, *args):
+        # seq breaks ties in order of scheduling
+        heapq.heappush(self._events, (due, kind, self._seq, args))
+        self._seq += 1
+
+    def _schedule_frame(self, frame, start):
+        due = start + frame * self.interval
+        for queue in self.queues:
+            if self.rng.rand() < self.drop:
+                self.stats.ndropped += 1
+                continue
+            offset = self.rng.rand() * self.jitter
+            if self.rng.rand() < self.reorder:
+                offset += 1.5 * self.interval
+                self.stats.nreordered += 1
+            self._push(due + offset, WRITE, queue, frame)
+
+    def _write(self, due, queue, frame):
+        data = queue.data(frame)
+        path = queue.path(frame)
+        if self.rng.rand() < self.partial:
+            split = len(data) // 2
+            with open(path, "wb") as fp:
+                fp.write(data[:split])
+            self._push(due + self.partial_delay, FINISH, path, data[split:])
+            self.stats.npartial += 1
+        else:
+            with open(path, "wb") as fp:
+                fp.write(data)
+            self.stats.nwritten += 1
+        self.stats.nbytes += len(data)
+
+    def run(self, nframes=None, runtime=None, stats_interval=10.0):
+        """Writes nframes frames, or frames for runtime s, logging statistics every stats_interval s.
+        """
+        start = self.stats.start = time.time()
+        end_frame = nframes if nframes is not None else int(runtime / self.interval)
+        next_frame = 0
+        next_stats = start + stats_interval
+        while next_frame < end_frame or self._events:
+            # frames are scheduled a frame ahead, so that reordered and jittered files interleave with the next one's
+            while next_frame < end_frame and start + (next_frame - 1) * self.interval <= time.time():
+                self._schedule_frame(next_frame, start)
+                next_frame += 1
+            if not self._events:
+                _sleep_until(start + (next_frame - 1) * self.interval)
+                continue
+            due, kind, _, args = self._events[0]
+            next_schedule = start + (next_frame - 1) * self.interval if next_frame < end_frame else due
+            if next_schedule < due:
+                _sleep_until(next_schedule)
+                continue
+            heapq.heappop(self._events)
+            _sleep_until(due)
+            self.stats.lateness.append(time.time() - due)
+            if kind == WRITE:
+                queue, frame = args
+                self._write(due, queue, frame)
+                self.stats.nframes = max(self.stats.nframes, frame + 1)
+            else:
+                path, rest = args
+                with open(path, "ab") as fp:
+                    fp.write(rest)
+                self.stats.nwritten += 1
+            if time.time() >= next_stats:
+                self.stats.log()
+                next_stats += stats_interval
+        self.stats.log(final=True)
+        return self.stats
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog --queue name:dir:elements[:dtype[:max]] [--queue ...] [options]")
+    parser.add_option("-q", "--queue", action="append", default=[],
+                      help="Queue to write, as name:directory:elements per file[:dtype[:max value]]; may be " +
+                           "given several times")
+    parser.add_option("-r", "--rate", type="float", default=2.0,
+                      help="Frames written per s, default %default")
+    parser.add_option("-t", "--runtime", type="float", default=20.0,
+                      help="Total runtime in s, if --frames isn't given, default %default")
+    parser.add_option("-n", "--frames", type="int", default=None,
+                      help="Number of frames to write")
+    parser.add_option("--jitter", type="float", default=0.0,
+                      help="Maximum random delay in s of each file after its frame's scheduled time, default " +
+                           "%default")
+    parser.add_option("--drop", type="float", default=0.0,
+                      help="Fraction of files not written, default %default")
+    parser.add_option("--reorder", type="float", default=0.0,
+                      help="Fraction of files delayed until after the next frame's files, default %default")
+    parser.add_option("--partial", type="float", default=0.0,
+                      help="Fraction of files written in two halves, default %default")
+    parser.add_option("--partial-delay", type="float", default=0.2,
+                      help="Time in s between writing the two halves of partial files, default %default")
+    parser.add_option("--files-per-subdir", type="int", default=0,
+                      help="If positive, write files into numbered subdirectories of each queue's directory, " +
+                           "this many files to each, default %default")
+    parser.add_option("--seed", type="int", default=None,
+                      help="Seed of file contents and perturbations")
+    parser.add_option("--stats-interval", type="float", default=10.0,
+                      help="Time in s between logged statistics, default %default")
+    opts, args = parser.parse_args()
+
+    if args or not opts.queue:
+        print >> sys.stderr, parser.get_usage()
+        sys.exit(1)
+
+    return opts
+
+
+def main():
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s:%(message)s'))
+    _logger.get().addHandler(_handler)
+    _logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+
+    np.random.seed(opts.seed)
+    queues = [Queue.fromSpec(spec, opts.files_per_subdir) for spec in opts.queue]
+    for queue in queues:
+        if not os.path.isdir(queue.datadir):
+            os.makedirs(queue.datadir)
+
+    generator = LoadGenerator(queues, opts.rate, jitter=opts.jitter, drop=opts.drop, reorder=opts.reorder,
+                              partial=opts.partial, partial_delay=opts.partial_delay, seed=opts.seed)
+    generator.run(nframes=opts.frames, runtime=opts.runtime, stats_interval=opts.stats_interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""A check that the multi-process pipeline (see pipeline.py) writes the same series as core.runloop() when running
+pre-reduction stages.
+
+Input files are all written up front, with values drifting over time, and are fed in batches of --batch-size
+timepoints, so that batches are spread over transform processes. For each case, the feeder is run once with
+runloop() as a reference, and once as a pipeline. The series files written by each are read back, joined in
+timepoint order, and checked to be identical. Stages keeping state across batches must be rejected when asked to run
+in more than one transform process.
+
+Usage is:
+python pipeline_check.py [options]
+
+Exits with a non-zero status if any check fails.
+"""
+import logging
+from multiprocessing import Process
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.batching import FixedSizeBatches
+from thunder_streaming.feeder.core import build_filecheck_generators, runloop
+from thunder_streaming.feeder.feeders import SyncSeriesFeeder
+from thunder_streaming.feeder.pipeline import run_pipeline
+from thunder_streaming.feeder.stages import StagePipeline
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.regex import FilenameParser
+
+NVALUES = 64
+DTYPE = "float32"
+
+# (stages, number of transform processes), each checked against runloop(); stateful stages are only allowed one
+CASES = [("clip:100:1200", 2), ("detrend:0.5", 1), ("dff:0.2,clip:-1:1", 1)]
+REJECTED = [("detrend:0.5", 2)]
+
+
+def make_feeder(outdir, stages, batch_size):
+    return SyncSeriesFeeder(outdir, -1, ["img"], dtype=DTYPE, indtype="uint16",
+                            filename_parser=FilenameParser(), check_skip_in_sequence=False,
+                            stages={"img": StagePipeline.fromSpec(stages)},
+                            emission_policy=FixedSizeBatches(batch_size))
+
+
+def run_reference(datadir, outdir, stages, batch_size, poll_time):
+    file_checkers = build_filecheck_generators(datadir, 0.0, filename_predicate=FilenameParser().queueName)
+    runloop(file_checkers, make_feeder(outdir, stages, batch_size), poll_time)
+
+
+def run_pipelined(datadir, outdir, stages, batch_size, poll_time, ntransform):
+    file_checkers = build_filecheck_generators(datadir, 0.0, filename_predicate=FilenameParser().queueName)
+    run_pipeline(file_checkers, make_feeder(outdir, stages, batch_size), poll_time, ntransform=ntransform)
+
+
+def read_output(outdir):
+    """Returns the values of all series files in outdir as a single (NVALUES, timepoints) array, and the number of
+    timepoints written.
+    """
+    blocks = []
+    for name in os.listdir(outdir):
+        if not name.startswith("series-"):
+            continue
+        # names are series-start-end_bytesN.bin, with no keys in records
+        start, end = [int(count) for count in name.split("_bytes")[0].split("-")[1:3]]
+        values = np.fromfile(os.path.join(outdir, name), dtype=DTYPE).reshape(NVALUES, end - start + 1)
+        blocks.append((start, values))
+    if not blocks:
+        return None, 0
+    values = np.hstack([values for _, values in sorted(blocks)])
+    return values, values.shape[1]
+
+
+def run_until_written(target, args, outdir, ntimepoints, timeout, interrupt):
+    """Runs target(*args) in a process until outdir holds ntimepoints timepoints, returning the output.
+    """
+    proc = Process(target=target, args=args)
+    proc.start()
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline and read_output(outdir)[1] < ntimepoints:
+            time.sleep(0.1)
+    finally:
+        if interrupt:
+            # lets the pipeline drain and shut down its stage processes
+            os.kill(proc.pid, signal.SIGINT)
+            proc.join(timeout)
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+    return read_output(outdir)[0]
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--timepoints", type="int", default=60,
+                      help="Number of timepoints written, default %default")
+    parser.add_option("--batch-size", type="int", default=4,
+                      help="Number of timepoints per series file, default %default")
+    parser.add_option("--timeout", type="float", default=30.0,
+                      help="Time in s allowed for each run to write all timepoints, default %default")
+    parser.add_option("--verbose", action="store_true", default=False)
+    opts, args = parser.parse_args()
+    return opts
+
+
+def main():
+    opts = parse_options()
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(process)d:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO if opts.verbose else logging.WARN)
+
+    poll_time = 0.1
+    datadir = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    base = rng.randint(100, 1000, NVALUES)
+    for timepoint in xrange(opts.timepoints):
+        values = base + 10 * timepoint + rng.randint(0, 50, NVALUES)
+        values.astype("uint16").tofile(os.path.join(datadir, "img_%05d" % timepoint))
+
+    failures = []
+    try:
+        for stages, ntransform in CASES:
+            outputs = []
+            for pipelined in (False, True):
+                outdir = tempfile.mkdtemp()
+                try:
+                    if pipelined:
+                        target, args = run_pipelined, (datadir, outdir, stages, opts.batch_size, poll_time,
+                                                       ntransform)
+                    else:
+                        target, args = run_reference, (datadir, outdir, stages, opts.batch_size, poll_time)
+                    outputs.append(run_until_written(target, args, outdir, opts.timepoints, opts.timeout,
+                                                     interrupt=pipelined))
+                finally:
+                    shutil.rmtree(outdir)
+            reference, pipelined = outputs
+            label = "'%s' with %d transform process(es)" % (stages, ntransform)
+            if reference is None or reference.shape[1] != opts.timepoints:
+                failures.append("%s: runloop() did not write all timepoints" % label)
+            elif pipelined is None or pipelined.shape != reference.shape:
+                failures.append("%s: pipeline did not write all timepoints" % label)
+            elif not np.array_equal(reference, pipelined):
+                ndiffer = np.count_nonzero((reference != pipelined).any(axis=0))
+                failures.append("%s: %d of %d timepoints differ from runloop()" % (label, ndiffer, opts.timepoints))
+            else:
+                print "%s: identical to runloop()" % label
+
+        for stages, ntransform in REJECTED:
+            outdir = tempfile.mkdtemp()
+            label = "'%s' with %d transform process(es)" % (stages, ntransform)
+            try:
+                run_pipeline([], make_feeder(outdir, stages, opts.batch_size), poll_time, ntransform=ntransform)
+                failures.append("%s: was not rejected" % label)
+            except ValueError, e:
+                print "%s: rejected (%s)" % (label, e)
+            finally:
+                shutil.rmtree(outdir)
+    finally:
+        shutil.rmtree(datadir)
+
+    if failures:
+        for failure in failures:
+            print >> sys.stderr, "FAILED: " + failure
+        sys.exit(1)
+    print "All checks passed"
+
+if __name__ == "__main__":
+    main()
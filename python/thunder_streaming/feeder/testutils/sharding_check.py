@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""A check of sharded feeding (see sharding.py), running a coordinator and several workers as local processes.
+
+Input files are written at a steady rate, each holding its own timepoint number as every value. Partway through,
+one worker is killed. Once all input has been written and the dead worker's shards have been taken over, the series
+files written by all workers are read back and checked to cover every timepoint, and the timepoints of the dead
+worker's shard to have been written by the survivors after its death.
+
+Delivery is at least once (see sharding.py), so timepoints the dead worker wrote out without having reported them may
+be written again by its successor. These are counted, and checked to be no more than a single poll's worth of the
+dead worker's timepoints; any other timepoint written more than once is a failure.
+
+The coordinator's handling of a worker saying goodbye after having already been expired, as when a worker whose
+feed outlasts the heartbeat timeout is then stopped, is checked separately beforehand, without any processes.
+
+Usage is:
+python sharding_check.py [options]
+
+Exits with a non-zero status if any check fails.
+"""
+import logging
+from multiprocessing import Event, Process
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.core import build_filecheck_generators, runloop
+from thunder_streaming.feeder.feeders import SyncSeriesFeeder
+from thunder_streaming.feeder.sharding import ShardCoordinator, ShardWorker
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.regex import FilenameParser
+
+NVALUES = 16
+
+
+def run_coordinator(endpoint, nshards, timeout, stop_event):
+    ShardCoordinator(endpoint, nshards, timeout=timeout).run(stop_event)
+
+
+def run_worker(endpoint, name, datadir, outdir, poll_time):
+    filename_parser = FilenameParser()
+    feeder = SyncSeriesFeeder(outdir, -1, ["img"], filename_parser=filename_parser, check_skip_in_sequence=False)
+    worker = ShardWorker(feeder, endpoint, name, filename_parser, heartbeat_interval=poll_time)
+    file_checkers = build_filecheck_generators(datadir, 0.0, filename_predicate=filename_parser.queueName)
+    runloop(file_checkers, worker, poll_time)
+
+
+def check_late_bye():
+    """Returns a list of failures of the coordinator to handle a worker leaving after being expired.
+    """
+    coordinator = ShardCoordinator("tcp://127.0.0.1:0", 2, timeout=1.0, startup_wait=0.0)
+    coordinator.handle("w0", {"type": "heartbeat", "shards": []}, 0.0)
+    coordinator.handle("w1", {"type": "heartbeat", "shards": []}, 0.0)
+    coordinator.assign(0.0)
+    coordinator.handle("w1", {"type": "heartbeat", "shards": coordinator.shards_of("w1")}, 1.5)
+    coordinator.expire(2.0)
+    try:
+        coordinator.handle("w0", {"type": "bye"}, 2.5)
+    except Exception, e:
+        return ["a bye from an expired worker raised %s: %s" % (type(e).__name__, e)]
+    coordinator.assign(2.5)
+    if coordinator.shards_of("w1") != [0, 1]:
+        return ["the expired worker's shard was not reassigned: owners %s" % coordinator.owners]
+    return []
+
+
+def read_output(outdir):
+    """Returns a list of (worker name, timepoints) for each series file in outdir.
+    """
+    written = []
+    for name in sorted(os.listdir(outdir)):
+        if not name.startswith("series-"):
+            continue
+        # names are series-start-end-worker_bytesN.bin
+        tag, bytesstr = name[:-len(".bin")].split("-")[3].split("_bytes")
+        ntimepoints = int(bytesstr) // 2
+        records = np.fromfile(os.path.join(outdir, name), dtype='uint16').reshape(-1, ntimepoints)
+        written.append((tag, list(records[0])))
+    return written
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--workers", type="int", default=3,
+                      help="Number of workers, and of shards, default %default")
+    parser.add_option("--timepoints", type="int", default=120,
+                      help="Number of timepoints written, default %default")
+    parser.add_option("--interval", type="float", default=0.02,
+                      help="Time in s between timepoints written, default %default")
+    parser.add_option("--timeout", type="float", default=1.0,
+                      help="Heartbeat timeout in s, default %default")
+    parser.add_option("--port", type="int", default=5571,
+                      help="Local port for the coordinator, default %default")
+    parser.add_option("--verbose", action="store_true", default=False)
+    opts, args = parser.parse_args()
+    return opts
+
+
+def main():
+    opts = parse_options()
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(process)d:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO if opts.verbose else logging.WARN)
+
+    failures = check_late_bye()
+    if not failures:
+        print "A bye from an already expired worker is ignored"
+
+    endpoint = "tcp://127.0.0.1:%d" % opts.port
+    poll_time = 0.1
+    datadir, outdir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    stop_event = Event()
+    coordinator = Process(target=run_coordinator, args=(endpoint, opts.workers, opts.timeout, stop_event))
+    coordinator.start()
+    workers = [Process(target=run_worker, args=(endpoint, "w%d" % idx, datadir, outdir, poll_time))
+               for idx in xrange(opts.workers)]
+    for worker in workers:
+        worker.start()
+
+    victim = workers[1]
+    kill_timepoint = opts.timepoints // 3
+    try:
+        for timepoint in xrange(opts.timepoints):
+            if timepoint == kill_timepoint:
+                os.kill(victim.pid, signal.SIGKILL)
+                print "Killed worker w1 before timepoint %d" % timepoint
+            np.repeat(np.uint16(timepoint), NVALUES).tofile(os.path.join(datadir, "img_%05d" % timepoint))
+            time.sleep(opts.interval)
+        # time for the dead worker's shard to be reassigned, and for the rest of the input to be fed
+        time.sleep(opts.timeout + 10 * poll_time)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        stop_event.set()
+        coordinator.join()
+
+    written = read_output(outdir)
+    shutil.rmtree(datadir)
+    shutil.rmtree(outdir)
+
+    counts = np.zeros(opts.timepoints, dtype=int)
+    taken_over, by_victim = set(), set()
+    for tag, timepoints in written:
+        for timepoint in timepoints:
+            counts[timepoint] += 1
+            if timepoint % opts.workers == 1:
+                (by_victim if tag == "w1" else taken_over).add(timepoint)
+    missing = np.flatnonzero(counts == 0)
+    repeated = set(np.flatnonzero(counts > 1))
+    rewritten = repeated & by_victim & taken_over
+    print "%d series files; %d of %d timepoints written; %d of w1's timepoints taken over" % (
+        len(written), np.count_nonzero(counts), opts.timepoints, len(taken_over))
+    print "%d timepoint(s) written by w1 without being reported, and so written again by its successor" % (
+        len(rewritten))
+
+    if len(missing):
+        failures.append("timepoints never written: %s" % list(missing))
+    if repeated - rewritten or counts.max() > 2:
+        failures.append("timepoints written more than once other than by w1 and its successor: %s" %
+                        sorted(repeated - rewritten or repeated))
+    # w1 writes a timepoint of its shard every opts.workers timepoints
+    max_rewritten = int(np.ceil(poll_time / (opts.interval * opts.workers))) + 1
+    if len(rewritten) > max_rewritten:
+        failures.append("%d of w1's timepoints written again, more than the %d it may write in a poll" % (
+            len(rewritten), max_rewritten))
+    if not [timepoint for timepoint in taken_over if timepoint >= kill_timepoint]:
+        failures.append("no timepoints of the dead worker's shard were written after it was killed")
+    if failures:
+        for failure in failures:
+            print >> sys.stderr, "FAILED: " + failure
+        sys.exit(1)
+    print "All checks passed"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""A check of the shared memory ring buffer in shmring.py, running the writer and reader in separate processes.
+
+Four runs are made, each on a new ring buffer file with a writer process writing batches whose contents are derived
+from their sequence numbers at a fixed rate:
+* a reader keeping up, which should see every batch, intact and in order
+* a slow reader, which should lose batches (counted in RingReader.nlost), but see the rest intact and in order
+* a reader holding on to a batch while the writer laps the ring, which should then find it no longer valid
+* a reader keeping up with a writer restarted twice on the same file, first with the same number of slots and then
+  with one more, which should see every batch, intact and in order, the last writer's starting from 0
+
+Usage is:
+python shmring_check.py [options]
+
+Exits with a non-zero status if any check fails.
+"""
+from multiprocessing import Event, Process
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.shmring import RingReader, RingWriter
+
+RECORD_SIZE = 64
+
+
+def batch_contents(seq, nrecords):
+    return (np.arange(nrecords * RECORD_SIZE // 2, dtype='uint16') + seq).astype('uint16')
+
+
+def run_writer(path, nslots, nbatches, nrecords, interval, created, go, restarts=()):
+    """Writes nbatches batches, then again for each number of slots in restarts, each time with a new RingWriter.
+    """
+    writer = RingWriter(path, nslots=nslots, slot_bytes=nrecords * RECORD_SIZE)
+    created.set()
+    # wait for the reader to map the ring
+    go.wait(10.0)
+    for restart_nslots in list(restarts) + [None]:
+        for _ in xrange(nbatches):
+            seq = writer.next_seq
+            writer.write([batch_contents(seq, nrecords)], RECORD_SIZE, 'uint16')
+            time.sleep(interval)
+        writer.close()
+        if restart_nslots is not None:
+            writer = RingWriter(path, nslots=restart_nslots, slot_bytes=nrecords * RECORD_SIZE)
+
+
+def start(path, opts, restarts=()):
+    """Starts a writer process, returning it and a reader of its ring buffer.
+    """
+    created, go = Event(), Event()
+    writer = Process(target=run_writer, args=(path, opts.slots, opts.batches, opts.records, opts.interval, created,
+                                              go, restarts))
+    writer.start()
+    if not created.wait(10.0):
+        raise RuntimeError("Ring buffer writer did not start")
+    reader = RingReader(path, from_oldest=True)
+    go.set()
+    return writer, reader
+
+
+def check_batch(batch, nrecords):
+    expected = batch_contents(batch.seq, nrecords).view(np.uint8).reshape(nrecords, RECORD_SIZE)
+    intact = np.array_equal(batch.records, expected)
+    return batch.valid() and intact
+
+
+def read_all(reader, opts, delay):
+    seqs = []
+    nbad = 0
+    while True:
+        batch = reader.next(timeout=1.0)
+        if batch is None:
+            return seqs, nbad
+        if delay > 0:
+            time.sleep(delay)
+        if batch.valid():
+            seqs.append(batch.seq)
+            if not check_batch(batch, opts.records):
+                nbad += 1
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--slots", type="int", default=4,
+                      help="Number of ring buffer slots, default %default")
+    parser.add_option("--batches", type="int", default=200,
+                      help="Number of batches written in each run, default %default")
+    parser.add_option("--records", type="int", default=4096,
+                      help="Number of records per batch, default %default")
+    parser.add_option("--interval", type="float", default=0.002,
+                      help="Time in s between batches written, default %default")
+    parser.add_option("--dir", default="/dev/shm" if os.path.isdir("/dev/shm") else None,
+                      help="Directory for the ring buffer file, default %default")
+    opts, args = parser.parse_args()
+    return opts
+
+
+def main():
+    opts = parse_options()
+    ringdir = tempfile.mkdtemp(dir=opts.dir)
+    paths = [os.path.join(ringdir, "ring%d" % run) for run in xrange(4)]
+    failures = []
+
+    writer, reader = start(paths[0], opts)
+    seqs, nbad = read_all(reader, opts, 0.0)
+    writer.join()
+    print "Keeping up: read %d of %d batches, %d lost, %d corrupt" % (len(seqs), opts.batches, reader.nlost, nbad)
+    if seqs != range(opts.batches) or reader.nlost or nbad:
+        failures.append("reader keeping up did not see every batch intact and in order")
+    reader.close()
+
+    writer, reader = start(paths[1], opts)
+    seqs, nbad = read_all(reader, opts, opts.interval * 3)
+    writer.join()
+    print "Lagging: read %d of %d batches, %d lost, %d corrupt" % (len(seqs), opts.batches, reader.nlost, nbad)
+    if not reader.nlost or nbad or seqs != sorted(set(seqs)) or len(seqs) + reader.nlost > opts.batches:
+        failures.append("lagging reader did not detect lost batches, or saw corrupt or out of order ones")
+    reader.close()
+
+    writer, reader = start(paths[2], opts)
+    batch = reader.next(timeout=1.0)
+    valid_before = batch.valid()
+    time.sleep(opts.interval * opts.slots * 4)
+    valid_after = batch.valid()
+    writer.join()
+    print "Overwrite: batch %d valid when read: %s, after writer lapped the ring: %s" % (
+        batch.seq, valid_before, valid_after)
+    if not valid_before or valid_after:
+        failures.append("overwrite of a held batch was not detected")
+    reader.close()
+
+    writer, reader = start(paths[3], opts, restarts=(opts.slots, opts.slots + 1))
+    seqs, nbad = read_all(reader, opts, 0.0)
+    writer.join()
+    print "Restarts: read %d of %d batches, %d lost, %d corrupt" % (len(seqs), 3 * opts.batches, reader.nlost, nbad)
+    if seqs != range(2 * opts.batches) + range(opts.batches) or reader.nlost or nbad:
+        failures.append("reader of a restarted writer did not see every batch intact and in order")
+    reader.close()
+
+    for path in paths:
+        os.unlink(path)
+    os.rmdir(ringdir)
+    if failures:
+        for failure in failures:
+            print >> sys.stderr, "FAILED: " + failure
+        sys.exit(1)
+    print "All checks passed"
+
+if __name__ == "__main__":
+    main()
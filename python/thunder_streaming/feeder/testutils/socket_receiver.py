@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""A stand-in for a streaming receiver, pulling batches of Series records sent by a SocketSink.
+
+Each batch's header is checked and its records reshaped; the delay between the send time in the header and receipt
+is reported periodically as percentiles. If an output directory is given, each batch is also written out as a
+Series binary file, as SeriesSink would have written it, so that the two may be compared.
+
+Usage is:
+python socket_receiver.py [options] endpoint
+
+for instance:
+python socket_receiver.py tcp://*:5557
+with a feeder sink given as "socket:tcp://localhost:5557:shape=512,512,4".
+"""
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.framing import unpack_header
+from thunder_streaming.feeder.utils.logger import global_logger
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] endpoint")
+    parser.add_option("--connect", action="store_true", default=False,
+                      help="Connect to the endpoint rather than binding to it; the sink should then bind")
+    parser.add_option("--hwm", type="int", default=10,
+                      help="Receive high-water mark in batches, default %default")
+    parser.add_option("--delay", type="float", default=0.0,
+                      help="Time in s to sleep after each batch, to simulate a slow receiver, default %default")
+    parser.add_option("--report-interval", type="float", default=10.0,
+                      help="Time in s between latency reports, default %default")
+    parser.add_option("--output-dir", default=None,
+                      help="If given, write each batch out as a Series binary file in this directory")
+    parser.add_option("--max-batches", type="int", default=-1,
+                      help="Exit after this many batches (negative for no limit), default %default")
+    opts, args = parser.parse_args()
+
+    if len(args) != 1:
+        print >> sys.stderr, parser.get_usage()
+        sys.exit(1)
+    setattr(opts, "endpoint", args[0])
+    return opts
+
+
+def report(latencies, nbatches, nrecords):
+    if not latencies:
+        return
+    pcts = np.percentile(latencies, [50, 90, 99])
+    global_logger.get().info("Received %d batches, %d records; send-to-receipt latency p50 %.1f ms, "
+                             "p90 %.1f ms, p99 %.1f ms, max %.1f ms", nbatches, nrecords, pcts[0] * 1000,
+                             pcts[1] * 1000, pcts[2] * 1000, max(latencies) * 1000)
+
+
+def main():
+    import zmq
+
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s:%(message)s'))
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+    socket = zmq.Context.instance().socket(zmq.PULL)
+    socket.setsockopt(zmq.RCVHWM, opts.hwm)
+    if opts.connect:
+        socket.connect(opts.endpoint)
+    else:
+        socket.bind(opts.endpoint)
+    if opts.output_dir and not os.path.isdir(opts.output_dir):
+        os.makedirs(opts.output_dir)
+
+    latencies = []
+    nbatches, nrecords = 0, 0
+    last_report = time.time()
+    try:
+        while opts.max_batches < 0 or nbatches < opts.max_batches:
+            if not socket.poll(1000):
+                continue
+            parts = socket.recv_multipart(copy=False)
+            received = time.time()
+            header = unpack_header(parts[0].bytes)
+            data = parts[1].bytes
+            if len(data) != header.record_size * header.nrecords:
+                global_logger.get().warn("Batch of %d bytes does not hold %d records of %d bytes", len(data),
+                                         header.nrecords, header.record_size)
+                continue
+            records = np.frombuffer(data, dtype=np.uint8).reshape(header.nrecords, header.record_size)
+            latencies.append(received - header.send_time)
+            nbatches += 1
+            nrecords += len(records)
+
+            if opts.output_dir:
+                outname = "series-%06d_bytes%d.bin" % (nbatches, header.record_size)
+                records.tofile(os.path.join(opts.output_dir, outname))
+            if opts.delay > 0:
+                time.sleep(opts.delay)
+            if received - last_report >= opts.report_interval:
+                report(latencies, nbatches, nrecords)
+                latencies = []
+                last_report = received
+    except KeyboardInterrupt:
+        pass
+    finally:
+        report(latencies, nbatches, nrecords)
+        socket.close()
+
+if __name__ == "__main__":
+    main()
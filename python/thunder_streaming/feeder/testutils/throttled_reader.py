@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""A testing utility that stands in for a slow network filesystem, and a script comparing cold sequential reads
+against reads through a Prefetcher.
+
+A ThrottledReader may be passed as the read_fcn of a Prefetcher. Each read waits for a fixed per-file latency,
+standing in for a network round trip, plus the file size divided by the bandwidth. Reads in parallel threads are
+throttled independently, as they would be on NFS up to the limit of the link.
+
+Usage is:
+python throttled_reader.py [options]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.transpose import transpose_files_to_array
+from thunder_streaming.feeder.utils.logger import global_logger
+from thunder_streaming.feeder.utils.prefetch import Prefetcher, read_file
+
+
+class ThrottledReader(object):
+    """Callable returning the contents of a file after a delay of latency + size / bandwidth seconds.
+
+    Parameters
+    ----------
+    latency: float
+        Delay in s per file read.
+    bandwidth: float
+        Bytes per s (zero or negative for unlimited).
+    """
+    def __init__(self, latency=0.01, bandwidth=-1):
+        self.latency = float(latency)
+        self.bandwidth = float(bandwidth)
+        self.nreads = 0
+
+    def __call__(self, filename):
+        data = read_file(filename)
+        delay = self.latency
+        if self.bandwidth > 0:
+            delay += len(data) / self.bandwidth
+        time.sleep(delay)
+        self.nreads += 1
+        return data
+
+    def fromfile(self, filename, dtype):
+        """Throttled equivalent of np.fromfile(), which may be passed as the 'reader' argument of the functions
+        in transpose.py.
+        """
+        return np.frombuffer(self(filename), dtype=dtype)
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--nfiles", type="int", default=50,
+                      help="Number of files to transpose, default %default")
+    parser.add_option("--datalen", type="int", default=512*512,
+                      help="Length of each file in uint16 elements, default %default")
+    parser.add_option("--latency", type="float", default=0.02,
+                      help="Simulated per-file latency in s, default %default")
+    parser.add_option("--bandwidth-mb", type="float", default=100.0,
+                      help="Simulated bandwidth per read in MB/s (negative for unlimited), default %default")
+    parser.add_option("--threads", type="int", default=8,
+                      help="Number of prefetch threads, default %default")
+    opts, args = parser.parse_args()
+    return opts
+
+
+def main():
+    _handler = logging.StreamHandler(sys.stdout)
+    global_logger.get().addHandler(_handler)
+    global_logger.get().setLevel(logging.INFO)
+
+    opts = parse_options()
+    bandwidth = opts.bandwidth_mb * 1024 * 1024 if opts.bandwidth_mb > 0 else -1
+    datadir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for fnidx in xrange(opts.nfiles):
+            filename = os.path.join(datadir, "img_%06d" % fnidx)
+            np.random.randint(0, 4096, opts.datalen).astype('uint16').tofile(filename)
+            filenames.append(filename)
+
+        reader = ThrottledReader(opts.latency, bandwidth)
+        start = time.time()
+        expected, _ = transpose_files_to_array(filenames, reader=reader.fromfile)
+        sequential_time = time.time() - start
+
+        prefetcher = Prefetcher(nthreads=opts.threads, read_fcn=ThrottledReader(opts.latency, bandwidth))
+        start = time.time()
+        prefetcher.prefetch(filenames)
+        actual, _ = transpose_files_to_array(filenames, reader=prefetcher.fromfile)
+        prefetcher.release(filenames)
+        prefetch_time = time.time() - start
+
+        if not np.array_equal(expected, actual):
+            print >> sys.stderr, "Prefetched output differs from sequential output"
+            sys.exit(1)
+        print "Sequential: %.3f s; prefetched with %d threads: %.3f s (%.1fx); %d hits, %d misses" % (
+            sequential_time, opts.threads, prefetch_time, sequential_time / prefetch_time,
+            prefetcher.nhits, prefetcher.nmisses)
+    finally:
+        shutil.rmtree(datadir)
+
+if __name__ == "__main__":
+    main()
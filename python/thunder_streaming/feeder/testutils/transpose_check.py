@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+"""An equivalence check and microbenchmark of the transpose implementations in transpose.py.
+
+Every implementation registered below with @implementation is checked to write output byte-for-byte identical to
+a straightforward reference, over randomized cases: numbers of files, shapes with two or three dimensions, input and
+output dtypes, startlinidx values, and files holding more or fewer elements than fit in the shape, so that keys
+overflow into further z planes. Cases that the reference expects to fail (linear indices overflowing the output
+dtype) must raise ValueError in every implementation.
+
+Each implementation is then timed over a grid of numbers of files and elements per file, reading from files in the
+page cache, and its throughput in input MB/s is reported. Results can be written as JSON and compared with those of
+an earlier run, flagging any implementation whose throughput has dropped by more than --threshold.
+
+New implementations (chunked, mmap'ed, parallel...) should be registered here, under the kind of output they
+produce:
+* flat: transposed values only, as by transpose_files()
+* series: subscript keys followed by values, as by transpose_files_to_series()
+* linear: linear keys followed by values, as by transpose_files_to_linear_series()
+* matches: records of several queues, as by transpose_matches_to_series_arrays()
+Each is registered as a function taking a Case and returning the output as a string of bytes.
+
+Usage is:
+python transpose_check.py [options]
+
+Exits with a non-zero status if any implementation differs from the reference or has regressed.
+"""
+from collections import namedtuple, OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.queuespec import QueueSpec
+from thunder_streaming.feeder.stages import StagePipeline
+from thunder_streaming.feeder.testutils.feeder_benchmark import git_commit
+from thunder_streaming.feeder.utils.prefetch import Prefetcher
+from thunder_streaming.feeder import transpose
+
+KINDS = ("flat", "series", "linear", "matches")
+
+# 'queues' is a list of lists of filenames, one list per queue, holding a file per timepoint. Only 'matches' cases
+# have more than one queue. 'shape' is None for flat cases, and for matches cases without subscript keys.
+Case = namedtuple("Case", ["queues", "dtype", "indtype", "shape", "linear", "startlinidx"])
+
+IMPLEMENTATIONS = OrderedDict((kind, OrderedDict()) for kind in KINDS)
+
+
+def implementation(kind, name):
+    """Decorator registering a function taking a Case and returning output bytes as an implementation of kind.
+    """
+    def register(fcn):
+        IMPLEMENTATIONS[kind][name] = fcn
+        return fcn
+    return register
+
+
+def _to_file(fcn, *args, **kwargs):
+    with tempfile.TemporaryFile() as fp:
+        fcn(*args, outfp=fp, **kwargs)
+        fp.seek(0)
+        return fp.read()
+
+
+def _to_bytes(result):
+    outbuf, _ = result
+    return outbuf.tostring() if outbuf is not None else ""
+
+
+def _prefetched_reader(filenames):
+    prefetcher = Prefetcher(nthreads=2, drop_after_use=False)
+    prefetcher.prefetch(filenames)
+    return prefetcher.fromfile
+
+
+@implementation("flat", "transpose_files")
+def _flat_file(case):
+    return _to_file(transpose.transpose_files, case.queues[0], dtype=case.dtype)
+
+
+@implementation("flat", "transpose_files_to_array")
+def _flat_array(case):
+    return _to_bytes(transpose.transpose_files_to_array(case.queues[0], dtype=case.dtype))
+
+
+@implementation("flat", "transpose_files_to_array+stages")
+def _flat_array_stages(case):
+    return _to_bytes(transpose.transpose_files_to_array(case.queues[0], dtype=case.dtype,
+                                                        stages=StagePipeline([])))
+
+
+@implementation("flat", "transpose_files_to_array+prefetch")
+def _flat_array_prefetch(case):
+    return _to_bytes(transpose.transpose_files_to_array(case.queues[0], dtype=case.dtype,
+                                                        reader=_prefetched_reader(case.queues[0])))
+
+
+@implementation("flat", "transpose_queue_files_to_array")
+def _flat_queue(case):
+    return _to_bytes(transpose.transpose_queue_files_to_array(case.queues[0], QueueSpec("q"), dtype=case.dtype,
+                                                              indtype=case.indtype))
+
+
+@implementation("series", "transpose_files_to_series")
+def _series_file(case):
+    return _to_file(transpose.transpose_files_to_series, case.queues[0], shape=case.shape, dtype=case.dtype,
+                    indtype=case.indtype, startlinidx=case.startlinidx)
+
+
+@implementation("series", "transpose_files_to_series_array")
+def _series_array(case):
+    return _to_bytes(transpose.transpose_files_to_series_array(case.queues[0], case.shape, dtype=case.dtype,
+                                                               indtype=case.indtype, startlinidx=case.startlinidx))
+
+
+@implementation("series", "transpose_files_to_series_array+stages")
+def _series_array_stages(case):
+    return _to_bytes(transpose.transpose_files_to_series_array(case.queues[0], case.shape, dtype=case.dtype,
+                                                               indtype=case.indtype, startlinidx=case.startlinidx,
+                                                               stages=StagePipeline([])))
+
+
+@implementation("series", "transpose_files_to_series_array+prefetch")
+def _series_array_prefetch(case):
+    return _to_bytes(transpose.transpose_files_to_series_array(case.queues[0], case.shape, dtype=case.dtype,
+                                                               indtype=case.indtype, startlinidx=case.startlinidx,
+                                                               reader=_prefetched_reader(case.queues[0])))
+
+
+@implementation("series", "transpose_queue_files_to_array")
+def _series_queue(case):
+    return _to_bytes(transpose.transpose_queue_files_to_array(case.queues[0], QueueSpec("q"), shape=case.shape,
+                                                              dtype=case.dtype, indtype=case.indtype,
+                                                              startlinidx=case.startlinidx))
+
+
+@implementation("series", "transpose_queue_files_to_array+stages")
+def _series_queue_stages(case):
+    return _to_bytes(transpose.transpose_queue_files_to_array(case.queues[0], QueueSpec("q"), shape=case.shape,
+                                                              dtype=case.dtype, indtype=case.indtype,
+                                                              startlinidx=case.startlinidx,
+                                                              stages=StagePipeline([])))
+
+
+@implementation("linear", "transpose_files_to_linear_series")
+def _linear_file(case):
+    return _to_file(transpose.transpose_files_to_linear_series, case.queues[0], dtype=case.dtype,
+                    indtype=case.indtype, startlinidx=case.startlinidx)
+
+
+@implementation("linear", "transpose_files_to_linear_series_array")
+def _linear_array(case):
+    return _to_bytes(transpose.transpose_files_to_linear_series_array(case.queues[0], dtype=case.dtype,
+                                                                      indtype=case.indtype,
+                                                                      startlinidx=case.startlinidx))
+
+
+@implementation("linear", "transpose_files_to_linear_series_array+stages")
+def _linear_array_stages(case):
+    return _to_bytes(transpose.transpose_files_to_linear_series_array(case.queues[0], dtype=case.dtype,
+                                                                      indtype=case.indtype,
+                                                                      startlinidx=case.startlinidx,
+                                                                      stages=StagePipeline([])))
+
+
+@implementation("linear", "transpose_queue_files_to_array")
+def _linear_queue(case):
+    return _to_bytes(transpose.transpose_queue_files_to_array(case.queues[0], QueueSpec("q"), linear=True,
+                                                              dtype=case.dtype, indtype=case.indtype,
+                                                              startlinidx=case.startlinidx))
+
+
+def _matches(case):
+    prefixes = ["q%d" % idx for idx in xrange(len(case.queues))]
+    matches = [(timepoint, dict(zip(prefixes, filenames))) for timepoint, filenames in enumerate(zip(*case.queues))]
+    return matches, prefixes
+
+
+@implementation("matches", "transpose_matches_to_series_arrays")
+def _matches_arrays(case):
+    matches, prefixes = _matches(case)
+    arrays, _, _ = transpose.transpose_matches_to_series_arrays(matches, prefixes, shape=case.shape,
+                                                                linear=case.linear, dtype=case.dtype,
+                                                                indtype=case.indtype)
+    return "".join(array.tostring() for array in arrays)
+
+
+@implementation("matches", "transpose_matches_to_series_arrays+queue_specs")
+def _matches_arrays_specs(case):
+    matches, prefixes = _matches(case)
+    queue_specs = dict((prefix, QueueSpec(prefix)) for prefix in prefixes)
+    arrays, _, _ = transpose.transpose_matches_to_series_arrays(matches, prefixes, shape=case.shape,
+                                                                linear=case.linear, dtype=case.dtype,
+                                                                indtype=case.indtype, queue_specs=queue_specs)
+    return "".join(array.tostring() for array in arrays)
+
+
+def reference_subscripts(linidxs, shape):
+    """Returns subscripts of the passed linear indices into shape, in Fortran order, with the last dimension
+    unbounded, so that indices beyond the end of shape continue into further planes.
+    """
+    subs = []
+    remaining = np.asarray(linidxs, dtype=np.int64)
+    for dim in shape[:-1]:
+        subs.append(remaining % dim)
+        remaining = remaining // dim
+    subs.append(remaining)
+    return subs
+
+
+def reference_records(values, keys, dtype):
+    """Returns the records holding the passed keys followed by the passed values (a 2d array of shape (nfiles,
+    nelements)), as bytes.
+    """
+    records = np.empty((values.shape[1], len(keys) + values.shape[0]), dtype=dtype)
+    for keyidx, key in enumerate(keys):
+        records[:, keyidx] = key
+    records[:, len(keys):] = values.T
+    return records.tostring()
+
+
+def reference_queue(values, case, startlinidx):
+    """Returns the reference output for a single queue's values, starting at the passed linear index, or raises
+    ValueError if its linear indices can't be represented.
+    """
+    linidxs = np.arange(startlinidx, startlinidx + values.shape[1])
+    dtype = np.dtype(case.dtype)
+    if case.linear:
+        maxval = np.iinfo(dtype).max if dtype.kind in 'iu' else np.finfo(dtype).max
+        if startlinidx + values.shape[1] >= maxval:
+            raise ValueError("linear indices overflow %s" % dtype)
+        keys = [linidxs]
+    elif case.shape is not None:
+        keys = reference_subscripts(linidxs, case.shape)
+    else:
+        keys = []
+    return reference_records(values, keys, dtype)
+
+
+def reference(kind, case, values):
+    """Returns the reference output for the passed case, given the values written to each of its queues' files as
+    a list of 2d arrays of shape (nfiles, nelements), already converted to the output dtype.
+    """
+    if kind == "flat":
+        return values[0].T.tostring()
+    if kind in ("series", "linear"):
+        return reference_queue(values[0], case, case.startlinidx)
+    output, startlinidx = [], 0
+    for queue_values in values:
+        output.append(reference_queue(queue_values, case, startlinidx))
+        startlinidx += queue_values.shape[1]
+    return "".join(output)
+
+
+def random_case(kind, rng, dirname):
+    """Writes the files of a random case of the passed kind into dirname, returning the Case and the values
+    written, as passed to reference().
+    """
+    if kind == "flat":
+        indtype = dtype = rng.choice(["uint8", "uint16", "int16", "int32", "float32", "float64"])
+    else:
+        indtype = rng.choice(["uint8", "uint16", "int16", "int32", "float32"])
+        dtype = rng.choice(["uint16", "int32", "uint32", "float32", "float64"])
+    shape = None
+    if kind in ("series", "matches") and (kind == "series" or rng.rand() < 0.5):
+        shape = tuple(rng.randint(1, 9, size=rng.choice([2, 3])))
+    linear = kind == "linear" or (kind == "matches" and shape is None and rng.rand() < 0.5)
+    size = int(np.prod(shape)) if shape else rng.randint(1, 200)
+    startlinidx = 0
+    if kind in ("series", "linear"):
+        # the last z plane may be partly filled, or overflow into further planes
+        startlinidx = rng.choice([0, size, rng.randint(0, 3 * size)])
+        if linear and rng.rand() < 0.2:
+            # linear keys that may not fit into a small output dtype
+            dtype = rng.choice(["uint8", "int16"])
+            startlinidx = np.iinfo(dtype).max - rng.randint(0, 2 * size)
+    nqueues = rng.randint(2, 4) if kind == "matches" else 1
+    nfiles = rng.randint(1, 11)
+
+    queues, values = [], []
+    for qidx in xrange(nqueues):
+        nelements = size if rng.rand() < 0.5 else rng.randint(1, 2 * size + 1)
+        queue_values = rng.randint(0, 200, size=(nfiles, nelements)).astype(indtype)
+        filenames = []
+        for fidx in xrange(nfiles):
+            filename = os.path.join(dirname, "q%d_%04d.bin" % (qidx, fidx))
+            queue_values[fidx].tofile(filename)
+            filenames.append(filename)
+        queues.append(filenames)
+        values.append(queue_values.astype(dtype))
+    return Case(queues, dtype, indtype, shape, linear, int(startlinidx)), values
+
+
+def check(ncases, seed, tmpdir, verbose=False):
+    """Checks all implementations against the reference over ncases random cases of each kind, returning a list of
+    failure messages.
+    """
+    rng = np.random.RandomState(seed)
+    failures = []
+    for kind in KINDS:
+        for caseidx in xrange(ncases):
+            dirname = tempfile.mkdtemp(dir=tmpdir)
+            try:
+                case, values = random_case(kind, rng, dirname)
+                try:
+                    expected = reference(kind, case, values)
+                except ValueError:
+                    expected = ValueError
+                for name, fcn in IMPLEMENTATIONS[kind].iteritems():
+                    try:
+                        output = fcn(case)
+                    except ValueError, e:
+                        output = ValueError
+                        if expected is not ValueError and verbose:
+                            print "%s/%s raised: %s" % (kind, name, e)
+                    except Exception, e:
+                        output = "%s: %s" % (type(e).__name__, e)
+                    if output != expected:
+                        failures.append("%s/%s differs from reference for case %d: %s" % (
+                            kind, name, caseidx, _describe(case, values)))
+            finally:
+                shutil.rmtree(dirname)
+        print "Checked %d implementations of %s over %d cases" % (len(IMPLEMENTATIONS[kind]), kind, ncases)
+    return failures
+
+
+def _describe(case, values):
+    return "%d queue(s) of %s files of %s elements, indtype %s, dtype %s, shape %s, linear %s, startlinidx %d" % (
+        len(case.queues), values[0].shape[0], [v.shape[1] for v in values], case.indtype, case.dtype, case.shape,
+        case.linear, case.startlinidx)
+
+
+def bench(sizes, repeats, tmpdir, dtype="uint16"):
+    """Times each implementation over the passed list of (nfiles, nelements) sizes, returning an OrderedDict of
+    'kind/name/<nfiles>x<nelements>' to throughput in input MB/s, the best of repeats calls.
+    """
+    results = OrderedDict()
+    for nfiles, nelements in sizes:
+        dirname = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            queues = []
+            for qidx in xrange(2):
+                filenames = [os.path.join(dirname, "q%d_%04d.bin" % (qidx, fidx)) for fidx in xrange(nfiles)]
+                for filename in filenames:
+                    np.arange(nelements, dtype=dtype).tofile(filename)
+                queues.append(filenames)
+            shape = (nelements, 1, 1)
+            cases = {
+                "flat": Case(queues[:1], dtype, dtype, None, False, 0),
+                "series": Case(queues[:1], dtype, dtype, shape, False, 0),
+                "linear": Case(queues[:1], "uint32", dtype, None, True, 0),
+                "matches": Case(queues, dtype, dtype, shape, False, 0),
+            }
+            for kind in KINDS:
+                case = cases[kind]
+                nbytes = len(case.queues) * nfiles * nelements * np.dtype(dtype).itemsize
+                for name, fcn in IMPLEMENTATIONS[kind].iteritems():
+                    best = None
+                    for _ in xrange(repeats):
+                        start = time.time()
+                        fcn(case)
+                        elapsed = time.time() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    results["%s/%s/%dx%d" % (kind, name, nfiles, nelements)] = nbytes / best / 1e6
+        finally:
+            shutil.rmtree(dirname)
+    return results
+
+
+def find_regressions(results, previous, threshold):
+    regressions = []
+    for key, throughput in results.iteritems():
+        old = previous.get(key)
+        if old and throughput < old * (1.0 - threshold):
+            regressions.append("%s: %.1f MB/s, down from %.1f MB/s (%+.1f%%)" % (
+                key, throughput, old, 100.0 * (throughput - old) / old))
+    return regressions
+
+
+def parse_sizes(sizes):
+    parsed = []
+    for size in sizes.split(","):
+        nfiles, nelements = size.strip().split("x")
+        parsed.append((int(nfiles), int(nelements)))
+    return parsed
+
+
+def parse_options():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--cases", type="int", default=200,
+                      help="Number of random equivalence cases of each kind, default %default")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed of the random cases, default %default")
+    parser.add_option("--sizes", default="8x16384,64x16384,8x262144,64x262144",
+                      help="Comma-separated sizes to time, as <number of files>x<elements per file>, " +
+                           "default %default")
+    parser.add_option("--repeats", type="int", default=5,
+                      help="Number of timed calls of each implementation at each size, of which the fastest is " +
+                           "kept, default %default")
+    parser.add_option("--no-check", dest="check", action="store_false", default=True,
+                      help="If set, skip the equivalence check")
+    parser.add_option("--no-bench", dest="bench", action="store_false", default=True,
+                      help="If set, skip timing")
+    parser.add_option("--tmpdir", default=None,
+                      help="Directory in which to write input files, default the system's")
+    parser.add_option("-o", "--output", default=None,
+                      help="File to write timing results to as JSON")
+    parser.add_option("--compare", default=None,
+                      help="JSON timing results of a previous run to compare with")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="Drop in throughput from the --compare results, as a fraction, beyond which an " +
+                           "implementation is flagged as having regressed, default %default")
+    parser.add_option("--verbose", action="store_true", default=False)
+    opts, args = parser.parse_args()
+    opts.sizes = parse_sizes(opts.sizes)
+    return opts
+
+
+def main():
+    opts = parse_options()
+    failures = []
+    if opts.check:
+        failures = check(opts.cases, opts.seed, opts.tmpdir, opts.verbose)
+
+    if opts.bench:
+        results = bench(opts.sizes, opts.repeats, opts.tmpdir)
+        previous = {}
+        if opts.compare:
+            with open(opts.compare) as fp:
+                previous = json.load(fp)["results"]
+        for key, throughput in results.iteritems():
+            old = previous.get(key)
+            change = " (%+.1f%%)" % (100.0 * (throughput - old) / old) if old else ""
+            print "%-72s %10.1f MB/s%s" % (key, throughput, change)
+        failures += ["regression in " + regression for regression in
+                     find_regressions(results, previous, opts.threshold)]
+        if opts.output:
+            with open(opts.output, "w") as fp:
+                json.dump(OrderedDict([("commit", git_commit()), ("time", time.time()), ("results", results)]), fp,
+                          indent=2)
+
+    if failures:
+        for failure in failures:
+            print >> sys.stderr, "FAILED: " + failure
+        sys.exit(1)
+    print "All checks passed"
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,25 @@
 import numpy as np
 
 
-def transpose_files(filenames, outfp, dtype='uint16'):
+def _fromfile(filename, dtype, reader=None):
+    if reader is None:
+        return np.fromfile(filename, dtype=dtype)
+    return reader(filename, dtype)
+
+
+def _read_batch(filenames, dtype='uint16', indtype='uint16', reader=None):
+    """Reads the passed files into a new 2d buffer of shape (nfiles, nelements per file), converted to dtype.
+    """
+    batch = None
+    for fnidx, fn in enumerate(filenames):
+        ary = _fromfile(fn, indtype, reader)
+        if batch is None:
+            batch = np.empty((len(filenames), ary.size), dtype=dtype)
+        batch[fnidx] = ary
+    return batch
+
+
+def transpose_files(filenames, outfp, dtype='uint16', stages=None, reader=None):
     """Rewrites the flat binary files whose names are given in 'filenames' into a single flat binary
     output file.
 
@@ -13,30 +31,66 @@ def transpose_files(filenames, outfp, dtype='uint16'):
     element in the output file will be the second element of the first passed file, and so on.
 
     This corresponds to a Thunder binary series file, except without keys.
+
+    If a StagePipeline is passed as 'stages', it is run over the batch of input files before transposition.
+
+    If a 'reader' function is passed, input files are read by calling reader(filename, dtype) rather than
+    np.fromfile(); see for instance Prefetcher.fromfile().
+    """
+    outbuf, ary_size = transpose_files_to_array(filenames, dtype=dtype, stages=stages, reader=reader)
+    if outbuf is not None:
+        outbuf.tofile(outfp)
+    return ary_size  # number of distinct indices written
+
+
+def transpose_files_to_array(filenames, dtype='uint16', stages=None, reader=None, indtype=None):
+    """As transpose_files(), but returns the output as an in-memory array rather than writing it to a file.
+
+    If an 'indtype' is passed, input files are read as indtype and converted to dtype, rather than read as dtype.
+
+    Returns
+    -------
+    (array or None if no filenames are passed, number of distinct indices)
     """
+    indtype = dtype if indtype is None else indtype
+    if stages is not None:
+        batch = _read_batch(filenames, dtype=dtype, indtype=indtype, reader=reader)
+        if batch is None:
+            return None, 0
+        batch = stages.run(batch)
+        return np.ascontiguousarray(batch.T), batch.shape[1]
+
     outbuf = None
     nfiles = len(filenames)
     ary_size = 0
     for fnidx, fn in enumerate(filenames):
-        ary = np.fromfile(fn, dtype=dtype)
+        ary = _fromfile(fn, indtype, reader)
         if outbuf is None:
             ary_size = ary.size
             totsize = ary_size * nfiles
             outbuf = np.empty((totsize,), dtype=dtype)
         outbuf[fnidx::nfiles] = ary
-    if outbuf is not None:
-        outbuf.tofile(outfp)
-    return ary_size  # number of distinct indices written
+    return outbuf, ary_size
 
 
-def _write_series_records(filenames, ndim=1, dtype='uint16', indtype='uint16'):
+def _write_series_records(filenames, ndim=1, dtype='uint16', indtype='uint16', stages=None, reader=None):
     """Transposes the contents of the passed filenames into a new (large) in-memory buffer
     """
+    if stages is not None:
+        batch = _read_batch(filenames, dtype=dtype, indtype=indtype, reader=reader)
+        if batch is None:
+            return None, 0
+        batch = stages.run(batch)
+        ary_size = batch.shape[1]
+        outbuf = np.empty((ary_size, len(filenames) + ndim), dtype=dtype)
+        outbuf[:, ndim:] = batch.T
+        return outbuf.ravel(), ary_size
+
     outbuf = None
     ary_size = 0
     incr = len(filenames) + ndim
     for fnidx, fn in enumerate(filenames):
-        ary = np.fromfile(fn, dtype=indtype).astype(dtype)
+        ary = _fromfile(fn, indtype, reader).astype(dtype)
         if outbuf is None:
             ary_size = ary.size
             totsize = ary_size * incr  # (nelts per image * (n images + ndim))
@@ -45,7 +99,8 @@ def _write_series_records(filenames, ndim=1, dtype='uint16', indtype='uint16'):
     return outbuf, ary_size
 
 
-def transpose_files_to_series(filenames, outfp, shape, dtype='uint16', indtype='uint16', startlinidx=0):
+def transpose_files_to_series(filenames, outfp, shape, dtype='uint16', indtype='uint16', startlinidx=0,
+                              stages=None, reader=None):
     """Rewrites the flat binary files whose names are given in 'filenames' into a valid Thunder binary series
     file, including keys.
 
@@ -53,10 +108,31 @@ def transpose_files_to_series(filenames, outfp, shape, dtype='uint16', indtype='
     startlinidx = prod(shape), this allows subscript indices to be written that are greater than fit into the
     specified shape. This is expected to be useful in appending behavioral regressor data at the end of an
     otherwise valid image series.
+
+    If a StagePipeline is passed as 'stages', it is run over the batch of input files before transposition.
+
+    If a 'reader' function is passed, input files are read by calling reader(filename, dtype) rather than
+    np.fromfile(); see for instance Prefetcher.fromfile().
+    """
+    outbuf, ary_size = transpose_files_to_series_array(filenames, shape, dtype=dtype, indtype=indtype,
+                                                       startlinidx=startlinidx, stages=stages, reader=reader)
+    if outbuf is not None:
+        outbuf.tofile(outfp)
+    return ary_size
+
+
+def transpose_files_to_series_array(filenames, shape, dtype='uint16', indtype='uint16', startlinidx=0, stages=None,
+                                    reader=None):
+    """As transpose_files_to_series(), but returns the output as an in-memory array rather than writing it to a file.
+
+    Returns
+    -------
+    (array or None if no filenames are passed, number of distinct indices)
     """
     nfiles = len(filenames)
     incr = nfiles + len(shape)
-    outbuf, ary_size = _write_series_records(filenames, ndim=len(shape), dtype=dtype, indtype=indtype)
+    outbuf, ary_size = _write_series_records(filenames, ndim=len(shape), dtype=dtype, indtype=indtype,
+                                             stages=stages, reader=reader)
 
     # check whether we are about to exceed the allowable range for the array size
     while (startlinidx + ary_size) >= np.prod(shape):
@@ -64,29 +140,172 @@ def transpose_files_to_series(filenames, outfp, shape, dtype='uint16', indtype='
 
     subidxarys = np.unravel_index(np.arange(startlinidx, startlinidx + ary_size,
                                             dtype=np.uint32), shape, order='F')
-    for subidx, subidxary in enumerate(subidxarys):
-        outbuf[subidx::incr] = subidxary
     if outbuf is not None:
-        outbuf.tofile(outfp)
-    return ary_size
+        for subidx, subidxary in enumerate(subidxarys):
+            outbuf[subidx::incr] = subidxary
+    return outbuf, ary_size
+
 
+def _check_linear_range(dtype, maxidx):
+    ddtype = np.dtype(dtype)
+    maxval = np.iinfo(ddtype).max if ddtype.kind in ('i', 'u') else np.finfo(ddtype).max
+    if maxidx >= maxval:
+        raise ValueError("Type '%s' isn't large enough to represent linear indices; " % str(dtype) +
+                         "max index is %d, max representable val is %d" % (maxidx, int(maxval)))
 
-def transpose_files_to_linear_series(filenames, outfp, dtype='uint32', indtype='uint16', startlinidx=0):
+
+def transpose_files_to_linear_series(filenames, outfp, dtype='uint32', indtype='uint16', startlinidx=0,
+                                     stages=None, reader=None):
     """Rewrites the flat binary files whose names are given in 'filenames' into a valid Thunder binary series
     file, including linear keys.
+
+    If a StagePipeline is passed as 'stages', it is run over the batch of input files before transposition.
+
+    If a 'reader' function is passed, input files are read by calling reader(filename, dtype) rather than
+    np.fromfile(); see for instance Prefetcher.fromfile().
+    """
+    outbuf, ary_size = transpose_files_to_linear_series_array(filenames, dtype=dtype, indtype=indtype,
+                                                              startlinidx=startlinidx, stages=stages,
+                                                              reader=reader)
+    if outbuf is not None:
+        outbuf.tofile(outfp)
+    return ary_size
+
+
+def transpose_files_to_linear_series_array(filenames, dtype='uint32', indtype='uint16', startlinidx=0, stages=None,
+                                           reader=None):
+    """As transpose_files_to_linear_series(), but returns the output as an in-memory array rather than writing it
+    to a file.
+
+    Returns
+    -------
+    (array or None if no filenames are passed, number of distinct indices)
     """
     nfiles = len(filenames)
     incr = nfiles + 1
-    outbuf, ary_size = _write_series_records(filenames, ndim=1, dtype=dtype, indtype=indtype)
-
-    ddtype = np.dtype(dtype)
-    maxval = np.iinfo(ddtype).max if ddtype.kind in ('i', 'u') else np.finfo(ddtype).max
-    if startlinidx + ary_size >= maxval:
-        raise ValueError("Type '%s' isn't large enough to represent linear indices; " % str(dtype) +
-                         "max index is %d, max representable val is %d" % (startlinidx + ary_size, int(maxval)))
+    outbuf, ary_size = _write_series_records(filenames, ndim=1, dtype=dtype, indtype=indtype, stages=stages,
+                                             reader=reader)
 
+    _check_linear_range(dtype, startlinidx + ary_size)
     linidxs = np.arange(startlinidx, startlinidx + ary_size)
     if outbuf is not None:
         outbuf[::incr] = linidxs
-        outbuf.tofile(outfp)
-    return ary_size
\ No newline at end of file
+    return outbuf, ary_size
+
+
+def transpose_queue_files_to_array(filenames, spec, shape=None, linear=False, dtype='uint16', indtype='uint16',
+                                   startlinidx=0, stages=None, reader=None):
+    """Transposes the files of a single queue into Series records, decoding them as described by the QueueSpec
+    'spec' rather than as flat arrays of indtype.
+
+    Keys are written as by transpose_files_to_linear_series() if 'linear' is set, as by
+    transpose_files_to_series() if a 'shape' is given, and not at all otherwise, unless the spec asks for the
+    queue's own keys. Unless there are stages to run, each file is decoded (including any byte swapping) and
+    converted to dtype by a single assignment straight into its column of the record buffer.
+
+    Returns
+    -------
+    (array or None if no filenames are passed, number of distinct indices)
+    """
+    nfiles = len(filenames)
+    ndim = 1 if linear else (len(shape) if shape is not None else 0)
+    if not nfiles:
+        return None, 0
+
+    if stages is not None:
+        batch = None
+        for fnidx, fn in enumerate(filenames):
+            values = spec.decode(_fromfile(fn, np.uint8, reader), indtype, fn)
+            if batch is None:
+                batch = np.empty((nfiles, values.size), dtype=dtype)
+            batch[fnidx] = values
+        batch = stages.run(batch)
+        ary_size = batch.shape[1]
+        records = np.empty((ary_size, nfiles + ndim), dtype=dtype)
+        records[:, ndim:] = batch.T
+    else:
+        records = None
+        for fnidx, fn in enumerate(filenames):
+            values = spec.decode(_fromfile(fn, np.uint8, reader), indtype, fn)
+            if records is None:
+                records = np.empty((values.size, nfiles + ndim), dtype=dtype)
+            records[:, ndim + fnidx] = values
+        ary_size = records.shape[0]
+
+    if ndim and spec.keys == 'own':
+        keys = spec.own_keys(ary_size, ndim)
+        if linear:
+            _check_linear_range(dtype, int(keys[0][-1]) if ary_size else 0)
+    elif linear:
+        _check_linear_range(dtype, startlinidx + ary_size)
+        keys = [np.arange(startlinidx, startlinidx + ary_size)]
+    elif ndim:
+        while (startlinidx + ary_size) >= np.prod(shape):
+            shape = list(shape[:-1]) + [shape[-1] + 1]
+        keys = np.unravel_index(np.arange(startlinidx, startlinidx + ary_size, dtype=np.uint32), shape, order='F')
+    else:
+        keys = []
+    for keyidx, keyary in enumerate(keys):
+        records[:, keyidx] = keyary
+    return records.ravel(), ary_size
+
+
+def transpose_matches_to_series_arrays(matches, prefixes, shape=None, linear=False, dtype='uint16', indtype='uint16',
+                                       stages=None, reader=None, queue_specs=None):
+    """Transposes matched files into Series records, as written out by SyncSeriesFeeder.
+
+    'matches' is a list of (timepoint, {qname: filename}) pairs sorted by timepoint. Records are written for each
+    queue in the order given by 'prefixes', with linear indices continuing from one queue to the next. If neither
+    'shape' nor 'linear' is given, records have no keys (see transpose_files()).
+
+    If a 'stages' dict is given, it should map queue names to StagePipelines to run over that queue's files.
+
+    If a 'queue_specs' dict is given, it should map queue names to QueueSpecs describing how that queue's files
+    are to be decoded and keyed; see transpose_queue_files_to_array(). Other queues' files are read as flat arrays
+    of indtype.
+
+    Returns
+    -------
+    (list of arrays, to be written out in order; list of input filenames; record size in bytes)
+    """
+    stages = stages or {}
+    queue_specs = queue_specs or {}
+    arrays = []
+    fullnames = []
+    nindices_written = 0
+    ninput_files = 0
+    for prefix in prefixes:
+        # matches are sorted by timepoint
+        curnames = [qname_to_filename[prefix] for _, qname_to_filename in matches]
+        fullnames.extend(curnames)
+        ninput_files = len(curnames)  # should be same for all prefixes
+        curstages = stages.get(prefix)
+        if prefix in queue_specs:
+            outbuf, ary_size = transpose_queue_files_to_array(curnames, queue_specs[prefix], shape=shape,
+                                                              linear=linear, dtype=dtype, indtype=indtype,
+                                                              startlinidx=nindices_written, stages=curstages,
+                                                              reader=reader)
+        elif (not linear) and (shape is None):
+            outbuf, ary_size = transpose_files_to_array(curnames, dtype=dtype, stages=curstages, reader=reader,
+                                                        indtype=indtype)
+        elif linear:
+            outbuf, ary_size = transpose_files_to_linear_series_array(curnames, dtype=dtype, indtype=indtype,
+                                                                      startlinidx=nindices_written,
+                                                                      stages=curstages, reader=reader)
+        else:
+            outbuf, ary_size = transpose_files_to_series_array(curnames, tuple(shape), dtype=dtype, indtype=indtype,
+                                                               startlinidx=nindices_written,
+                                                               stages=curstages, reader=reader)
+        if outbuf is not None:
+            arrays.append(outbuf)
+        nindices_written += ary_size
+
+    record_vals_size = ninput_files * np.dtype(dtype).itemsize
+    if linear:
+        recordsize = np.dtype(dtype).itemsize + record_vals_size
+    elif shape:
+        # keys are written in dtype, as are the values
+        recordsize = len(shape)*np.dtype(dtype).itemsize + record_vals_size
+    else:
+        recordsize = record_vals_size
+    return arrays, fullnames, recordsize
@@ -0,0 +1,395 @@
+"""Lightweight timers and counters for the feeder, exported in Prometheus text format over HTTP and optionally
+dumped as JSON lines.
+
+Defines a global registry as `global_metrics`. Metrics are looked up by name and labels when a feeder is
+constructed, and then updated directly. Recording is off unless one of the export options added by
+add_metrics_options() is given on the command line: until then the registry hands out metrics whose updates do
+nothing, and registers no callbacks.
+
+When recording, counters and histograms only append the value passed to a deque, which is safe without a lock as the
+threads of several sinks share stage timers, and costs well under a microsecond; the values appended are added up
+into totals and buckets when metrics are exported, and at least every --metrics-interval s. Values that a feeder
+already keeps track of, such as queue depths, are instead registered as callbacks, which are only evaluated when
+metrics are exported.
+
+Timings of each step of the feeder are recorded in the feeder_stage_seconds histogram, labelled by stage:
+* walk, stat: listing and stat'ing the input directories
+* match: matching files by timepoint
+* read, transpose: reading input files and transposing them into Series records
+* write, rename: writing output into the staging directory, and moving it into the feeder directory
+* clean: removing expired output files
+Steps that handle no files, such as feeding or cleaning up nothing, are not timed, as recording them would cost
+about as much as the steps themselves.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque, OrderedDict
+import json
+import os
+from threading import Lock, Thread
+import time
+
+import numpy as np
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+# upper bounds in s of the buckets of latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                           30.0, 60.0)
+
+
+class _Recorder(object):
+    """Base of the metrics that record each value by appending it to a deque, which is atomic and so needs no lock,
+    and only add up the values recorded when they are taken, on export.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = deque()
+
+    def _take(self):
+        """Returns the values recorded since the last call; must be called holding self._lock.
+        """
+        popleft = self._pending.popleft
+        return [popleft() for _ in xrange(len(self._pending))]
+
+
+class Counter(_Recorder):
+    kind = "counter"
+
+    def __init__(self):
+        _Recorder.__init__(self)
+        self._value = 0
+
+    def inc(self, amount=1):
+        self._pending.append(amount)
+
+    @property
+    def value(self):
+        with self._lock:
+            self._value += sum(self._take())
+            return self._value
+
+
+class Gauge(object):
+    kind = "gauge"
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+
+class Histogram(_Recorder):
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        _Recorder.__init__(self)
+        self.bounds = tuple(sorted(buckets))
+        # the last count is for values above the largest bound
+        self._counts = np.zeros(len(self.bounds) + 1, dtype='int64')
+        self._sum = 0.0
+        # observe(value) is the append method of the deque itself, saving a Python call per value
+        self.observe = self._pending.append
+
+    def totals(self):
+        """Returns the count and sum of the values observed so far, and the cumulative count of each bucket.
+        """
+        with self._lock:
+            values = np.array(self._take(), dtype='float64')
+            if len(values):
+                # side='left' puts a value equal to a bound into that bound's bucket, as 'le' requires
+                self._counts += np.bincount(np.searchsorted(self.bounds, values, side='left'),
+                                            minlength=len(self._counts))
+                self._sum += float(values.sum())
+            cumulative = np.cumsum(self._counts).tolist()
+            return cumulative[-1], self._sum, cumulative
+
+
+class _NullMetric(object):
+    """Stands in for any metric while recording is off; updates do nothing.
+    """
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+_NULL_METRIC = _NullMetric()
+
+
+class _Callback(object):
+    """A counter or gauge whose value is read from functions when it is exported: the sum of the values returned by
+    each function registered under the same name and labels.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.fcns = []
+
+    @property
+    def value(self):
+        try:
+            return sum(fcn() for fcn in list(self.fcns))
+        except Exception:
+            # for instance multiprocessing.Queue.qsize() is not implemented on all platforms
+            return float('nan')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in items]
+    return "{" + ",".join('%s="%s"' % item for item in escaped) + "}"
+
+
+def _format_value(value):
+    if value != value:
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry(object):
+    """A set of named metrics, each of which may have several instances with different labels.
+
+    Asking for a metric that already exists with the same name and labels returns the existing instance, so that
+    for instance several feeders in one process add to the same counters. Likewise, callbacks registered with the
+    same name and labels are all kept, and their values added up when exported.
+
+    Labels in const_labels, such as the name of a pipeline process, are added to all exported metrics.
+
+    While enabled is False, metrics asked for are not recorded: a metric that does nothing is returned instead, and
+    callbacks are dropped.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._families = OrderedDict()  # name -> (kind, help)
+        self._metrics = OrderedDict()  # (name, sorted label items) -> metric
+        self.const_labels = {}
+
+    def _get(self, name, kind, help, labels, factory):
+        if not self.enabled:
+            return _NULL_METRIC
+        key = (name, tuple(sorted(labels.iteritems())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    family_kind, _ = self._families.setdefault(name, (kind, help))
+                    if family_kind != kind:
+                        raise ValueError("Metric '%s' is a %s, not a %s" % (name, family_kind, kind))
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get(name, "counter", help, labels, Counter)
+
+    def gauge(self, name, help="", **labels):
+        return self._get(name, "gauge", help, labels, Gauge)
+
+    def histogram(self, name, help="", buckets=DEFAULT_LATENCY_BUCKETS, **labels):
+        return self._get(name, "histogram", help, labels, lambda: Histogram(buckets))
+
+    def counter_callback(self, name, fcn, help="", **labels):
+        """Registers a counter whose value is the return value of fcn, for counts kept elsewhere.
+        """
+        return self._add_callback(name, "counter", fcn, help, labels)
+
+    def gauge_callback(self, name, fcn, help="", **labels):
+        """Registers a gauge whose value is the return value of fcn, such as the length of a queue.
+        """
+        return self._add_callback(name, "gauge", fcn, help, labels)
+
+    def _add_callback(self, name, kind, fcn, help, labels):
+        callback = self._get(name, kind, help, labels, lambda: _Callback(kind))
+        if callback is _NULL_METRIC:
+            return callback
+        with self._lock:
+            callback.fcns.append(fcn)
+        return callback
+
+    def stage_timer(self, stage):
+        """Returns the histogram of time spent in the passed feeder stage; see the module documentation.
+        """
+        return self.histogram("feeder_stage_seconds", "Time spent in each stage of the feeder, per call",
+                              stage=stage)
+
+    def _items(self):
+        with self._lock:
+            families = self._families.items()
+            metrics = self._metrics.items()
+        const = tuple(sorted(self.const_labels.iteritems()))
+        for name, (kind, help) in families:
+            yield name, kind, help, [(const + labels, metric) for (mname, labels), metric in metrics if mname == name]
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, kind, help, instances in self._items():
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, metric in instances:
+                if kind == "histogram":
+                    count, total_sum, cumulative = metric.totals()
+                    for bound, bucket_count in zip(metric.bounds + ("+Inf",), cumulative):
+                        le = bound if isinstance(bound, str) else _format_value(float(bound))
+                        lines.append("%s_bucket%s %d" % (name, _format_labels(labels, ("le", le)), bucket_count))
+                    lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(total_sum)))
+                    lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+                else:
+                    lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns a list of dicts describing the current value of each metric, for dumping as JSON.
+        """
+        snapshot = []
+        for name, kind, _, instances in self._items():
+            for labels, metric in instances:
+                entry = {"name": name, "labels": dict(labels)}
+                if kind == "histogram":
+                    count, total_sum, cumulative = metric.totals()
+                    entry.update(count=count, sum=total_sum,
+                                 buckets=[[bound, bucket_count] for bound, bucket_count in
+                                          zip(metric.bounds + (None,), cumulative)])
+                else:
+                    value = metric.value
+                    entry["value"] = None if value != value else value
+                snapshot.append(entry)
+        return snapshot
+
+global_metrics = MetricsRegistry(enabled=False)
+
+
+class MetricsServer(Thread):
+    """Daemon thread serving the metrics of the passed registry over HTTP, in Prometheus text format at /metrics,
+    and as JSON at /metrics.json.
+
+    The port is bound on construction, so that a port already in use raises socket.error at once.
+    """
+    def __init__(self, port, addr="127.0.0.1", registry=None):
+        Thread.__init__(self, name="metrics-server")
+        self.setDaemon(True)
+        registry = registry if registry is not None else global_metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path in ("/", "/metrics"):
+                    body, content_type = registry.render(), "text/plain; version=0.0.4"
+                elif path == "/metrics.json":
+                    body, content_type = json.dumps(registry.snapshot()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((addr, int(port)), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+
+class MetricsDumper(Thread):
+    """Daemon thread appending a snapshot of the metrics of the passed registry to a file as a line of JSON every
+    interval seconds.
+
+    If filename is None, the snapshot is only taken, which adds up the values recorded since the last one, so that
+    they do not pile up between exports over HTTP.
+    """
+    def __init__(self, filename, interval=10.0, registry=None):
+        Thread.__init__(self, name="metrics-dumper")
+        self.setDaemon(True)
+        self.filename = filename
+        self.interval = float(interval)
+        self.registry = registry if registry is not None else global_metrics
+
+    def dump(self):
+        line = json.dumps({"time": time.time(), "pid": os.getpid(), "metrics": self.registry.snapshot()})
+        if self.filename is None:
+            return
+        with open(self.filename, "a") as fp:
+            fp.write(line + "\n")
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except (IOError, OSError), e:
+                global_logger.warnIfNotAlreadyGiven("Could not write metrics to '%s': %s", self.filename, e)
+
+
+def _enable_if_exported(option, opt_str, value, parser):
+    setattr(parser.values, option.dest, value)
+    if value:
+        global_metrics.enabled = True
+
+
+def add_metrics_options(parser):
+    """Adds options controlling the export of metrics to the passed optparse.OptionParser.
+
+    Giving --metrics-port or --metrics-file turns on recording in global_metrics as soon as the option is parsed, so
+    before any feeder is constructed; without either, metrics cost nothing.
+    """
+    parser.add_option("--metrics-port", type="int", default=0, action="callback", callback=_enable_if_exported,
+                      help="Serve metrics in Prometheus text format over HTTP on this port (zero disables), " +
+                           "default %default")
+    parser.add_option("--metrics-addr", default="127.0.0.1",
+                      help="Address to serve metrics on, default %default")
+    parser.add_option("--metrics-file", default=None, type="string", action="callback",
+                      callback=_enable_if_exported,
+                      help="If given, append a JSON line with the current metrics to this file every " +
+                           "--metrics-interval s")
+    parser.add_option("--metrics-interval", type="float", default=10.0,
+                      help="Time in s between metrics written to --metrics-file, or added up when only served over " +
+                           "HTTP, default %default")
+
+
+def start_metrics(opts, process_name=None, port_offset=0):
+    """Starts serving and dumping metrics from this process as specified by the options added by
+    add_metrics_options().
+
+    When each of several processes exports its own metrics, each should pass a distinct process_name, which is
+    added to their metrics as a 'process' label and to the name of the metrics file, and a distinct port_offset,
+    which is added to the port.
+    """
+    if process_name:
+        global_metrics.const_labels["process"] = process_name
+    if opts.metrics_port > 0:
+        port = opts.metrics_port + port_offset
+        MetricsServer(port, opts.metrics_addr).start()
+        global_logger.get().info("Serving metrics on http://%s:%d/metrics", opts.metrics_addr, port)
+    if opts.metrics_file:
+        filename = opts.metrics_file
+        if process_name:
+            filename = "%s.%s" % (filename, process_name)
+        MetricsDumper(filename, opts.metrics_interval).start()
+    elif opts.metrics_port > 0:
+        MetricsDumper(None, opts.metrics_interval).start()
@@ -0,0 +1,212 @@
+"""Background reading of input files ahead of their use, for input directories on slow (network) filesystems.
+
+Reading input files one at a time in the transpose loop means waiting for one network round trip per file. The
+Prefetcher instead starts reading each file on a pool of background threads as soon as the feeder is passed it,
+while it waits to be matched, and asks the kernel to start readahead with posix_fadvise(POSIX_FADV_WILLNEED).
+Once a file has been written out, it is dropped from the page cache with POSIX_FADV_DONTNEED, so that input data
+read once does not evict pages that Spark will be reading.
+"""
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Event, Lock
+
+import numpy as np
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+# Linux values; only available from the os module in more recent pythons:
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+
+def _load_posix_fadvise():
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is not None:
+        return fadvise
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_fadvise = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    libc_fadvise.restype = ctypes.c_int
+
+    def fadvise(fd, offset, length, advice):
+        # posix_fadvise returns an error number rather than setting errno
+        err = libc_fadvise(fd, offset, length, advice)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return fadvise
+
+_posix_fadvise = _load_posix_fadvise()
+
+
+def advise_file(filename, advice):
+    """Passes the given advice (POSIX_FADV_WILLNEED or POSIX_FADV_DONTNEED) on the whole of the passed file to the
+    kernel. Returns True on success, False if fadvise is not available or fails.
+    """
+    if _posix_fadvise is None:
+        return False
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        _posix_fadvise(fd, 0, 0, advice)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def read_file(filename):
+    """Returns the contents of the passed file as a string.
+    """
+    with open(filename, 'rb') as fp:
+        return fp.read()
+
+
+class _PendingRead(object):
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.done = Event()
+        self.data = None
+
+
+class Prefetcher(object):
+    """Reads files on background threads ahead of their use.
+
+    Files passed to prefetch() are read into memory in parallel. A later call to fromfile() for one of these files
+    returns its prefetched contents, waiting for the read to finish if necessary, and forgets them. Files are read
+    directly if they were never prefetched.
+
+    At most max_bytes of file contents are held. Beyond this, files are only advised to the kernel with
+    POSIX_FADV_WILLNEED, and if there are prefetched files that have not been used for longer than this (for
+    instance because their timepoint was never matched), the oldest are dropped.
+
+    Parameters
+    ----------
+    nthreads: int
+        Number of background reads to run in parallel.
+    max_bytes: int
+        Maximum total size of prefetched files to hold in memory.
+    read_fcn: function, optional
+        Function taking a filename and returning the file's contents as a string. Defaults to read_file(); may be
+        replaced by a throttled reader for testing (see testutils/throttled_reader.py).
+    drop_after_use: bool
+        Whether release() should drop files from the page cache.
+    """
+    def __init__(self, nthreads=4, max_bytes=256*1024*1024, read_fcn=None, drop_after_use=True):
+        self.max_bytes = int(max_bytes)
+        self.read_fcn = read_fcn if read_fcn is not None else read_file
+        self.drop_after_use = drop_after_use
+        self.nthreads = nthreads
+        # created on first use, so that a Prefetcher can be passed to a forked process before use:
+        self._pool = None
+        self._pool_pid = None
+        self._lock = Lock()
+        # filename -> _PendingRead, in order of prefetch() calls:
+        self._pending = OrderedDict()
+        self._nbytes = 0
+        self.nhits = self.nmisses = 0
+
+    def _get_pool(self):
+        if self._pool_pid != os.getpid():
+            self._pool = ThreadPool(self.nthreads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _read(self, filename, pending):
+        try:
+            pending.data = self.read_fcn(filename)
+        except (IOError, OSError), e:
+            # fromfile() will read the file itself and raise any error there
+            global_logger.get().warn("Could not prefetch '%s': %s", filename, e)
+        finally:
+            pending.done.set()
+
+    def _evict_oldest(self):
+        # called with self._lock held; only drops reads that have finished, since the others are counted as hits
+        for filename, pending in self._pending.iteritems():
+            if pending.done.is_set():
+                del self._pending[filename]
+                self._nbytes -= pending.nbytes
+                return True
+        return False
+
+    def prefetch(self, filenames):
+        """Starts reading the passed files in the background.
+        """
+        for filename in filenames:
+            if filename in self._pending:
+                continue
+            try:
+                nbytes = os.path.getsize(filename)
+            except OSError:
+                continue
+            advise_file(filename, POSIX_FADV_WILLNEED)
+            with self._lock:
+                while self._nbytes + nbytes > self.max_bytes and self._evict_oldest():
+                    pass
+                if self._nbytes + nbytes > self.max_bytes:
+                    continue
+                pending = self._pending[filename] = _PendingRead(nbytes)
+                self._nbytes += nbytes
+            self._get_pool().apply_async(self._read, (filename, pending))
+
+    def fromfile(self, filename, dtype):
+        """Returns the contents of the passed file as a 1d array of dtype, as np.fromfile() would.
+
+        This may be passed as the 'reader' argument of the functions in transpose.py.
+        """
+        with self._lock:
+            pending = self._pending.pop(filename, None)
+            if pending is not None:
+                self._nbytes -= pending.nbytes
+        if pending is not None:
+            pending.done.wait()
+        if pending is not None and pending.data is not None:
+            self.nhits += 1
+            data = pending.data
+        else:
+            self.nmisses += 1
+            data = self.read_fcn(filename)
+        # like np.fromfile(), ignores any trailing partial element
+        dtype = np.dtype(dtype)
+        return np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+
+    def release(self, filenames):
+        """Called with files that have been used, to drop them from the page cache and forget any prefetched
+        contents.
+        """
+        with self._lock:
+            for filename in filenames:
+                pending = self._pending.pop(filename, None)
+                if pending is not None:
+                    self._nbytes -= pending.nbytes
+        if self.drop_after_use:
+            for filename in filenames:
+                advise_file(filename, POSIX_FADV_DONTNEED)
+
+
+def add_prefetch_options(parser):
+    """Adds options controlling input prefetching to the passed optparse.OptionParser.
+    """
+    parser.add_option("--prefetch-threads", type="int", default=0,
+                      help="Read input files on this many background threads ahead of their use, for input " +
+                           "directories on network filesystems (zero disables), default %default")
+    parser.add_option("--prefetch-mb", type="float", default=256.0,
+                      help="Maximum size in MB of prefetched input held in memory, default %default")
+
+
+def get_prefetcher(opts):
+    """Returns a Prefetcher as specified by the options added by add_prefetch_options(), or None if prefetching
+    is disabled.
+    """
+    if opts.prefetch_threads <= 0:
+        return None
+    return Prefetcher(nthreads=opts.prefetch_threads, max_bytes=int(opts.prefetch_mb * 1024 * 1024))
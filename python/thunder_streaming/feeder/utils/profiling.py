@@ -0,0 +1,461 @@
+"""On-demand profiling of running feeder and shell processes, for diagnosing stalls without restarting them.
+
+Defines a global profiler as `global_profiler`. Hot calls are made through global_profiler.call(name, fcn, *args),
+which costs a single attribute check while no profiling session is active. Hooked calls are:
+* feed: each Feeder.feed() call made by a FeedCycle
+* discover, match, transform, publish: the stages of a pipelined feeder (see feeder/pipeline.py)
+* monitor: each poll of an Analysis' output directory by its FileMonitor
+* convert: each converter handling new output from a FileMonitor, or a frame from a FeederPreview
+A call hooked from within another hooked call on the same thread is not hooked again.
+
+A session runs for the next N hooked calls, or for N seconds, in one of these modes:
+* sample: a thread samples the stacks of all other threads every --profile-interval s, and writes the counts of each
+  distinct stack as a collapsed-stack file (<thread>;<outermost frame>;...;<innermost frame> <count>), as read by
+  flamegraph.pl or speedscope. This is cheap, and also shows where a call that never returns is stuck.
+* cprofile: hooked calls are run under cProfile, and a pstats file is written for each hook and thread.
+* tracemalloc: memory allocations are traced, and the top allocation sites are written as text along with a
+  snapshot. This needs the tracemalloc module, which under python 2 is provided by the pytracemalloc backport.
+Output files are written into --profile-dir, named <process>-<pid>-<time>[-<hook>-<thread>].<extension>.
+
+Sessions are started by sending the process SIGUSR2, which starts a session with the defaults given by the
+--profile-* options, or ends the active session early. With --profile-socket, commands are also accepted on a unix
+socket, one per connection, and answered with a single line:
+    <mode> [calls=N] [seconds=S] [interval=S]    start a session
+    stop                                         end the active session early
+    status                                       describe the active session
+For instance:
+python -m thunder_streaming.feeder.utils.profiling /tmp/feeder.sock cprofile calls=20
+"""
+import cProfile
+from collections import defaultdict
+import os
+import signal
+import socket
+import sys
+import tempfile
+from threading import current_thread, enumerate as enumerate_threads, Event, local, Lock, Thread, Timer
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from thunder_streaming.feeder.utils.logger import global_logger
+
+MODES = ("sample", "cprofile", "tracemalloc")
+
+# number of frames recorded for each allocation traced by tracemalloc, and of allocation sites written out
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 50
+
+
+class ProfilingSession(object):
+    """A profiling session, ending after calls hooked calls or seconds s, whichever comes first.
+
+    Subclasses run hooked calls in _call(), and write their output in _write(), returning the names of the files
+    written.
+    """
+    mode = None
+
+    def __init__(self, prefix, calls=None, seconds=None):
+        self.prefix = prefix
+        self.calls = calls
+        self.seconds = seconds
+        self.ncalls = 0
+        self.started = None
+        self.finished = False
+        self.filenames = []
+        self.on_finish = None
+        self._lock = Lock()
+        self._timer = None
+
+    def start(self):
+        self.started = time.time()
+        if self.seconds:
+            # a timer, rather than hooked calls, ends the session, so that it ends even if the hooked call stalls
+            self._timer = Timer(self.seconds, self.finish)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def call(self, name, fcn, args, kwargs):
+        try:
+            return self._call(name, fcn, args, kwargs)
+        finally:
+            with self._lock:
+                self.ncalls += 1
+                done = self.calls and self.ncalls >= self.calls
+            if done:
+                self.finish()
+
+    def _call(self, name, fcn, args, kwargs):
+        return fcn(*args, **kwargs)
+
+    def finish(self):
+        """Ends the session and writes its output, if it hasn't already ended.
+        """
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        if self._timer:
+            self._timer.cancel()
+        try:
+            self.filenames = self._write()
+        except (IOError, OSError), e:
+            global_logger.get().warn("Could not write %s profile to '%s*': %s", self.mode, self.prefix, e)
+        if self.on_finish:
+            self.on_finish(self)
+
+    def _write(self):
+        return []
+
+    def describe(self):
+        limits = []
+        if self.calls:
+            limits.append("%d/%d calls" % (self.ncalls, self.calls))
+        if self.seconds:
+            limits.append("%.1f/%g s" % (time.time() - self.started, self.seconds))
+        return "%s session writing to %s*, %s" % (self.mode, self.prefix, ", ".join(limits))
+
+
+class SamplingSession(ProfilingSession):
+    """Samples the stacks of all threads but its own every interval s, from a daemon thread.
+    """
+    mode = "sample"
+
+    def __init__(self, prefix, calls=None, seconds=None, interval=0.005):
+        super(SamplingSession, self).__init__(prefix, calls, seconds)
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self.nsamples = 0
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._sample, name="profile-sampler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        super(SamplingSession, self).start()
+
+    def _sample(self):
+        own = current_thread().ident
+        while not self._stopped.wait(self.interval):
+            names = dict((thread.ident, thread.name) for thread in enumerate_threads())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.nsamples += 1
+
+    def _write(self):
+        self._stopped.set()
+        if self._thread is not current_thread():
+            self._thread.join()
+        filename = self.prefix + ".collapsed"
+        with open(filename, "w") as fp:
+            for stack, count in sorted(self.counts.items()):
+                fp.write("%s %d\n" % (stack, count))
+        return [filename]
+
+
+class CProfileSession(ProfilingSession):
+    """Runs hooked calls under cProfile, with a profile for each hook and thread.
+
+    Profiles of calls still running when the session ends are written once those calls return.
+    """
+    mode = "cprofile"
+
+    def __init__(self, prefix, calls=None, seconds=None):
+        super(CProfileSession, self).__init__(prefix, calls, seconds)
+        self._profiles = {}
+        self._running = set()
+
+    def _filename(self, key):
+        name, ident, thread_name = key
+        return "%s-%s-%s.pstats" % (self.prefix, name, thread_name)
+
+    def _call(self, name, fcn, args, kwargs):
+        thread = current_thread()
+        key = (name, thread.ident, thread.name)
+        with self._lock:
+            if self.finished:
+                return fcn(*args, **kwargs)
+            profile = self._profiles.setdefault(key, cProfile.Profile())
+            self._running.add(key)
+        try:
+            return profile.runcall(fcn, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+                late = self.finished
+            if late:
+                filename = self._filename(key)
+                profile.dump_stats(filename)
+                global_logger.get().info("Wrote cprofile profile of a call that outlasted its session to %s",
+                                         filename)
+
+    def _write(self):
+        filenames = []
+        with self._lock:
+            done = [(key, profile) for key, profile in self._profiles.items() if key not in self._running]
+        for key, profile in done:
+            filename = self._filename(key)
+            profile.dump_stats(filename)
+            filenames.append(filename)
+        return filenames
+
+
+class TracemallocSession(ProfilingSession):
+    """Traces memory allocations with tracemalloc for the duration of the session.
+    """
+    mode = "tracemalloc"
+
+    def __init__(self, prefix, calls=None, seconds=None):
+        if tracemalloc is None:
+            raise ValueError("tracemalloc profiling needs the tracemalloc module (pytracemalloc under python 2)")
+        super(TracemallocSession, self).__init__(prefix, calls, seconds)
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracing = True
+        super(TracemallocSession, self).start()
+
+    def _write(self):
+        snapshot = tracemalloc.take_snapshot()
+        if self._started_tracing:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        snapshotname, textname = self.prefix + ".tracemalloc", self.prefix + ".txt"
+        snapshot.dump(snapshotname)
+        with open(textname, "w") as fp:
+            for stat in snapshot.statistics("traceback")[:TRACEMALLOC_TOP]:
+                fp.write("%s\n" % stat)
+                for line in stat.traceback.format():
+                    fp.write("%s\n" % line)
+                fp.write("\n")
+        return [textname, snapshotname]
+
+
+SESSIONS = {"sample": SamplingSession, "cprofile": CProfileSession, "tracemalloc": TracemallocSession}
+
+
+class Profiler(object):
+    """Runs hooked calls, and at most one profiling session at a time.
+    """
+    def __init__(self):
+        self.session = None
+        self.directory = tempfile.gettempdir()
+        self.process_name = None
+        self.defaults = {"mode": "sample", "calls": None, "seconds": 10.0, "interval": 0.005}
+        self._local = local()
+        self._lock = Lock()
+
+    def call(self, name, fcn, *args, **kwargs):
+        """Calls fcn(*args, **kwargs), profiling it as the hook name if a session is active.
+        """
+        session = self.session
+        if session is None or getattr(self._local, "hooked", False):
+            return fcn(*args, **kwargs)
+        self._local.hooked = True
+        try:
+            return session.call(name, fcn, args, kwargs)
+        finally:
+            self._local.hooked = False
+
+    def _prefix(self):
+        name = "%s-%d-%s" % (self.process_name or "profile", os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        return os.path.join(self.directory, name)
+
+    def start(self, mode=None, calls=None, seconds=None, interval=None):
+        """Starts a profiling session, taking the mode and limits not passed from the defaults.
+
+        The session ends after calls hooked calls or seconds s; if neither is passed, the default limits are used.
+        Raises ValueError if a session is already active, or if mode is unknown or unavailable.
+        """
+        mode = mode or self.defaults["mode"]
+        if mode not in SESSIONS:
+            raise ValueError("Unknown profiling mode '%s', expected one of %s" % (mode, ", ".join(MODES)))
+        if not calls and not seconds:
+            calls, seconds = self.defaults["calls"], self.defaults["seconds"]
+        if not calls and not seconds:
+            raise ValueError("A profiling session needs a number of calls or of seconds")
+        kwargs = {}
+        if mode == "sample":
+            kwargs["interval"] = interval or self.defaults["interval"]
+        with self._lock:
+            if self.session is not None:
+                raise ValueError("A profiling session is already active: " + self.session.describe())
+            session = SESSIONS[mode](self._prefix(), calls=calls, seconds=seconds, **kwargs)
+            session.on_finish = self._finished
+            session.start()
+            self.session = session
+        global_logger.get().info("Started %s", session.describe())
+        return session
+
+    def stop(self):
+        """Ends the active session early, returning the names of the files it wrote, or None if none was active.
+        """
+        session = self.session
+        if session is None:
+            return None
+        session.finish()
+        return session.filenames
+
+    def _finished(self, session):
+        with self._lock:
+            if self.session is session:
+                self.session = None
+        global_logger.get().info("Finished %s profiling after %d calls, wrote %s", session.mode, session.ncalls,
+                                 ", ".join(session.filenames) or "nothing")
+
+    def status(self):
+        session = self.session
+        return session.describe() if session is not None else "no active session"
+
+    def toggle(self):
+        """Ends the active session, or starts one with the defaults if none is active.
+        """
+        if self.session is not None:
+            self.stop()
+        else:
+            self.start()
+
+    def handle_command(self, line):
+        """Handles a control command, as described in the module documentation, returning the reply.
+        """
+        words = line.split()
+        if not words:
+            return "error: empty command"
+        command, kwargs = words[0], {}
+        try:
+            if command == "status":
+                return self.status()
+            if command == "stop":
+                filenames = self.stop()
+                return "no active session" if filenames is None else "wrote " + (", ".join(filenames) or "nothing")
+            for word in words[1:]:
+                key, _, value = word.partition("=")
+                if key == "calls":
+                    kwargs[key] = int(value)
+                elif key in ("seconds", "interval"):
+                    kwargs[key] = float(value)
+                else:
+                    raise ValueError("Unknown argument '%s'" % word)
+            return "started " + self.start(command, **kwargs).describe()
+        except ValueError, e:
+            return "error: %s" % e
+
+    def install_signal_handler(self, signum=signal.SIGUSR2):
+        """Makes the passed signal toggle a session with the defaults. Must be called from the main thread.
+        """
+        def handler(signum, frame):
+            try:
+                self.toggle()
+            except ValueError, e:
+                global_logger.get().warn("Could not start profiling: %s", e)
+        signal.signal(signum, handler)
+
+global_profiler = Profiler()
+
+
+class ControlServer(Thread):
+    """Daemon thread accepting profiling commands on a unix socket at path, one per connection.
+
+    The socket is bound on construction, replacing any stale socket at path, so that errors are raised at once.
+    """
+    def __init__(self, path, profiler=None):
+        Thread.__init__(self, name="profile-control")
+        self.setDaemon(True)
+        self.path = path
+        self.profiler = profiler if profiler is not None else global_profiler
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(4)
+
+    def run(self):
+        while True:
+            conn, _ = self.socket.accept()
+            try:
+                line = conn.makefile("r").readline()
+                conn.sendall(self.profiler.handle_command(line) + "\n")
+            except socket.error, e:
+                global_logger.get().warn("Error handling profiling command on '%s': %s", self.path, e)
+            finally:
+                conn.close()
+
+
+def send_command(path, command, timeout=30.0):
+    """Sends a command to the profiling control socket at path, and returns the reply.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(command.strip() + "\n")
+        return sock.makefile("r").readline().strip()
+    finally:
+        sock.close()
+
+
+def add_profiling_options(parser):
+    """Adds options controlling on-demand profiling to the passed optparse.OptionParser.
+    """
+    parser.add_option("--profile-socket", default=None,
+                      help="If given, accept profiling commands on a unix socket at this path")
+    parser.add_option("--profile-dir", default=tempfile.gettempdir(),
+                      help="Directory to write profiles into, default %default")
+    parser.add_option("--profile-mode", type="choice", choices=MODES, default="sample",
+                      help="Profiling mode of sessions started by SIGUSR2, one of " + ", ".join(MODES) +
+                           ", default %default")
+    parser.add_option("--profile-calls", type="int", default=0,
+                      help="If positive, sessions started by SIGUSR2 end after this many hooked calls rather " +
+                           "than after --profile-seconds, default %default")
+    parser.add_option("--profile-seconds", type="float", default=10.0,
+                      help="Duration in s of sessions started by SIGUSR2, default %default")
+    parser.add_option("--profile-interval", type="float", default=0.005,
+                      help="Time in s between stack samples in sample mode, default %default")
+
+
+def start_profiling(opts, process_name=None):
+    """Sets up on-demand profiling of this process as specified by the options added by add_profiling_options().
+
+    When each of several processes accepts its own commands, each should pass a distinct process_name, which is
+    added to the path of the control socket and to the names of profiles.
+    """
+    global_profiler.directory = opts.profile_dir
+    global_profiler.process_name = process_name
+    global_profiler.defaults.update(mode=opts.profile_mode, interval=opts.profile_interval)
+    if opts.profile_calls > 0:
+        global_profiler.defaults.update(calls=opts.profile_calls, seconds=None)
+    else:
+        global_profiler.defaults.update(calls=None, seconds=opts.profile_seconds)
+    if current_thread().name == "MainThread":
+        global_profiler.install_signal_handler()
+    if opts.profile_socket:
+        path = opts.profile_socket
+        if process_name:
+            path = "%s.%s" % (path, process_name)
+        ControlServer(path).start()
+        global_logger.get().info("Accepting profiling commands on %s", path)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print >> sys.stderr, "usage: %s <control socket> <command> [arguments...]" % sys.argv[0]
+        sys.exit(1)
+    print send_command(sys.argv[1], " ".join(sys.argv[2:]))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 """Module to support using regular expressions to match filenames or portions of filenames.
 """
+from collections import namedtuple, OrderedDict
 import os
 import re
 
+from thunder_streaming.feeder.utils.filenames import getFilenamePostfix, getFilenamePrefix
+
 
 class RegexMatchToQueueName(object):
     """Supports associating matched regular expressions with names of queues (strings).
@@ -136,3 +139,120 @@ class RegexMatchToPredicate(object):
         """
         basename = os.path.basename(filename)
         return bool(self.regex.match(basename))
+
+
+ParsedFilename = namedtuple("ParsedFilename", ["queue", "timepoint", "timepoint_string"])
+
+
+class FilenameParser(object):
+    """Extracts queue name and timepoint from filenames in a single pass, memoizing the results.
+
+    Queue names are determined either by a list of regular expressions, as for RegexMatchToQueueName, or if no
+    regular expressions are given, by the filename prefix before the first delimiter character. Likewise timepoints
+    are given either by a group within a regular expression, as for RegexMatchToTimepointString, or by the filename
+    postfix after the first delimiter.
+
+    All regular expressions are compiled into a single pattern, with the queue regexes combined in one alternation
+    of named groups, so that the queue name and timepoint are extracted from a single match() call.
+
+    Timepoints are converted to integers where possible. Parsed results are cached in a bounded LRU cache keyed by
+    basename, so that repeated lookups of the same file by different consumers are cheap.
+    """
+    _QUEUE_GROUP_FMT = "_fnparser_queue%d"
+
+    def __init__(self, queue_regex_strings=None, queue_names=None, timepoint_regex_string=None, timepoint_group=1,
+                 delim='_', cache_size=4096):
+        queue_regex_strings = list(queue_regex_strings or [])
+        queue_names = list(queue_names or [])
+        if len(queue_regex_strings) != len(queue_names):
+            raise ValueError("Must have equal numbers of regular expressions and queue names, " +
+                             "got %d regexes and %d queues" % (len(queue_regex_strings), len(queue_names)))
+        self.queue_names = queue_names
+        self.delim = delim
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._queue_groups = [self._QUEUE_GROUP_FMT % qidx for qidx in xrange(len(queue_names))]
+        alternation = "|".join("(?P<%s>%s)" % (group, regex_str)
+                               for group, regex_str in zip(self._queue_groups, queue_regex_strings))
+        if alternation:
+            alternation = "(?=%s)" % alternation
+        if timepoint_regex_string is not None:
+            # timepoint groups are numbered after any groups in the queue alternation:
+            self._timepoint_group = re.compile(alternation).groups + timepoint_group
+            pattern = "%s(?:%s)?" % (alternation, timepoint_regex_string)
+        else:
+            self._timepoint_group = None
+            pattern = alternation
+        self.regex = re.compile(pattern) if pattern else None
+        self._regex_queues = bool(queue_regex_strings)
+
+    @classmethod
+    def fromFiles(cls, queue_regex_file=None, timepoint_regex_file=None, **kwargs):
+        """Factory to instantiate a FilenameParser from the same regular expression files read by
+        RegexMatchToQueueName.fromFile() and RegexMatchToTimepointString.fromFile().
+
+        Either file may be None, in which case the filename prefix or postfix is used instead.
+        """
+        queue_regex_strings, queue_names, timepoint_regex_string = None, None, None
+        if queue_regex_file:
+            queue_matcher = RegexMatchToQueueName.fromFile(queue_regex_file)
+            queue_regex_strings = [regex.pattern for regex in queue_matcher.regexs]
+            queue_names = queue_matcher.queue_names
+        if timepoint_regex_file:
+            timepoint_regex_string = _first_noncomment_line(timepoint_regex_file)
+        return cls(queue_regex_strings, queue_names, timepoint_regex_string, **kwargs)
+
+    def _parse_basename(self, basename):
+        queue, timepoint_string = None, None
+        m = self.regex.match(basename) if self.regex else None
+        if self._regex_queues:
+            if m:
+                for qidx, group in enumerate(self._queue_groups):
+                    if m.start(group) >= 0:
+                        queue = self.queue_names[qidx]
+                        break
+        else:
+            queue = getFilenamePrefix(basename, self.delim)
+        if self._timepoint_group is not None:
+            timepoint_string = m.group(self._timepoint_group) if m else None
+        else:
+            timepoint_string = getFilenamePostfix(basename, self.delim)
+
+        if timepoint_string is None:
+            timepoint = None
+        elif timepoint_string.isdigit():
+            timepoint = int(timepoint_string)
+        else:
+            timepoint = timepoint_string
+        return ParsedFilename(queue, timepoint, timepoint_string)
+
+    def parse(self, filename):
+        """Returns a ParsedFilename (queue, timepoint, timepoint_string) tuple for the passed filename.
+
+        Fields that cannot be determined for this filename are None. Only the basename is used, directory components
+        are ignored.
+        """
+        basename = os.path.basename(filename)
+        cache = self._cache
+        parsed = cache.pop(basename, None)
+        if parsed is None:
+            parsed = self._parse_basename(basename)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        # (re)insert as most recently used:
+        cache[basename] = parsed
+        return parsed
+
+    def queueName(self, filename):
+        """Returns the queue name for the passed filename, or None if none can be determined.
+
+        This may be used as a filename predicate, to skip files that don't belong to any queue.
+        """
+        return self.parse(filename).queue
+
+    def timepoint(self, filename):
+        """Returns the timepoint for the passed filename, as an integer if possible, or None if none can be
+        determined.
+        """
+        return self.parse(filename).timepoint
@@ -0,0 +1,143 @@
+"""Functions to place the contents of input files into the feeder output directory as cheaply as possible.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+
+# errnos indicating that a particular transfer method is unavailable for this pair of files,
+# rather than a genuine I/O error:
+_UNSUPPORTED_ERRNOS = frozenset([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                                 getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.EOPNOTSUPP])
+
+# ioctl making the destination file share the source file's extents, on copy-on-write filesystems (btrfs, XFS):
+FICLONE = 0x40049409
+
+
+def _libc_function(name, restype, argtypes):
+    """Returns the named function from the C library, or None if the library does not provide it.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fcn = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    fcn.restype = restype
+    fcn.argtypes = argtypes
+    return fcn
+
+# os.copy_file_range() and os.sendfile() only exist in python 3, so the C library's are called through ctypes.
+# copy_file_range() needs glibc 2.27 or later, and sendfile() to a regular file Linux 2.6.33 or later.
+_libc_copy_file_range = _libc_function('copy_file_range', ctypes.c_ssize_t,
+                                       [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_size_t, ctypes.c_uint])
+_libc_sendfile = _libc_function('sendfile', ctypes.c_ssize_t,
+                                [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+
+def _kernel_copy(srcname, dstname, copy_fcn):
+    """Copies srcname to dstname using the passed in-kernel copy function, without passing through user space.
+
+    copy_fcn should have the signature copy_fcn(infd, outfd, count) and return the number of bytes copied.
+
+    Raises OSError if the copy function is not supported for these files.
+    """
+    with open(srcname, 'rb') as infp:
+        with open(dstname, 'wb') as outfp:
+            infd, outfd = infp.fileno(), outfp.fileno()
+            remaining = os.fstat(infd).st_size
+            while remaining > 0:
+                ncopied = copy_fcn(infd, outfd, remaining)
+                if not ncopied:
+                    break
+                remaining -= ncopied
+
+
+def _check_ncopied(ncopied):
+    if ncopied < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ncopied
+
+
+def _copy_file_range_fcn(infd, outfd, count):
+    # NULL offsets copy from and to the files' current positions, advancing them
+    return _check_ncopied(_libc_copy_file_range(infd, None, outfd, None, count, 0))
+
+
+def _sendfile_fcn(infd, outfd, count):
+    return _check_ncopied(_libc_sendfile(outfd, infd, None, count))
+
+
+def _copy_methods():
+    methods = []
+    if _libc_copy_file_range is not None:
+        methods.append(("copy_file_range", _copy_file_range_fcn))
+    if _libc_sendfile is not None:
+        methods.append(("sendfile", _sendfile_fcn))
+    return methods
+
+
+def clone_file(srcname, dstname):
+    """Makes dstname a reflink of srcname: a separate file sharing srcname's data blocks until either is modified.
+
+    Raises OSError (or IOError) if the filesystem does not support reflinks, or the files are on different
+    filesystems.
+    """
+    with open(srcname, 'rb') as infp:
+        with open(dstname, 'wb') as outfp:
+            try:
+                fcntl.ioctl(outfp.fileno(), FICLONE, infp.fileno())
+            except IOError, e:
+                # fcntl raises IOError in python 2
+                raise OSError(e.errno, e.strerror)
+
+
+def transfer_file(srcname, dstname, clone=False, link=True):
+    """Makes the contents of srcname available at dstname, using the cheapest available method.
+
+    If srcname is on the same filesystem as the directory containing dstname, and 'link' is set, a hard link is
+    made, which does not copy any data. Otherwise the file is copied in-kernel with copy_file_range() or sendfile()
+    where these are available, falling back to a regular copy.
+
+    Note that a hard link shares its inode, and so its modification time, with the original file, so callers should
+    not touch a linked dstname. If 'clone' is set, a reflink is tried before a hard link, which copies no data
+    either, but makes a separate inode.
+
+    Returns
+    -------
+    string name of the method used: one of "clone", "link", "copy_file_range", "sendfile", or "copy".
+    """
+    if os.path.lexists(dstname):
+        os.remove(dstname)
+
+    if os.stat(srcname).st_dev == os.stat(os.path.dirname(os.path.abspath(dstname))).st_dev:
+        if clone:
+            try:
+                clone_file(srcname, dstname)
+                return "clone"
+            except OSError, e:
+                if os.path.lexists(dstname):
+                    os.remove(dstname)
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+        if link:
+            try:
+                os.link(srcname, dstname)
+                return "link"
+            except OSError, e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+
+    for method_name, copy_fcn in _copy_methods():
+        try:
+            _kernel_copy(srcname, dstname, copy_fcn)
+            return method_name
+        except OSError, e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    shutil.copyfile(srcname, dstname)
+    return "copy"
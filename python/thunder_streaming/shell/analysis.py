@@ -1,5 +1,7 @@
 from thunder_streaming.shell.mapped_scala_class import MappedScalaClass
 from thunder_streaming.shell.param_listener import ParamListener
+from thunder_streaming.shell.latency import latency_tracker
+from thunder_streaming.feeder.utils.profiling import global_profiler
 import settings
 from threading import Thread
 import time
@@ -68,30 +70,43 @@ class Analysis(MappedScalaClass, ParamListener):
                 return None
             return set([path_and_size(f) for f in os.listdir(root)])
 
+        def _poll(self):
+            """
+            Checks the output directory for new subdirectories, and returns a list of (subdirectory, file names) for
+            those whose contents have remained the same for a sufficient period of time, in order of batch time
+            """
+            cur_time = time.time()
+            dp = cur_time - self.last_dir_poll
+            if dp > self.DIR_POLL_PERIOD:
+                cur_dir_state = self._qualified_dir_set(self.output_dir)
+                if cur_dir_state != self._last_dir_state:
+                    if self._last_dir_state != None:
+                        diff = cur_dir_state.difference(self._last_dir_state)
+                        self._start_monitoring(diff)
+                    self._last_dir_state = cur_dir_state
+                self.last_dir_poll = cur_time
+            ready = []
+            for dir, info in self.monitored_dirs.items():
+                dir_state = self._qualified_file_set(dir)
+                if info[0] != dir_state:
+                    self.monitored_dirs[dir] = (dir_state, time.time())
+                elif info[0]:
+                    # Only want to get to this point if the directory is not empty
+                    if (time.time() - info[1]) > self.FILE_POLL_PERIOD:
+                        # The directory has remained the same for a sufficient period of time
+                        ready.append((dir, map(lambda x: x[0], dir_state)))
+                        del self.monitored_dirs[dir]
+            ready.sort(key=lambda item: latency_tracker.batch_time(*item))
+            return ready
+
         def run(self):
             while not self._stopped:
-                cur_time = time.time()
-                dp = cur_time - self.last_dir_poll
-                if dp > self.DIR_POLL_PERIOD:
-                    cur_dir_state = self._qualified_dir_set(self.output_dir)
-                    if cur_dir_state != self._last_dir_state:
-                        if self._last_dir_state != None:
-                            diff = cur_dir_state.difference(self._last_dir_state)
-                            self._start_monitoring(diff)
-                        self._last_dir_state = cur_dir_state
-                    self.last_dir_poll = cur_time
-                for dir, info in self.monitored_dirs.items():
-                    dir_state = self._qualified_file_set(dir)
-                    if info[0] != dir_state:
-                        self.monitored_dirs[dir] = (dir_state, time.time())
-                    elif info[0]:
-                        # Only want to get to this point if the directory is not empty
-                        if (time.time() - info[1]) > self.FILE_POLL_PERIOD:
-                            # The directory has remained the same for a sufficient period of time
-                            only_names = map(lambda x: x[0], dir_state)
-                            for output in self.outputs:
-                                output.handle_new_data(dir, only_names)
-                            del self.monitored_dirs[dir]
+                # Polling and each converter are profiled separately when profiling is turned on
+                for dir, only_names in global_profiler.call("monitor", self._poll):
+                    latency_tracker.output_detected(self.output_dir, dir, only_names)
+                    for output in self.outputs:
+                        global_profiler.call("convert", output.handle_new_data, dir, only_names)
+                    latency_tracker.finish(dir)
                 time.sleep(self.WAIT_PERIOD)
 
 
@@ -1,4 +1,7 @@
 from thunder_streaming.shell.analysis import Analysis
+from thunder_streaming.shell.latency import latency_tracker
+from thunder_streaming.feeder.preview import DEFAULT_TOPIC, decode_preview
+from thunder_streaming.feeder.utils.profiling import global_profiler
 
 from abc import abstractmethod
 from collections import OrderedDict
@@ -12,6 +15,7 @@ import os
 import json
 import struct
 import time
+from threading import Thread
 
 # TODO Fix up comment
 """
@@ -87,7 +91,8 @@ class Data(object):
     def output(func):
         def add_to_output(self, *args, **kwargs):
             self.output_funcs[func.func_name] = lambda data: func(self, data, *args, **kwargs)
-            return self.analysis
+            # Data objects that aren't fed by an Analysis (i.e. FeederPreview) return themselves for chaining
+            return self.analysis if self.analysis is not None else self
         return add_to_output
 
     @staticmethod
@@ -148,6 +153,7 @@ class Data(object):
             transformed = func(transformed)
         for func in self.output_funcs.values():
             func(transformed)
+        latency_tracker.converted(root)
 
     def start(self):
         self.analysis.start()
@@ -358,3 +364,76 @@ class Image(Series):
         else:
             # Do dashboard stuff here
             lgn.image(data)
+
+
+class FeederPreview(Image):
+    """
+    Receives the downsampled uint8 frames published by the feeder's preview tap (see feeder/preview.py) through the
+    MessageProxy, and passes them through the usual Image transformations and outputs. This shows live frames within
+    a fraction of a second, without waiting for Spark and an Analysis' output directory.
+
+    A FeederPreview isn't created from an Analysis; it should be added to the ThunderStreamingContext, which starts
+    and stops it along with the analyses:
+
+    feeder_conf.set_preview_addr(FeederConfiguration.MESSAGE_PROXY)
+    preview = FeederPreview(tssc).getPlane(0).toLightning(image_viz, None, only_viz=True)
+    tssc.add_preview(preview)
+
+    Frames arrive as (z,) y, x arrays. If the viewer falls behind, only the most recent frame is shown.
+    """
+
+    class Receiver(Thread):
+        """
+        Receives frames from the MessageProxy and hands the most recent one to the FeederPreview
+        """
+
+        def __init__(self, preview):
+            Thread.__init__(self)
+            self.preview = preview
+            self.subscriber = preview.tssc.get_message_proxy().get_subscriber(preview.topic)
+            self._stopped = False
+            self.setDaemon(True)
+
+        def stop(self):
+            self._stopped = True
+
+        def run(self):
+            while not self._stopped:
+                payload = self.subscriber.receive(blocking=False)
+                if payload is None:
+                    continue
+                # Skip straight to the newest frame if several have queued up
+                newer = self.subscriber.receive(blocking=False)
+                while newer is not None:
+                    payload = newer
+                    newer = self.subscriber.receive(blocking=False)
+                try:
+                    global_profiler.call("convert", self.preview.handle_new_data, None, payload)
+                except Exception as e:
+                    print "Error handling feeder preview: %s" % str(e)
+            self.subscriber.close()
+
+    def __init__(self, tssc, topic=DEFAULT_TOPIC):
+        Image.__init__(self, None, None, None)
+        self.tssc = tssc
+        self.topic = topic
+        self.receiver = None
+        # Header of the last frame received, and the time from the feeder matching it to its arrival here
+        self.last_header = None
+        self.latency = None
+
+    def _convert(self, root, new_data):
+        header, frame = decode_preview(new_data)
+        self.last_header = header
+        self.latency = time.time() - header["time"]
+        self.dims = frame.shape
+        return frame
+
+    def start(self):
+        self.receiver = FeederPreview.Receiver(self)
+        self.receiver.start()
+
+    def stop(self):
+        if self.receiver:
+            self.receiver.stop()
+            self.receiver = None
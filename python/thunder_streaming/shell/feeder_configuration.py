@@ -9,14 +9,21 @@ FEEDER_DIR = "python/thunder_streaming/feeder/bin/"
 GSS_FEEDER_PATH = os.path.join(THUNDER_STREAMING_PATH, FEEDER_DIR, "grouping_series_stream_feeder.py")
 SS_FEEDER_PATH = os.path.join(THUNDER_STREAMING_PATH, FEEDER_DIR, "series_stream_feeder.py")
 
-DEFAULT_TMP_DIR = "/nobackup/freeman/streamingtmp/"
-
 
 class FeederConfiguration(object):
     """
     A FeederConfiguration contains all the information necessary to launch the feeder script, including whether to look
     for both imaging and behavioral data, the number of files to transfer per batch, and relevant file prefixes
     (specified by regexes).
+
+    Calling set_batch_time(FeederConfiguration.STREAMER_BATCH_TIME) makes the feeder write out one file shortly before
+    each of the streamer's batches, using the BATCH_TIME of the ThunderStreamingContext that starts it.
+
+    Calling set_preview_addr(FeederConfiguration.MESSAGE_PROXY) makes the feeder publish downsampled previews of its
+    frames to that context's MessageProxy, for display with a FeederPreview.
+
+    Calling set_write_manifests() makes the feeder write manifests that the ThunderStreamingContext uses to trace the
+    latency of each timepoint through the feeder, Spark and the shell (see ThunderStreamingContext.latency_report()).
     """
 
     class RegexList:
@@ -31,6 +38,32 @@ class FeederConfiguration(object):
             for regex in self.regexes:
                 yield regex
 
+    class StageList:
+        """
+        Wrapper for an ordered list of pre-reduction stage specifications (i.e. "clip:0:4095"), which will get joined
+        into a single --stages argument
+        """
+
+        def __init__(self, stages):
+            self.stages = stages
+
+        def __iter__(self):
+            for stage in self.stages:
+                yield stage
+
+    class QueueSpecList:
+        """
+        Wrapper for a set of per-queue input decoding specifications (i.e. "behav dtype=float32 offset=64 keys=own"),
+        which will get written to a queue spec file
+        """
+
+        def __init__(self, queue_specs):
+            self.queue_specs = queue_specs
+
+        def __iter__(self):
+            for queue_spec in self.queue_specs:
+                yield queue_spec
+
     # Keyword parameters for the feeder script
     KW_PARAMS = {
         'mod_buffer_time': '--mod-buffer-time',
@@ -47,9 +80,39 @@ class FeederConfiguration(object):
         'timepoint_regexes': '--timepoint-regex-file',
         'filter_regexes': '--filter-regex-file',
         'check_size': '--check-size',
-        'no_check_skip': '--no-check-skip'
+        'no_check_skip': '--no-check-skip',
+        'stages': '--stages',
+        'queue_specs': '--queue-spec-file',
+        'max_backlog': '--max-backlog',
+        'backlog_mode': '--backlog-mode',
+        'backlog_path': '--backlog-path',
+        'target_latency': '--target-latency',
+        'min_batch': '--min-batch',
+        'max_batch': '--max-batch',
+        'transform_workers': '--transform-workers',
+        'prefetch_threads': '--prefetch-threads',
+        'batch_time': '--batch-time',
+        'preview_addr': '--preview-addr',
+        'preview_topic': '--preview-topic',
+        'preview_shape': '--preview-shape',
+        'preview_downsample': '--preview-downsample',
+        'preview_rate': '--preview-rate',
+        'metrics_port': '--metrics-port',
+        'metrics_file': '--metrics-file',
+        'metrics_interval': '--metrics-interval',
+        'write_manifests': '--write-manifests'
     }
 
+    # Keyword parameters that are flags, passed without a value when set
+    FLAG_PARAMS = set(['linear', 'check_size', 'no_check_skip', 'write_manifests'])
+
+    # Value of batch_time standing for the streamer's BATCH_TIME run parameter, filled in when the feeder is started
+    # by a ThunderStreamingContext
+    STREAMER_BATCH_TIME = 'streamer'
+
+    # Value of preview_addr standing for the MessageProxy of the ThunderStreamingContext that starts the feeder
+    MESSAGE_PROXY = 'proxy'
+
     # Positional parameters are ordered and don't have '--' specifiers
     POS_PARAMS = OrderedDict({
         'images_dir': '',
@@ -58,9 +121,7 @@ class FeederConfiguration(object):
     })
 
     # All entries in this dict are converted to environment variables immediately before the feeder script is started
-    ENV_VAR_PARAMS = {
-        'TMP': ''
-    }
+    ENV_VAR_PARAMS = {}
 
     def __init__(self):
         self.params = {}
@@ -75,8 +136,6 @@ class FeederConfiguration(object):
         for (n, v) in chain(self.KW_PARAMS.items(), self.POS_PARAMS.items(), self.ENV_VAR_PARAMS.items()):
             self.__dict__['set_' + n.lower()] = _update_param(n)
 
-        self.set_tmp(DEFAULT_TMP_DIR)
-
     def _get_executable(self):
         if self.params.get('behaviors_dir'):
             return GSS_FEEDER_PATH
@@ -104,6 +163,24 @@ class FeederConfiguration(object):
             else:
                 print "Can only write regexes in RegexList form"
 
+        # Queue specs are written to a temporary file, one line per queue
+        if name == 'queue_specs':
+            if isinstance(value, FeederConfiguration.QueueSpecList):
+                with NamedTemporaryFile(delete=False) as temp:
+                    for queue_spec in value:
+                        temp.write(queue_spec + '\n')
+                return temp.name
+            else:
+                print "Can only write queue specs in QueueSpecList form"
+
+        # Stage lists are joined into a single comma-separated specification
+        if isinstance(value, FeederConfiguration.StageList):
+            return ",".join(value)
+
+        # Flags are set by calling their setter without a value, or with any true value
+        if name in self.FLAG_PARAMS:
+            return 'true' if value == '' or value else ''
+
         # The default is to convert the value to a str and pass it through
         return str(value)
 
@@ -116,6 +193,8 @@ class FeederConfiguration(object):
         def build_arg(param_dict, p):
             prefix = param_dict.get(p)
             val = self.params.get(p)
+            if val and p in self.FLAG_PARAMS:
+                return [prefix]
             if val and prefix:
                 return [prefix, val]
             elif val:
@@ -132,7 +211,7 @@ class FeederConfiguration(object):
         # insert the executable name into the argument list
         arg_list.insert(0, self._get_executable())
 
-        return (dict([(k, self.params.get(k)) for k in self.ENV_VAR_PARAMS.keys()]),
+        return (dict([(k, self.params.get(k)) for k in self.ENV_VAR_PARAMS.keys() if self.params.get(k)]),
                 arg_list)
 
     def __str__(self):
@@ -0,0 +1,246 @@
+"""
+Tracing of the latency of each timepoint, from its frames landing on disk to the results of its analysis having been
+converted by the shell.
+
+The feeder, when started with --write-manifests, writes a manifest next to each series file recording when each of
+its timepoints was last modified on disk, matched by the feeder, and published (see feeder/manifest.py). The
+LatencyTracker reads these from Spark's input directory as they appear. Each Analysis.FileMonitor tells the tracker
+when it has detected a new output directory, and each Data converter when it has converted it. Timepoints are
+attributed to the output of the Spark batch that picked them up: the first batch whose time is no earlier than the
+time their series file was published. Batch times are read from Spark's output file names (prefix-id-time.bin).
+
+Latencies are broken down into stages:
+    discovery: from the last input file being modified to the timepoint being matched by the feeder
+    feeder: from being matched to being published into Spark's input directory
+    batch_wait: from being published to the start of the Spark batch that picks it up
+    spark: from the start of that batch to the last of its output being written
+    monitor: from the output being written to the FileMonitor detecting it
+    conversion: from the output being detected to the last converter having handled it
+    total: from the last input file being modified to the last converter having handled the output
+All times are wall clock times, so the feeder, Spark and the shell should run on hosts with synchronized clocks.
+"""
+
+from thunder_streaming.feeder.manifest import is_manifest_name, read_manifest
+
+from collections import deque
+from threading import Thread, Lock
+import numpy as np
+import os
+import re
+import time
+
+STAGES = ("discovery", "feeder", "batch_wait", "spark", "monitor", "conversion", "total")
+
+# Spark output files end in the batch time in ms, followed by an extension
+BATCH_TIME_PATTERN = re.compile("-(\d{10,})(\.\w+)?$")
+
+
+class LatencyTracker(object):
+    """
+    Collects manifests written by the feeder and stamps from the shell, and reports latency percentiles for each stage
+    and a time series of latencies per Spark batch.
+    """
+
+    class ManifestReader(Thread):
+        """
+        Polls Spark's input directory for new manifests
+        """
+
+        def __init__(self, tracker, input_dir):
+            Thread.__init__(self)
+            self.tracker = tracker
+            self.input_dir = input_dir
+            self._stopped = False
+            self.setDaemon(True)
+
+        def stop(self):
+            self._stopped = True
+
+        def run(self):
+            while not self._stopped:
+                try:
+                    self.tracker.read_manifests(self.input_dir)
+                except OSError as e:
+                    print "Error reading feeder manifests: %s" % str(e)
+                time.sleep(self.tracker.POLL_PERIOD)
+
+    # Time between checks of Spark's input directory for new manifests
+    POLL_PERIOD = 0.5
+    # Number of manifests, timepoints and batches to keep
+    MAX_MANIFESTS = 1000
+    MAX_TIMEPOINTS = 100000
+    MAX_BATCHES = 10000
+
+    def __init__(self):
+        self.reader = None
+        self._lock = Lock()
+        # Names of manifests already read that are still in the input directory
+        self._seen = set()
+        # Manifests read, in order of publication
+        self._manifests = deque(maxlen=self.MAX_MANIFESTS)
+        # Analysis output dir -> time of the last batch whose output has been detected
+        self._last_batch = {}
+        # Output dir of a single batch -> dict of stamps for output being converted
+        self._open = {}
+        # (analysis output dir, {stage: latency}) for each timepoint
+        self.timepoints = deque(maxlen=self.MAX_TIMEPOINTS)
+        # One dict for each batch output; see time_series()
+        self.batches = deque(maxlen=self.MAX_BATCHES)
+
+    def start(self, input_dir):
+        """
+        Starts reading manifests from the passed directory (Spark's input directory)
+        """
+        self.stop()
+        self.reader = LatencyTracker.ManifestReader(self, input_dir)
+        self.reader.start()
+
+    def stop(self):
+        if self.reader:
+            self.reader.stop()
+            self.reader = None
+
+    def reset(self):
+        with self._lock:
+            self.timepoints.clear()
+            self.batches.clear()
+
+    def read_manifests(self, input_dir):
+        names = set(name for name in os.listdir(input_dir) if is_manifest_name(name))
+        for name in sorted(names - self._seen):
+            manifest = read_manifest(os.path.join(input_dir, name))
+            if manifest is not None:
+                with self._lock:
+                    self._manifests.append(manifest)
+        # forget manifests that have been cleaned up, so that _seen stays small
+        self._seen = names
+
+    @staticmethod
+    def _written(root, filenames):
+        written = os.path.getmtime(root)
+        for filename in filenames:
+            try:
+                written = max(written, os.path.getmtime(filename))
+            except OSError:
+                pass
+        return written
+
+    @staticmethod
+    def _batch_time(root, filenames, written):
+        times = []
+        for filename in filenames:
+            m = BATCH_TIME_PATTERN.search(os.path.basename(filename))
+            if m:
+                times.append(int(m.group(1)) / 1000.0)
+        # Without Spark's output file names, the batch is taken to have started when its output was written
+        return max(times) if times else written
+
+    def batch_time(self, root, filenames):
+        """
+        Returns the time of the batch whose output is in root, holding the passed files. Outputs should be passed to
+        output_detected() in order of batch time, as each takes the manifests published since the previous one
+        """
+        return self._batch_time(root, filenames, self._written(root, filenames))
+
+    def output_detected(self, output_dir, root, filenames):
+        """
+        Called by an Analysis.FileMonitor once it has detected the complete output of a batch in root, a new
+        subdirectory of the Analysis' output_dir, holding the passed files
+        """
+        if self.reader is None:
+            return
+        detected = time.time()
+        written = self._written(root, filenames)
+        batch_time = self._batch_time(root, filenames, written)
+        with self._lock:
+            last_batch = self._last_batch.get(output_dir)
+            manifests = [m for m in self._manifests
+                         if m["published"] <= batch_time and (last_batch is None or m["published"] > last_batch)]
+            # a batch detected after a later one gets no manifests, rather than those of the batches after it
+            self._last_batch[output_dir] = max(batch_time, last_batch)
+            self._open[root] = {"output_dir": output_dir, "batch_time": batch_time, "written": written,
+                                "detected": detected, "converted": None, "manifests": manifests}
+
+    def converted(self, root):
+        """
+        Called by a Data converter once it has handled the output in root
+        """
+        trace = self._open.get(root)
+        if trace is not None:
+            trace["converted"] = time.time()
+
+    def finish(self, root):
+        """
+        Called by an Analysis.FileMonitor once all of its converters have been passed the output in root
+        """
+        with self._lock:
+            trace = self._open.pop(root, None)
+        if trace is None:
+            return
+        end = trace["converted"] if trace["converted"] is not None else trace["detected"]
+        latencies = []
+        for manifest in trace["manifests"]:
+            published = manifest["published"]
+            for entry in manifest["timepoints"]:
+                mtime, fed = entry.get("mtime"), entry.get("fed")
+                stages = {
+                    "discovery": fed - mtime if fed is not None and mtime is not None else None,
+                    "feeder": published - fed if fed is not None else None,
+                    "batch_wait": trace["batch_time"] - published,
+                    "spark": trace["written"] - trace["batch_time"],
+                    "monitor": trace["detected"] - trace["written"],
+                    "conversion": end - trace["detected"],
+                    "total": end - mtime if mtime is not None else None
+                }
+                latencies.append(stages)
+        row = {"output_dir": trace["output_dir"], "root": root, "batch_time": trace["batch_time"],
+               "timepoints": len(latencies)}
+        for stage in STAGES:
+            values = [stages[stage] for stages in latencies if stages[stage] is not None]
+            row[stage] = float(np.median(values)) if values else None
+        row["total_max"] = max([stages["total"] for stages in latencies if stages["total"] is not None] or [None])
+        with self._lock:
+            self.timepoints.extend((trace["output_dir"], stages) for stages in latencies)
+            self.batches.append(row)
+
+    def percentiles(self, output_dir=None, percentiles=(50, 90, 99)):
+        """
+        Returns a dict of stage -> (number of timepoints, [latency at each percentile], max latency) over the traced
+        timepoints, optionally only those of the Analysis with the passed output_dir
+        """
+        with self._lock:
+            timepoints = [stages for key, stages in self.timepoints if output_dir is None or key == output_dir]
+        result = {}
+        for stage in STAGES:
+            values = np.array([stages[stage] for stages in timepoints if stages[stage] is not None])
+            if len(values):
+                result[stage] = (len(values), list(np.percentile(values, percentiles)), values.max())
+            else:
+                result[stage] = (0, [None] * len(percentiles), None)
+        return result
+
+    def report(self, output_dir=None, percentiles=(50, 90, 99)):
+        """
+        Returns a table of latency percentiles in s for each stage, as a string
+        """
+        header = "%-12s %8s" % ("stage", "n") + "".join("%10s" % ("p%g" % p) for p in percentiles) + "%10s" % "max"
+        lines = [header]
+        for stage, (n, values, maxval) in sorted(self.percentiles(output_dir, percentiles).items(),
+                                                  key=lambda item: STAGES.index(item[0])):
+            if not n:
+                lines.append("%-12s %8d" % (stage, n))
+                continue
+            lines.append("%-12s %8d" % (stage, n) + "".join("%10.3f" % v for v in values) + "%10.3f" % maxval)
+        return "\n".join(lines)
+
+    def time_series(self, output_dir=None):
+        """
+        Returns a list with a dict for each batch output traced, in order, holding its output_dir, root, batch_time,
+        number of timepoints, the median latency of its timepoints in each stage, and the maximum total latency
+        (total_max)
+        """
+        with self._lock:
+            return [row for row in self.batches if output_dir is None or row["output_dir"] == output_dir]
+
+# Shared by all Analyses and converters in the shell
+latency_tracker = LatencyTracker()
@@ -41,17 +41,20 @@ class Subscriber(object):
 
     def __init__(self, context, addr, tag):
         """
-        Given the host/port of the XSUB proxy, create a PUB socket connected to that proxy
+        Given the host/port of the XPUB proxy, create a SUB socket connected to that proxy
         """
         self.sub_sock = context.socket(zmq.SUB)
         self.sub_sock.connect(addr)
         self.tag = tag
         # If the tag was specified when the object was constructed, subscribe now
         if self.tag:
-            self.pub_sock.setsockopt(zmq.SUBSCRIBE, self.tag)
+            self.sub_sock.setsockopt(zmq.SUBSCRIBE, self.tag)
 
     def subscribe(self, tag):
-        self.pub_sock.setsockopt(zmq.SUBSCRIBE, tag)
+        self.sub_sock.setsockopt(zmq.SUBSCRIBE, tag)
+
+    def close(self):
+        self.sub_sock.close()
 
     def _receive(self):
         [address, msg] = self.sub_sock.recv_multipart()
@@ -126,6 +129,12 @@ class MessageProxy(object):
         else:
             return "inproc://" + MessageProxy.INPROC_PUB_ID
 
+    def get_publisher_addr(self):
+        """
+        :return: The address that remote publishers (such as the feeder's preview tap) should connect to
+        """
+        return self._get_pub_addr(remote=True)
+
     def get_publisher(self, remote=True):
         """
         :param tag: The tag the client will use to publish
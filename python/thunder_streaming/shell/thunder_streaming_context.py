@@ -1,6 +1,8 @@
 from thunder_streaming.shell.analysis import Analysis
 from thunder_streaming.shell.param_listener import ParamListener
 from thunder_streaming.shell.message_proxy import MessageProxy
+from thunder_streaming.shell.latency import latency_tracker
+from thunder_streaming.feeder.utils.profiling import global_profiler
 from thunder_streaming.shell.settings import *
 from thunder_streaming.shell.converter import *
 
@@ -11,6 +13,7 @@ from tempfile import NamedTemporaryFile
 from subprocess import Popen
 import time
 import atexit
+import shutil
 
 
 class ThunderStreamingContext(ParamListener):
@@ -98,9 +101,14 @@ class ThunderStreamingContext(ParamListener):
 
         signal.signal(signal.SIGINT, handler)
         signal.signal(signal.SIGTERM, handler)
+        # SIGUSR2 toggles profiling of the FileMonitor and converter threads (see feeder/utils/profiling.py)
+        global_profiler.process_name = "shell"
+        global_profiler.install_signal_handler()
 
         # ZeroMQ messaging proxy
         self.updaters = []
+        # FeederPreviews, started and stopped along with the analyses
+        self.previews = []
         self.message_proxy = MessageProxy()
         self.message_proxy.start()
         print "MessageProxy is running..."
@@ -137,6 +145,9 @@ class ThunderStreamingContext(ParamListener):
     def add_updater(self, updater):
         self.updaters.append(updater)
 
+    def add_preview(self, preview):
+        self.previews.append(preview)
+
     def add_analysis(self, analysis):
 
         if self.state == self.STARTED:
@@ -208,6 +219,9 @@ class ThunderStreamingContext(ParamListener):
         print "Starting the updaters."
         self._start_updaters()
 
+        for preview in self.previews:
+            preview.start()
+
         print "Starting the streaming analyses with run configuration:"
         print self
         self._start_streaming_child()
@@ -243,6 +257,12 @@ class ThunderStreamingContext(ParamListener):
         if not self.feeder_conf:
             print "You must set the feeder script configuration (using self.set_feeder_conf) before starting the feeder."
             return
+        # Align the feeder's output to the streamer's batches, if requested
+        if self.feeder_conf.params.get('batch_time') == self.feeder_conf.STREAMER_BATCH_TIME:
+            self.feeder_conf.params['batch_time'] = self.run_parameters['BATCH_TIME']
+        # Publish previews to this context's MessageProxy, if requested
+        if self.feeder_conf.params.get('preview_addr') == self.feeder_conf.MESSAGE_PROXY:
+            self.feeder_conf.params['preview_addr'] = self.message_proxy.get_publisher_addr()
         (env_vars, cmd) = self.feeder_conf.generate_command()
         for (key, value) in env_vars.items():
             os.putenv(key, value)
@@ -252,7 +272,15 @@ class ThunderStreamingContext(ParamListener):
         input_dir = self.feeder_conf.params.get('spark_input_dir')
         if input_dir:
             for path in [os.path.abspath(os.path.join(input_dir, f)) for f in os.listdir(input_dir)]:
-                os.remove(path)
+                if os.path.isdir(path):
+                    # staging directories left behind by a previous feeder
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+        # Trace the latency of each timepoint using the manifests the feeder writes next to its output
+        if input_dir and self.feeder_conf.params.get('write_manifests'):
+            latency_tracker.start(input_dir)
 
         self.feeder_child = Popen(cmd)
 
@@ -312,12 +340,58 @@ class ThunderStreamingContext(ParamListener):
             return
         for analysis in self.analyses.values():
             analysis.stop()
+        for preview in self.previews:
+            preview.stop()
+        latency_tracker.stop()
         self._kill_children()
         # If execution reaches this point, then an analysis which was previously started has been stopped. Since it can
         # be restarted immediately, the new state is READY
         self.state = self.READY
         self._reinitialize()
 
+    def latency_report(self, analysis=None):
+        """
+        Prints percentiles of the latency of each timepoint in each stage, from its frames landing on disk to the
+        output of an Analysis having been converted, optionally only for the passed Analysis. Requires the feeder to
+        write manifests (FeederConfiguration.set_write_manifests()); see shell/latency.py for the stages.
+        """
+        output_dir = analysis.get_output_dir() if analysis else None
+        print latency_tracker.report(output_dir)
+
+    def latency_series(self, analysis=None):
+        """
+        Returns a list with a dict for each Spark batch output converted, in order, holding the batch time and the
+        median latency of its timepoints in each stage, optionally only for the passed Analysis.
+        """
+        output_dir = analysis.get_output_dir() if analysis else None
+        return latency_tracker.time_series(output_dir)
+
+    def profile(self, mode="sample", seconds=10.0, calls=None, directory=None):
+        """
+        Profiles the FileMonitor and converter threads for the passed number of seconds, or of calls if given, in
+        one of the modes 'sample', 'cprofile' or 'tracemalloc'. Profiles are written into the passed directory
+        (by default the system's temporary directory) once the session ends, or when stop_profile() is called.
+        """
+        if directory:
+            global_profiler.directory = directory
+        if calls:
+            seconds = None
+        try:
+            session = global_profiler.start(mode, calls=calls, seconds=seconds)
+        except ValueError as e:
+            print "Could not start profiling: %s" % str(e)
+            return
+        print "Started %s" % session.describe()
+
+    def stop_profile(self):
+        """
+        Ends the active profiling session, and returns the names of the files written
+        """
+        filenames = global_profiler.stop()
+        if filenames is None:
+            print "No profiling session is active"
+        return filenames
+
     def __repr__(self):
         return self.__str__()
 
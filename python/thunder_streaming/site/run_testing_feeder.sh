@@ -1,14 +1,13 @@
 #!/bin/bash
 PATH_SUBDIR=python/
-FEEDER_SUBDIR="$PATH_SUBDIR"/thunder/streaming/feeder/bin
+FEEDER_SUBDIR="$PATH_SUBDIR"/thunder_streaming/feeder
 
 THUNDER_STREAMING_DIR=/mnt/data/src/thunder_streaming_mainline_1501
 BASEDIR=/mnt/tmpram
-BEHAV_DELAY=5.0
+FRAME_RATE=2.0
 
+# images and behavioural data are written for the same frames, at the same rate
 PYTHONPATH="$THUNDER_STREAMING_DIR"/"$PATH_SUBDIR" \
-"$FEEDER_SUBDIR"/testutils/stream_feeder_testing_feeder.py "$BASEDIR"/feederimgs \
---datafileprefix img_ &
-sleep "$BEHAV_DELAY"
-"$FEEDER_SUBDIR"/testutils/stream_feeder_testing_feeder.py "$BASEDIR"/feederbehav \
---datalen 2 --datamax 128 --datafileprefix behav_ &
+"$FEEDER_SUBDIR"/testutils/load_generator.py --rate "$FRAME_RATE" --files-per-subdir 10 \
+--queue img:"$BASEDIR"/feederimgs:1048576 \
+--queue behav:"$BASEDIR"/feederbehav:2:uint16:128 &